@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ~~~~~
+
+    Load generators and benchmarks for a locally running Glia server.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.chat_load
+    ~~~~~
+
+    Load generator for the `/movements` Socket.IO namespace.
+
+    Logs in a number of clients, joins them to a chat room and has each of
+    them send messages at a fixed rate. The latency of a message is the time
+    from emitting `text` until the sender receives the broadcast `message`
+    event for it.
+
+    Requires `socketIO-client<0.6` (for the Socket.IO 0.9 protocol):
+
+        >> python -m benchmarks.chat_load --email me@example.com \\
+            --password secret --mindset <mindset id> --clients 10
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import requests
+
+from uuid import uuid4
+
+from benchmarks.stats import latency_summary
+
+try:
+    from socketIO_client import SocketIO, BaseNamespace
+except ImportError:
+    SocketIO = None
+
+
+def login(base_url, email, password):
+    """Return the cookies of a logged in session"""
+    session = requests.Session()
+    rv = session.get(base_url + "/login")
+    csrf_token = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', rv.text)
+    session.post(base_url + "/login", data={
+        "email": email,
+        "password": password,
+        "csrf_token": csrf_token.group(1) if csrf_token else ""
+    })
+    return session.cookies.get_dict()
+
+
+class ChatClient(threading.Thread):
+    """A chat client sending `count` messages, one every `interval` seconds"""
+
+    def __init__(self, host, port, cookies, mindset_id, count, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.cookies = cookies
+        self.mindset_id = mindset_id
+        self.count = count
+        self.interval = interval
+        self.sent = dict()
+        self.latencies = []
+
+    def on_message(self, data):
+        for token in re.findall(r'bench-[0-9a-f]{32}', data.get("msg", "")):
+            if token in self.sent:
+                self.latencies.append(time.time() - self.sent.pop(token))
+
+    def run(self):
+        socket = SocketIO(self.host, self.port, cookies=self.cookies)
+        movements = socket.define(BaseNamespace, '/movements')
+        movements.on('message', self.on_message)
+        movements.emit('joined', {'room_id': self.mindset_id})
+        socket.wait(seconds=1)
+
+        for i in range(self.count):
+            token = "bench-{}".format(uuid4().hex)
+            self.sent[token] = time.time()
+            movements.emit('text', {
+                'msg': "Load test message {} {}".format(i, token),
+                'map_id': self.mindset_id,
+                'room_id': self.mindset_id
+            })
+            socket.wait(seconds=self.interval)
+
+        # Wait for outstanding broadcasts
+        deadline = time.time() + 10
+        while len(self.sent) > 0 and time.time() < deadline:
+            socket.wait(seconds=0.5)
+
+        movements.emit('left', {'room_id': self.mindset_id})
+        socket.disconnect()
+
+
+def run(host, port, email, password, mindset_id, clients=1, count=20, interval=0.5):
+    """Run the load generator and return latency statistics"""
+    if SocketIO is None:
+        raise RuntimeError("The chat load generator requires socketIO-client<0.6")
+
+    base_url = "http://{}:{}".format(host, port)
+    cookies = login(base_url, email, password)
+
+    threads = [ChatClient(host, port, cookies, mindset_id, count, interval)
+        for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies = [l for t in threads for l in t.latencies]
+    rv = {
+        "sent": clients * count,
+        "received": len(latencies),
+        "latency_ms": latency_summary(latencies)
+    }
+    return rv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat broadcast load generator")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=24500)
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--mindset", required=True,
+        help="ID of the mindset whose chat receives the messages")
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--count", type=int, default=20,
+        help="Messages sent by each client")
+    parser.add_argument("--interval", type=float, default=0.5,
+        help="Seconds between messages of a client")
+    args = parser.parse_args()
+
+    print json.dumps(run(args.host, args.port, args.email, args.password,
+        args.mindset, args.clients, args.count, args.interval), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.dataset
+    ~~~~~
+
+    Synthetic dataset for benchmarks.
+
+    Creates users with personas, movements with members, and threaded
+    conversations with votes and longform text percepts in the database of the
+    configured app. Thoughts and votes are created through the Nucleus model
+    methods used by the web views, acting as the respective persona.
+
+    All generated users share the password `BENCHMARK_PASSWORD` and have
+    email addresses of the form 'bench-<n>@<EMAIL_DOMAIN>'.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import datetime
+import logging
+import random
+
+from flask.ext.login import login_user, logout_user
+from uuid import uuid4
+
+from nucleus.nucleus import ALLOWED_COLORS
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import Persona, User, Movement, Mindspace, \
+    Blog, Thought
+from glia.keypool import assign_keys
+
+logger = logging.getLogger('benchmarks')
+
+BENCHMARK_PASSWORD = "benchmark"
+EMAIL_DOMAIN = "benchmark.rktik"
+
+WORDS = ("thought mind movement idea network signal question answer story "
+    "city river music code paper garden light window bridge letter map").split()
+
+
+def sentence(rng, length=8):
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize()
+
+
+def create_persona(n, rng):
+    """Create a user with an active persona, mindspace and blog"""
+    created = datetime.datetime.utcnow()
+    persona = Persona(
+        id=uuid4().hex,
+        username="bench{}".format(n),
+        created=created,
+        modified=created,
+        color=rng.choice(ALLOWED_COLORS.keys()))
+    persona.mindspace = Mindspace(id=uuid4().hex, author=persona)
+    persona.blog = Blog(id=uuid4().hex, author=persona)
+
+    user = User(
+        id=uuid4().hex,
+        email="bench-{}@{}".format(n, EMAIL_DOMAIN),
+        active_persona=persona,
+        created=created,
+        modified=created)
+    user.set_password(BENCHMARK_PASSWORD)
+    assign_keys(persona, BENCHMARK_PASSWORD)
+    user.active = True
+    user.validated_on = created
+    persona.user = user
+
+    db.session.add(persona)
+    db.session.add(user)
+    return persona
+
+
+def create_movement(n, admin, rng):
+    """Create a movement administrated by a persona"""
+    created = datetime.datetime.utcnow()
+    movement = Movement(
+        id=uuid4().hex,
+        username="Benchmark Movement {}".format(n),
+        description=sentence(rng, 12),
+        admin=admin,
+        created=created,
+        modified=created,
+        color=rng.choice(ALLOWED_COLORS.keys()),
+        private=False)
+    admin.toggle_movement_membership(movement=movement, role="admin")
+    db.session.add(movement)
+    return movement
+
+
+def post(author, mindset, rng, parent=None, longform=False):
+    """Create a Thought as author"""
+    login_user(author.user)
+    thought_data = Thought.create_from_input(
+        text=sentence(rng),
+        longform="\n\n".join(sentence(rng, 40) for _ in range(3))
+            if longform else None,
+        parent=parent,
+        mindset=mindset)
+    thought = thought_data["instance"]
+    thought.posted_from = "benchmark"
+    db.session.add(thought)
+    db.session.add_all(thought_data["notifications"])
+    return thought
+
+
+def vote(persona, thought):
+    login_user(persona.user)
+    thought.toggle_upvote()
+
+
+def generate(app, personas=50, movements=5, members=20, threads=20, replies=3,
+        depth=3, votes=5, longform_ratio=0.2, seed=0):
+    """Fill the database of app with a synthetic dataset
+
+    Args:
+        app (Flask): App whose database is used
+        personas (int): Number of users, each with one persona
+        movements (int): Number of movements
+        members (int): Members per movement
+        threads (int): Top-level thoughts per movement mindspace and blog
+        replies (int): Replies per thought on each level of a thread
+        depth (int): Levels of replies below top-level thoughts
+        votes (int): Upper bound of votes per thought
+        longform_ratio (float): Share of top-level thoughts with a longform
+            text percept
+        seed (int): Seed for the random number generator
+
+    Returns:
+        dict: Counts of created objects and IDs useful for scenarios
+    """
+    rng = random.Random(seed)
+    rv = {"personas": 0, "movements": 0, "thoughts": 0, "votes": 0,
+        "movement_id": None, "mindset_id": None, "thought_id": None}
+
+    with app.test_request_context('/'):
+        all_personas = [create_persona(n, rng) for n in range(personas)]
+        db.session.commit()
+        rv["personas"] = len(all_personas)
+        rv["email"] = all_personas[0].user.email
+
+        all_movements = []
+        for n in range(movements):
+            admin = rng.choice(all_personas)
+            movement = create_movement(n, admin, rng)
+            member_list = [admin]
+            for member in rng.sample(all_personas, min(members, personas)):
+                if member is not admin:
+                    member.toggle_movement_membership(movement=movement)
+                    member_list.append(member)
+            all_movements.append((movement, member_list))
+        db.session.commit()
+        rv["movements"] = len(all_movements)
+
+        for movement, member_list in all_movements:
+            for mindset in (movement.mindspace, movement.blog):
+                for _ in range(threads):
+                    root = post(rng.choice(member_list), mindset, rng,
+                        longform=rng.random() < longform_ratio)
+                    level = [root]
+                    created = [root]
+                    for _ in range(depth):
+                        level = [post(rng.choice(member_list), mindset, rng,
+                            parent=parent) for parent in level
+                            for _ in range(replies)]
+                        created.extend(level)
+                    db.session.commit()
+
+                    for thought in created:
+                        for voter in rng.sample(member_list,
+                                min(rng.randint(0, votes), len(member_list))):
+                            vote(voter, thought)
+                            rv["votes"] += 1
+                    db.session.commit()
+                    rv["thoughts"] += len(created)
+
+            logger.info("Created conversations in {}".format(movement))
+
+        logout_user()
+        if len(all_movements) > 0:
+            rv["movement_id"] = all_movements[0][0].id
+            rv["mindset_id"] = all_movements[0][0].mindspace.id
+            thought = Thought.query \
+                .filter(Thought.mindset_id == rv["mindset_id"]) \
+                .filter(Thought.parent_id == None) \
+                .first()
+            rv["thought_id"] = thought.id if thought is not None else None
+
+    return rv
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.scenarios
+    ~~~~~
+
+    Request scenarios run against the app with the Flask test client.
+
+    Every scenario is a list of URLs requested in turn, either anonymously or
+    as the first Persona of the synthetic dataset. For each scenario the
+    throughput, latency percentiles and number of database queries per
+    request are reported.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import time
+
+from flask import url_for
+from sqlalchemy import event
+
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import User
+from benchmarks.stats import latency_summary
+
+
+def scenario_urls(dataset):
+    """Return the URLs requested by each scenario
+
+    Args:
+        dataset (dict): Return value of `benchmarks.dataset.generate`
+
+    Returns:
+        dict: Maps scenario names to tuples (logged in, list of URLs)
+    """
+    rv = {
+        "index_anonymous": (False, [url_for("web.index")]),
+        "index": (True, [url_for("web.index")]),
+    }
+
+    if dataset.get("movement_id"):
+        rv["movement_mindspace"] = (True, [url_for("web.movement_mindspace",
+            id=dataset["movement_id"])])
+        rv["movement_blog"] = (True, [url_for("web.movement_blog",
+            id=dataset["movement_id"])])
+
+    if dataset.get("mindset_id"):
+        rv["async_chat"] = (True, [url_for("web.async_chat",
+            mindset_id=dataset["mindset_id"])])
+
+    if dataset.get("thought_id"):
+        rv["thought"] = (True, [url_for("web.thought",
+            id=dataset["thought_id"])])
+        rv["thought_anonymous"] = (False, [url_for("web.thought",
+            id=dataset["thought_id"])])
+
+    return rv
+
+
+class QueryCounter(object):
+    """Counts statements executed by the database engine"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _before_cursor_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, "before_cursor_execute",
+            self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute",
+            self._before_cursor_execute)
+
+
+def login(client, email):
+    """Log in the test client as the User with the given email address"""
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise ValueError("User {} not found".format(email))
+
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.id
+        sess['_fresh'] = True
+
+
+def run_scenario(client, engine, urls, iterations, warmup=1):
+    """Request urls iterations times after warmup unmeasured rounds
+
+    Returns:
+        dict: Request and error counts, throughput, latency statistics and
+            mean number of queries per request
+    """
+    for _ in range(warmup):
+        for url in urls:
+            client.get(url)
+
+    latencies = []
+    queries = []
+    errors = 0
+    started = time.time()
+    for _ in range(iterations):
+        for url in urls:
+            with QueryCounter(engine) as counter:
+                t0 = time.time()
+                rv = client.get(url)
+                latencies.append(time.time() - t0)
+            queries.append(counter.count)
+            if rv.status_code >= 400:
+                errors += 1
+    duration = time.time() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / duration if duration > 0 else None,
+        "latency_ms": latency_summary(latencies),
+        "queries": {
+            "mean": float(sum(queries)) / len(queries) if queries else None,
+            "max": max(queries) if queries else None
+        }
+    }
+
+
+def run(app, dataset, names=None, iterations=20):
+    """Run scenarios against app
+
+    Args:
+        app (Flask): App to test
+        dataset (dict): Return value of `benchmarks.dataset.generate`
+        names (list): Names of scenarios to run, all if None
+        iterations (int): Measured rounds per scenario
+
+    Returns:
+        dict: Maps scenario names to their results
+    """
+    with app.test_request_context('/'):
+        scenarios = scenario_urls(dataset)
+        engine = db.engine
+
+    rv = dict()
+    for name in sorted(scenarios.keys()):
+        if names and name not in names:
+            continue
+
+        logged_in, urls = scenarios[name]
+        client = app.test_client()
+        if logged_in:
+            with app.app_context():
+                login(client, dataset["email"])
+
+        app.logger.info("Running scenario {}".format(name))
+        rv[name] = run_scenario(client, engine, urls, iterations)
+    return rv
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.stats
+    ~~~~~
+
+    Summary statistics shared by all benchmarks.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+
+
+def percentile(values, q):
+    """Return the q-quantile of a list of numbers"""
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def latency_summary(latencies):
+    """Return statistics of a list of latencies given in seconds
+
+    Returns:
+        dict: Mean, median, 95th and 99th percentile and maximum in
+            milliseconds
+    """
+    ms = [l * 1000 for l in latencies]
+    return {
+        "mean": sum(ms) / len(ms) if ms else None,
+        "p50": percentile(ms, 0.5),
+        "p95": percentile(ms, 0.95),
+        "p99": percentile(ms, 0.99),
+        "max": max(ms) if ms else None
+    }
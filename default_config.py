@@ -22,4 +22,107 @@ SESSION_EXPIRATION_TIME = datetime.timedelta(minutes=15)
 
 SEND_FILE_MAX_AGE_DEFAULT = 43200
 
+# Link static bundles built by `python manage.py assets` (see glia.assets).
+# None uses them whenever a build exists, False always links the sources.
+# Bundles have content hashes in their filenames and are cached for
+# ASSETS_MAX_AGE seconds.
+ASSETS_BUNDLED = None
+ASSETS_LESSC = "lessc"
+ASSETS_MAX_AGE = 365 * 24 * 3600
+
 TIMEZONE = 'Europe/Berlin'
+
+# Seconds until the precomputed front page expires. Should be a multiple of the
+# interval of the `build_frontpage_snapshot` job so that a late job run does
+# not leave visitors without a snapshot.
+FRONTPAGE_SNAPSHOT_TIMEOUT = 300
+
+# Thoughts younger than this many days have their stored hotness recomputed by
+# the `decay_hotness` job
+HOTNESS_DECAY_DAYS = 14
+
+# Seconds for which Thought text with rendered mentions is cached. Cached
+# entries are replaced when a Thought is modified.
+MENTIONS_CACHE_TIMEOUT = 3600
+
+# Seconds for which rendered thoughts and chatlines are shared between viewers
+# (see glia.web.fragments). Relative timestamps in cached fragments may be this
+# much out of date.
+FRAGMENT_CACHE_TIMEOUT = 300
+
+# Seconds for which the navigation data of a Persona is cached (see
+# glia.web.viewer). Entries are deleted when memberships change.
+VIEWER_CACHE_TIMEOUT = 60
+
+# Seconds for which the unread notifications of a Persona are cached (see
+# glia.web.readmarks)
+UNREAD_CACHE_TIMEOUT = 300
+
+# Outbound email (see glia.mail). With MAIL_QUEUE enabled, messages are queued
+# in Redis and delivered by the rq worker in batches of MAIL_BATCH_SIZE. At
+# most one delivery job is enqueued per MAIL_FLUSH_INTERVAL seconds, which
+# should match the interval of the periodical `flush_mail` job.
+MAIL_BACKEND = "sendgrid"
+MAIL_QUEUE = True
+MAIL_FLUSH_INTERVAL = 30
+MAIL_BATCH_SIZE = 100
+# Messages the backend rejects are retried by later flushes until they failed
+# this many times
+MAIL_MAX_ATTEMPTS = 3
+MAIL_SMTP_HOST = "localhost"
+MAIL_SMTP_PORT = 25
+MAIL_FILE_PATH = "./mail_outbox.jsonl"
+
+# Let greenlets of the gevent server run while waiting for PostgreSQL (see
+# glia.cooperative). None enables this whenever gevent monkey patching is
+# active. DATABASE_POOL_SIZE connections are shared by all greenlets.
+GEVENT_DATABASE = None
+DATABASE_POOL_SIZE = 20
+DATABASE_POOL_TIMEOUT = 10
+
+# Send SELECT statements of read-only views to this database replica (see
+# glia.replica). Users read from the primary for REPLICA_STICKY_SECONDS after
+# their own writes.
+SQLALCHEMY_REPLICA_URI = None
+REPLICA_STICKY_SECONDS = 10
+
+# Deliver Socket.IO events to clients of all server processes through Redis
+# ("redis") or only to those of the emitting process ("local"). See glia.bus.
+SOCKETIO_BACKEND = "redis"
+
+# Record votes in Redis and write them to the database in batches (see
+# glia.votes). Voter sets of Thoughts expire after VOTE_CACHE_TIMEOUT seconds
+# without votes. Vote counts are broadcast at most every
+# VOTE_BROADCAST_INTERVAL seconds per Thought.
+VOTE_ENGINE = True
+VOTE_CACHE_TIMEOUT = 24 * 3600
+VOTE_BROADCAST_INTERVAL = 1.0
+
+# Extract percepts from longform text and from short texts containing links in
+# the rq worker instead of the request (see glia.attachments). Extraction results are cached for
+# EXTRACTION_CACHE_TIMEOUT seconds.
+ASYNC_ATTACHMENTS = True
+EXTRACTION_CACHE_TIMEOUT = 24 * 3600
+
+# Pregenerated keypairs for new Personas (see glia.keypool). A refill is
+# scheduled whenever fewer than KEYPOOL_MIN_SIZE keysets remain.
+KEYPOOL = True
+KEYPOOL_SIZE = 50
+KEYPOOL_MIN_SIZE = 10
+KEYPOOL_REFILL_TIMEOUT = 600
+
+# Request and Socket.IO event metrics (see glia.instrumentation), aggregated in
+# windows of INSTRUMENTATION_WINDOW seconds of which the last
+# INSTRUMENTATION_RETENTION are kept. Recording costs a Redis pipeline of up
+# to ten commands per request, so it is off unless enabled.
+INSTRUMENTATION = False
+INSTRUMENTATION_WINDOW = 60
+INSTRUMENTATION_RETENTION = 60
+
+# Requests taking longer than this many seconds are logged with their SQL
+# statements. Set to None to disable.
+SLOW_REQUEST_THRESHOLD = None
+SLOW_REQUEST_SAMPLES = 50
+
+# Seconds after their last heartbeat until chat members are considered offline
+PRESENCE_TIMEOUT = 150
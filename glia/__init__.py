@@ -14,7 +14,7 @@ from blinker import Namespace
 from flask import Flask
 from flask.ext.compress import Compress
 from flask.ext.socketio import SocketIO
-from flask.ext.login import LoginManager, current_user
+from flask.ext.login import LoginManager
 from flask.ext.misaka import Misaka
 from flask.ext.rq import RQ
 from flask_debugtoolbar import DebugToolbarExtension
@@ -26,6 +26,9 @@ from .helpers import setup_loggers, ProxiedRequest, AnonymousPersona
 from nucleus.nucleus.connections import db, cache
 from nucleus.nucleus.models import Persona
 from glia.helpers import inject_mentions, gallery_col_width, sort_hot
+from glia import hotness  # registers the stored Thought._hot column
+from glia import percepts  # registers the stored Percept.content_digest column
+from glia import assets, cooperative, instrumentation, replica
 from worker import scheduler
 
 socketio = SocketIO()
@@ -50,6 +53,8 @@ def create_app(log_info=True):
     app.request_class = ProxiedRequest
 
     # Setup SQLAlchemy database
+    cooperative.init_app(app)
+    replica.init_app(app)
     db.init_app(app)
     with app.app_context():
         if not db.engine.dialect.has_table(db.engine.connect(), "persona"):
@@ -71,6 +76,9 @@ def create_app(log_info=True):
         cache_config['CACHE_MEMCACHED_PASSWORD'] = os.getenv('MEMCACHIER_PASSWORD')
     cache.init_app(app, config=cache_config)
 
+    # Setup request metrics
+    instrumentation.init_app(app, cache)
+
     # Setup login manager
     login_manager.init_app(app)
     login_manager.anonymous_user = AnonymousPersona
@@ -85,8 +93,9 @@ def create_app(log_info=True):
     @app.context_processor
     def persona_context():
         """Makes active persona available in templates"""
+        from glia.web.viewer import get_viewer
         return dict(
-            active_persona=current_user.active_persona
+            active_persona=get_viewer().persona
         )
 
     # Setup markdown support for templates
@@ -95,6 +104,11 @@ def create_app(log_info=True):
     # Setup time filter
     # - Import here to avoid circular import
     from web.helpers import localtime, authorize_filter
+    from web.preload import upvoted_filter, upvote_count_filter, \
+        comment_count_filter
+    from web.threads import replies_filter
+    from web.readmarks import unread_notifications
+    from web.fragments import render_thought, upvoted_ids
     app.jinja_env.filters['naturaltime'] = naturaltime
     app.jinja_env.filters['naturaldelta'] = naturaldelta
     app.jinja_env.filters['localtime'] = lambda value: localtime(value, tzval=app.config["TIMEZONE"]) if value is not None else None
@@ -104,6 +118,13 @@ def create_app(log_info=True):
     app.jinja_env.filters['gallery_col_width'] = gallery_col_width
     app.jinja_env.filters['sort_hot'] = sort_hot
     app.jinja_env.filters['authorize'] = authorize_filter
+    app.jinja_env.filters['upvoted'] = upvoted_filter
+    app.jinja_env.filters['upvote_count'] = upvote_count_filter
+    app.jinja_env.filters['comment_count'] = comment_count_filter
+    app.jinja_env.filters['replies'] = replies_filter
+    app.jinja_env.filters['unread_notifications'] = unread_notifications
+    app.jinja_env.globals['thought_fragment'] = render_thought
+    app.jinja_env.globals['upvoted_ids'] = upvoted_ids
     app.jinja_env.add_extension('jinja2.ext.do')
 
     # Setup debug toolbar
@@ -113,6 +134,13 @@ def create_app(log_info=True):
     # Setup Gzip compression
     compress.init_app(app)
 
+    # Setup static bundles, served precompressed when built
+    assets.init_app(app)
+
+    # Setup deferred processing of attachments
+    from glia import attachments
+    attachments.init_app(app)
+
     from glia.web import app as web_blueprint
     app.register_blueprint(web_blueprint)
 
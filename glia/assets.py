@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.assets
+    ~~~~~
+
+    Static asset bundles.
+
+    `python manage.py assets` compiles LESS sources with `lessc`, concatenates
+    and minifies the sources of each bundle in `BUNDLES` and writes the result
+    to `static/dist` under a name containing a hash of its content. A gzipped
+    copy is written next to each bundle and a manifest maps bundle names to
+    the current files.
+
+    Templates link bundles with the `asset_urls` global. When a manifest is
+    present, bundles are served from `static/dist` with far-future cache
+    headers and their precompressed variant, so that Flask-Compress doesn't
+    gzip them on every request. Without a manifest the sources are linked
+    individually, with LESS compiled in the browser in debug mode.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import subprocess
+
+from collections import OrderedDict
+from cStringIO import StringIO
+from flask import current_app, request, send_from_directory, url_for
+from flask.helpers import safe_join
+
+logger = logging.getLogger('web')
+
+# Build output relative to the static folder. Kept one level deep like the
+# source directories so that relative URLs in stylesheets stay valid.
+DIST_DIR = "dist"
+MANIFEST_FILE = "dist/manifest.json"
+
+# Bundle names mapped to their sources, relative to the static folder
+BUNDLES = OrderedDict([
+    ("vendor.css", ["css/bootstrap.css", "css/font-awesome.min.css"]),
+    ("glia.css", ["css/pnotify.custom.min.css", "css/lightbox.css",
+        "less/main.less"]),
+    ("spectrum.css", ["css/spectrum.css"]),
+    ("vendor.js", ["js/jquery.min.js", "js/bootstrap.min.js",
+        "js/socket.io.min.js"]),
+    ("glia.js", ["js/pnotify.custom.min.js", "js/jquery.simplyCountable.js",
+        "js/lightbox.js", "js/main.js"]),
+    ("graph.js", ["js/graph.js"]),
+    ("spectrum.js", ["js/spectrum.js"]),
+])
+
+
+def compile_less(path, lessc="lessc"):
+    """Return the CSS compiled from a LESS file"""
+    return subprocess.check_output([lessc, path])
+
+
+def minify(content, kind):
+    """Minify CSS or JS source
+
+    Args:
+        content (String): Source code
+        kind (String): Either ".css" or ".js"
+    """
+    if kind == ".css":
+        from rcssmin import cssmin
+        return cssmin(content)
+    else:
+        from rjsmin import jsmin
+        return jsmin(content)
+
+
+def gzip_content(content):
+    """Return content gzipped at the highest level
+
+    The modification time is left out of the header to give the same output
+    for the same content.
+    """
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def build_bundle(app, name, minified=True):
+    """Return the content of a bundle
+
+    Args:
+        app (Flask): Glia app
+        name (String): Key of BUNDLES
+        minified (Boolean): Minify the concatenated sources
+    """
+    kind = os.path.splitext(name)[1]
+    parts = []
+    for source in BUNDLES[name]:
+        path = os.path.join(app.static_folder, source)
+        if source.endswith(".less"):
+            parts.append(compile_less(path, app.config["ASSETS_LESSC"]))
+        else:
+            with open(path, "rb") as f:
+                parts.append(f.read())
+
+    # Scripts are separated by semicolons in case one lacks its final one
+    content = (";\n" if kind == ".js" else "\n").join(parts)
+    return minify(content, kind) if minified else content
+
+
+def build(app, minified=True):
+    """Write all bundles, their gzipped variants and the manifest
+
+    Files of previous builds are removed.
+
+    Args:
+        app (Flask): Glia app
+        minified (Boolean): Minify bundles
+
+    Returns:
+        dict: The manifest, mapping bundle names to their file in the static
+            folder
+    """
+    dist = os.path.join(app.static_folder, DIST_DIR)
+    if not os.path.isdir(dist):
+        os.makedirs(dist)
+
+    manifest = OrderedDict()
+    for name in BUNDLES:
+        content = build_bundle(app, name, minified=minified)
+
+        base, kind = os.path.splitext(name)
+        filename = "{}/{}-{}{}".format(DIST_DIR, base,
+            hashlib.sha1(content).hexdigest()[:12], kind)
+
+        with open(os.path.join(app.static_folder, filename), "wb") as f:
+            f.write(content)
+        with open(os.path.join(app.static_folder, filename + ".gz"), "wb") as f:
+            f.write(gzip_content(content))
+        manifest[name] = filename
+
+    current = set([os.path.basename(fn) for fn in manifest.values()])
+    current.update([fn + ".gz" for fn in current])
+    current.add(os.path.basename(MANIFEST_FILE))
+    for fn in os.listdir(dist):
+        if fn not in current:
+            os.remove(os.path.join(dist, fn))
+
+    with open(os.path.join(app.static_folder, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def load_manifest(app):
+    """Return the manifest of the last build or None if there is none"""
+    path = os.path.join(app.static_folder, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def asset_urls(name):
+    """Return URLs to include for a bundle
+
+    Args:
+        name (String): Key of BUNDLES
+
+    Returns:
+        list: URL of the built bundle or, without a build, URLs of its
+            sources. Outside of debug mode LESS sources are replaced by the
+            CSS file of the same name in `css/`.
+    """
+    manifest = current_app.extensions["glia_assets"]
+    if manifest is not None:
+        return [url_for("static", filename=manifest[name])]
+
+    rv = []
+    for source in BUNDLES[name]:
+        if source.endswith(".less") and not current_app.config["DEBUG"]:
+            source = "css/{}.css".format(
+                os.path.splitext(os.path.basename(source))[0])
+        rv.append(url_for("static", filename=source))
+    return rv
+
+
+def assets_built():
+    return current_app.extensions["glia_assets"] is not None
+
+
+def send_static_file(filename):
+    """Serve static files, with precompressed bundles from the build folder"""
+    if not filename.startswith(DIST_DIR + "/"):
+        return current_app.send_static_file(filename)
+
+    static = current_app.static_folder
+    options = {
+        "mimetype": mimetypes.guess_type(filename)[0],
+        "cache_timeout": current_app.config["ASSETS_MAX_AGE"]
+    }
+
+    gzipped = filename + ".gz"
+    if "gzip" in request.headers.get("Accept-Encoding", "").lower() \
+            and os.path.isfile(safe_join(static, gzipped)):
+        rv = send_from_directory(static, gzipped, **options)
+        rv.headers["Content-Encoding"] = "gzip"
+    else:
+        rv = send_from_directory(static, filename, **options)
+
+    rv.vary.add("Accept-Encoding")
+    return rv
+
+
+def init_app(app):
+    """Load the manifest and serve precompressed bundles
+
+    `ASSETS_BUNDLED` set to False links the sources even if a build exists,
+    for example while working on stylesheets.
+    """
+    manifest = None
+    if app.config["ASSETS_BUNDLED"] is not False:
+        manifest = load_manifest(app)
+
+    if manifest is None and app.config["ASSETS_BUNDLED"]:
+        logger.warning("No asset manifest found, run `python manage.py "
+            "assets` to build static bundles")
+
+    app.extensions["glia_assets"] = manifest
+    app.jinja_env.globals['asset_urls'] = asset_urls
+    app.jinja_env.globals['assets_built'] = assets_built
+
+    if app.has_static_folder:
+        app.view_functions["static"] = send_static_file
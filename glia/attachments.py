@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.attachments
+    ~~~~~
+
+    Deferred processing of longform text attached to Thoughts.
+
+    Extracting links, pictures, mentions and tags from longform text may fetch
+    remote sites. Instead of doing this while handling the request, the raw
+    text is attached as a placeholder TextPercept and a `process_longform`
+    job is enqueued once the Thought is committed. The job replaces the
+    placeholder with the processed text, attaches the extracted percepts and
+    sends the rendered percepts to the chat with a `status` event.
+
+    Links in the short text of a Thought are deferred the same way. While
+    `create_from_input` creates a Thought whose text contains a link, Nucleus'
+    `process_attachments`, replaced by `init_app`, returns the text unchanged
+    and a `process_text` job attaches the extracted percepts later. Mentions found by either job
+    create MentionNotifications.
+
+    Extraction results are cached by a hash of the longform text, so that
+    reposting the same text attaches the existing percepts right away.
+
+    `sync_attachments` replaces the attachments of a Thought with a given set
+    of Percepts using bulk statements, e.g. when a Thought is edited.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import datetime
+import logging
+import re
+
+from collections import OrderedDict
+from flask import current_app, g, get_template_attribute, has_app_context, \
+    url_for
+from flask.ext.rq import get_queue
+from hashlib import sha1
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from nucleus.nucleus import helpers as nucleus_helpers, \
+    models as nucleus_models
+from nucleus.nucleus.connections import db, cache
+from nucleus.nucleus.helpers import process_attachments
+from nucleus.nucleus.models import Thought, Percept, PerceptAssociation, \
+    TextPercept, Mention, MentionNotification
+from glia import bus
+from glia.percepts import get_or_create
+
+logger = logging.getLogger('web')
+
+EXTRACTION_CACHE_KEY = "attachments-{}"
+
+# Session.info key for jobs that are enqueued once the session is committed
+JOBS_INFO_KEY = "glia_attachment_jobs"
+
+# Short texts matching this are processed by a job, as links may be fetched
+LINK_PATTERN = re.compile(r"(https?://|www\.)\S", re.IGNORECASE)
+
+
+def _deferrable_process_attachments(text, *args, **kwargs):
+    """Nucleus' `process_attachments`, skipped inside `create_from_input`"""
+    if has_app_context() and getattr(g, "deferred_texts", None) is not None:
+        g.deferred_texts.append(text)
+        return text, set()
+    return process_attachments(text, *args, **kwargs)
+
+
+def init_app(app):
+    """Let `create_from_input` skip Nucleus' `process_attachments`
+
+    `Thought.create_from_input` calls `process_attachments` from the Nucleus
+    modules, so it is replaced there. If Nucleus no longer exposes it there,
+    links in short texts are processed in the request again.
+    """
+    patched = False
+    for module in (nucleus_helpers, nucleus_models):
+        current = getattr(module, "process_attachments", None)
+        if current is process_attachments:
+            module.process_attachments = _deferrable_process_attachments
+        patched = patched or current in (process_attachments,
+            _deferrable_process_attachments)
+
+    if not patched:
+        logger.warning("Can't defer processing of links in short texts, "
+            "process_attachments not found in Nucleus")
+    app.extensions["glia_attachments"] = {"deferrable": patched}
+
+
+def longform_hash(longform):
+    return sha1(longform.encode('utf-8')).hexdigest()
+
+
+def cached_extraction(longform):
+    """Return the cached extraction result of a longform text
+
+    Returns:
+        tuple: Processed text and list of Percept IDs, or None
+    """
+    return cache.get(EXTRACTION_CACHE_KEY.format(longform_hash(longform)))
+
+
+def _attach(thought, percepts, author):
+    """Attach Percepts that aren't attached yet
+
+    Returns:
+        list: Newly attached Percepts
+    """
+    existing = set([pa.percept_id for pa in thought.percept_assocs])
+    rv = []
+    for p in percepts:
+        if p.id not in existing:
+            db.session.add(PerceptAssociation(thought=thought, percept=p,
+                author=author))
+            existing.add(p.id)
+            rv.append(p)
+    return rv
+
+
+def _enqueue(job_name, *args):
+    """Enqueue a job from `glia.jobs` once the session is committed"""
+    db.session.info.setdefault(JOBS_INFO_KEY, []).append((job_name, args))
+
+
+def create_from_input(**kwargs):
+    """Create a Thought with Nucleus, deferring links in its text to a job
+
+    Takes the arguments of `Thought.create_from_input`. If the text contains
+    a link and `ASYNC_ATTACHMENTS` is enabled, the Thought is created without
+    percepts from its text and a `process_text` job attaches them once the
+    session is committed.
+
+    Returns:
+        dict: The Thought and notifications, as returned by Nucleus
+    """
+    text = kwargs.get("text")
+    if not current_app.config["ASYNC_ATTACHMENTS"] or not text \
+            or LINK_PATTERN.search(text) is None \
+            or not current_app.extensions["glia_attachments"]["deferrable"]:
+        return Thought.create_from_input(**kwargs)
+
+    g.deferred_texts = []
+    try:
+        thought_data = Thought.create_from_input(**kwargs)
+    finally:
+        deferred = g.deferred_texts
+        g.deferred_texts = None
+
+    thought = thought_data["instance"]
+    for deferred_text in deferred:
+        _enqueue("process_text", thought.id, deferred_text)
+    return thought_data
+
+
+def attached_percepts(thought):
+    """Return the Percepts attached to a Thought, loaded with one query
+
+    Returns:
+        OrderedDict: Maps Percept IDs to Percepts
+    """
+    return OrderedDict([(p.id, p) for p in Percept.query
+        .join(PerceptAssociation, PerceptAssociation.percept_id == Percept.id)
+        .filter(PerceptAssociation.thought_id == thought.id)])
+
+
+def sync_attachments(thought, percepts, author, existing=None):
+    """Make a set of Percepts the attachments of a Thought
+
+    Inserts and deletes are computed in memory and applied with at most one
+    statement each.
+
+    Args:
+        thought (Thought): Thought whose attachments are replaced
+        percepts (iterable): Percepts the Thought should have attached
+        author (Persona): Author of new attachments
+        existing (iterable): IDs of Percepts currently attached, if they
+            have been loaded before
+
+    Returns:
+        tuple: Sets of added and removed Percept IDs
+    """
+    if existing is None:
+        existing = [pid for (pid, ) in db.session.query(
+            PerceptAssociation.percept_id).filter_by(thought_id=thought.id)]
+    existing = set(existing)
+    desired = set([p.id for p in percepts])
+
+    added = desired - existing
+    removed = existing - desired
+    pa_table = PerceptAssociation.__table__
+
+    if len(removed) > 0:
+        db.session.execute(pa_table.delete()
+            .where(pa_table.c.thought_id == thought.id)
+            .where(pa_table.c.percept_id.in_(removed)))
+
+    if len(added) > 0:
+        # New Percepts need to be inserted before they can be referenced
+        db.session.flush()
+        db.session.execute(pa_table.insert(), [{
+            "thought_id": thought.id,
+            "percept_id": pid,
+            "author_id": author.id
+        } for pid in added])
+
+    if len(added) > 0 or len(removed) > 0:
+        # Changes the fragment cache keys of the Thought
+        thought.modified = datetime.datetime.utcnow()
+        db.session.add(thought)
+
+    return added, removed
+
+
+def attach_longform(thought, longform, source=None, author=None):
+    """Attach longform text to a Thought, deferring extraction to a job
+
+    If the text was processed before, the cached percepts are attached right
+    away. Otherwise the raw text is attached as a placeholder and a
+    `process_longform` job is enqueued when the session is committed. With
+    `ASYNC_ATTACHMENTS` disabled the text is processed in place.
+
+    Args:
+        thought (Thought): Thought that receives the attachments
+        longform (String): Longform text
+        source (String): Source of the longform text
+        author (Persona): Author of the attachments, defaults to the
+            Thought's author
+
+    Returns:
+        TextPercept: Percept holding the (placeholder) text
+    """
+    author = author or thought.author
+
+    cached = cached_extraction(longform)
+    if cached is not None:
+        lftext, percept_ids = cached
+        percepts = Percept.query.filter(Percept.id.in_(percept_ids)).all() \
+            if len(percept_ids) > 0 else []
+        if len(percepts) == len(percept_ids):
+            text_percept = get_or_create(TextPercept, lftext, source=source)
+            _attach(thought, percepts + [text_percept], author)
+            return text_percept
+
+    if not current_app.config["ASYNC_ATTACHMENTS"]:
+        lftext, percepts = extract(longform)
+        text_percept = get_or_create(TextPercept, lftext, source=source)
+        _attach(thought, list(percepts) + [text_percept], author)
+        return text_percept
+
+    placeholder = get_or_create(TextPercept, longform, source=source)
+    _attach(thought, [placeholder], author)
+
+    _enqueue("process_longform", thought.id, placeholder.id, longform, source)
+    return placeholder
+
+
+def extract(longform):
+    """Extract percepts from longform text and cache the result
+
+    Returns:
+        tuple: Processed text and set of Percepts
+    """
+    lftext, percepts = process_attachments(longform)
+    db.session.add_all(percepts)
+    db.session.flush()
+
+    cache.set(EXTRACTION_CACHE_KEY.format(longform_hash(longform)),
+        (lftext, [p.id for p in percepts]),
+        timeout=current_app.config["EXTRACTION_CACHE_TIMEOUT"])
+    return lftext, percepts
+
+
+def mention_notifications(thought, percepts):
+    """Create notifications for the Mentions among newly attached Percepts
+
+    Returns:
+        list: MentionNotifications added to the session
+    """
+    rv = []
+    url = url_for('web.thought', id=thought.id)
+    for percept in percepts:
+        if isinstance(percept, Mention):
+            notification = MentionNotification(percept, thought.author, url)
+            db.session.add(notification)
+            rv.append(notification)
+    return rv
+
+
+def _finish_processing(thought, attached, message):
+    """Commit processed attachments and notify mentions and the chat"""
+    from glia.web.helpers import dispatch_notifications
+
+    notifications = mention_notifications(thought, attached)
+
+    # Changes the fragment cache keys of the Thought
+    thought.modified = datetime.datetime.utcnow()
+    db.session.add(thought)
+    db.session.commit()
+
+    dispatch_notifications(notifications)
+
+    render = get_template_attribute('macros/chat.html', 'chat_percepts')
+    bus.emit('status', {
+        'msg': message.format(thought.author.username),
+        'thought_id': thought.id,
+        'html': unicode(render(thought))
+    }, room=thought.mindset_id)
+
+
+def process_longform(thought_id, placeholder_id, longform, source=None):
+    """Replace a placeholder percept with the processed longform text
+
+    The placeholder TextPercept is deleted if no other Thought uses it.
+
+    Args:
+        thought_id (String): ID of the Thought
+        placeholder_id (String): ID of the placeholder TextPercept
+        longform (String): Longform text
+        source (String): Source of the longform text
+
+    Returns:
+        Boolean: True if attachments were changed
+    """
+    thought = Thought.query.get(thought_id)
+    placeholder_pa = PerceptAssociation.query \
+        .filter_by(thought_id=thought_id) \
+        .filter_by(percept_id=placeholder_id) \
+        .first() if thought is not None else None
+
+    if placeholder_pa is None:
+        logger.info("Attachments of <Thought {}> were removed before "
+            "processing".format(thought_id))
+        return False
+
+    author = placeholder_pa.author or thought.author
+    lftext, percepts = extract(longform)
+    text_percept = get_or_create(TextPercept, lftext, source=source)
+    if text_percept.id != placeholder_id:
+        db.session.delete(placeholder_pa)
+        db.session.flush()
+        if PerceptAssociation.query \
+                .filter_by(percept_id=placeholder_id).count() == 0:
+            db.session.delete(TextPercept.query.get(placeholder_id))
+    attached = _attach(thought, [text_percept] + list(percepts), author)
+
+    _finish_processing(thought, attached,
+        "Attachments of {}'s post are ready")
+    return True
+
+
+def process_text(thought_id, text):
+    """Attach the percepts extracted from the short text of a Thought
+
+    Args:
+        thought_id (String): ID of the Thought
+        text (String): Text as passed to `process_attachments`
+
+    Returns:
+        Boolean: True if attachments were changed
+    """
+    thought = Thought.query.get(thought_id)
+    if thought is None:
+        logger.info("<Thought {}> was removed before processing".format(
+            thought_id))
+        return False
+
+    processed, percepts = extract(text)
+    attached = _attach(thought, percepts, thought.author)
+
+    # Keep edits made in the meantime
+    if thought.text == text:
+        thought.text = processed
+
+    _finish_processing(thought, attached, "Links in {}'s post are ready")
+    return True
+
+
+@event.listens_for(Session, "after_commit")
+def enqueue_attachment_jobs(session):
+    """Enqueue processing of placeholders once their Thoughts are committed"""
+    pending = session.info.pop(JOBS_INFO_KEY, None)
+    if pending:
+        from glia import jobs
+        queue = get_queue()
+        for job_name, args in pending:
+            queue.enqueue(getattr(jobs, job_name), *args)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_attachment_jobs(session, previous_transaction):
+    session.info.pop(JOBS_INFO_KEY, None)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.bus
+    ~~~~~
+
+    Socket.IO events for clients connected to any server process.
+
+    `socketio.emit` only reaches clients connected to the process it is called
+    in. Events sent with `emit` from this module are published on a Redis
+    channel instead, to which every server process subscribes with `listen`.
+    Each process then delivers the event to its own clients in the given room.
+    This also lets rq jobs send events to browsers.
+
+    The backend is selected with `SOCKETIO_BACKEND`: "redis" publishes events,
+    "local" emits them in the current process, which is enough when running a
+    single server process.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import json
+import logging
+import time
+
+from flask import current_app
+from flask.ext.rq import get_connection
+from redis.exceptions import ConnectionError
+
+logger = logging.getLogger('web')
+
+CHANNEL = "glia:socketio"
+
+# Seconds to wait before subscribing again after losing the Redis connection
+RECONNECT_DELAY = 5
+
+
+def emit(event, data, room=None, namespace="/movements"):
+    """Send a Socket.IO event to clients of all server processes
+
+    Args:
+        event (String): Name of the event
+        data (dict): JSON serializable payload
+        room (String): Only send to clients in this room
+        namespace (String): Socket.IO namespace
+    """
+    if current_app.config["SOCKETIO_BACKEND"] == "redis":
+        get_connection().publish(CHANNEL, json.dumps({
+            "event": event,
+            "data": data,
+            "room": room,
+            "namespace": namespace
+        }))
+    else:
+        emit_local(event, data, room, namespace)
+
+
+def emit_local(event, data, room=None, namespace="/movements"):
+    """Send a Socket.IO event to clients of this process"""
+    from glia import socketio
+
+    # Broadcasting to all clients needs the server, rooms are kept by socketio
+    if room is None and getattr(socketio, "server", None) is None:
+        logger.warning("No Socket.IO server in this process, dropped '{}' "
+            "event".format(event))
+        return
+
+    socketio.emit(event, data, room=room, namespace=namespace)
+
+
+def listen(app):
+    """Deliver events published by any process to clients of this process
+
+    Blocks forever, run it in its own greenlet of every server process.
+    """
+    while True:
+        try:
+            with app.app_context():
+                pubsub = get_connection().pubsub()
+            pubsub.subscribe(CHANNEL)
+
+            for item in pubsub.listen():
+                if item["type"] != "message":
+                    continue
+
+                try:
+                    message = json.loads(item["data"])
+                except ValueError:
+                    logger.warning("Invalid message on {}: {}".format(
+                        CHANNEL, item["data"]))
+                    continue
+
+                # A failing message must not stop delivery of later ones
+                try:
+                    with app.app_context():
+                        emit_local(message["event"], message["data"],
+                            room=message.get("room"),
+                            namespace=message.get("namespace"))
+                except Exception:
+                    logger.exception("Error delivering message on {}: "
+                        "{}".format(CHANNEL, item["data"]))
+        except ConnectionError, e:
+            logger.error("Lost connection to the Socket.IO bus ({}), "
+                "reconnecting".format(e))
+            time.sleep(RECONNECT_DELAY)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.cooperative
+    ~~~~~
+
+    Cooperative PostgreSQL access for the gevent server.
+
+    `gevent.monkey.patch_all` doesn't reach the sockets used by libpq, so a
+    query would block every greenlet of the server until it returns. Setting
+    a psycopg2 wait callback makes psycopg2 run connections in asynchronous
+    mode and yield to the gevent hub whenever libpq waits for the database.
+
+    Since many greenlets now hold database connections at the same time, the
+    SQLAlchemy connection pool is sized with `DATABASE_POOL_SIZE`. With the
+    threading module patched by gevent, the pool and the scoped session are
+    greenlet-aware.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+import socket
+
+logger = logging.getLogger('web')
+
+
+def gevent_patched():
+    """Return True if gevent monkey patching is active in this process"""
+    try:
+        from gevent import socket as gevent_socket
+    except ImportError:
+        return False
+    return socket.socket is gevent_socket.socket
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """Wait for a psycopg2 connection, letting other greenlets run meanwhile"""
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError("Bad result from poll: {}".format(state))
+
+
+def init_app(app):
+    """Enable cooperative database access if the app runs on gevent
+
+    Must be called before the database engine is created. `GEVENT_DATABASE`
+    set to True or False overrides detecting the gevent server.
+    """
+    enabled = app.config["GEVENT_DATABASE"]
+    if enabled is None:
+        enabled = gevent_patched()
+
+    if not enabled or \
+            not app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres"):
+        return
+
+    from psycopg2 import extensions
+    extensions.set_wait_callback(gevent_wait_callback)
+
+    app.config["SQLALCHEMY_POOL_SIZE"] = app.config["DATABASE_POOL_SIZE"]
+    app.config["SQLALCHEMY_POOL_TIMEOUT"] = app.config["DATABASE_POOL_TIMEOUT"]
+    logger.info("Using cooperative psycopg2 connections, pool size {}".format(
+        app.config["DATABASE_POOL_SIZE"]))
@@ -3,7 +3,8 @@ import sys
 
 from colorlog import ColoredFormatter
 from flask import Request, session
-from jinja2 import Environment, PackageLoader, Markup, evalcontextfilter
+from hashlib import sha1
+from jinja2 import Markup, evalcontextfilter
 
 formatter = ColoredFormatter(
     "%(log_color)s%(name)s :: %(module)s [%(filename)s:%(lineno)d]%(reset)s %(message)s",
@@ -92,31 +93,54 @@ class ProxiedRequest(Request):
 # app.request_class = ProxiedRequest
 
 
+def mentions_cache_key(text, thought, nolink):
+    """Return the cache key for a Thought's text with rendered mentions
+
+    The key changes whenever the Thought is modified. A digest of the input
+    text is included because the filter is applied to both raw and markdown
+    rendered text."""
+    digest = sha1(text.encode('utf-8')).hexdigest()
+    modified = thought.modified.isoformat() if thought.modified else ""
+    return "mentions-{}-{}-{}-{}".format(
+        thought.id, modified, int(bool(nolink)), digest)
+
+
 @evalcontextfilter
 def inject_mentions(eval_ctx, text, thought, nolink=False):
     """Replace portions of Thought text with a link to the mentioned Identity for
-    every mention registered on the Thought"""
+    every mention registered on the Thought
 
-    from flask import url_for
-    env = Environment(loader=PackageLoader('glia', 'templates'))
-    env.globals['url_for'] = url_for
-    template = env.get_template('macros/identity.html')
-    mentions = [pa.percept for pa in thought.percept_assocs if pa.percept.kind == "mention"]
+    Rendered results are cached per Thought version (see `mentions_cache_key`)
+    and links are rendered with the app's own compiled identity macros."""
+    from flask import current_app
+    from nucleus.nucleus.connections import cache
 
-    for mention in mentions:
-        if mention.identity.kind == "persona":
-            rendered_link = template.module.persona(mention.identity, nolink=nolink)
-        else:
-            rendered_link = template.module.movement(mention.identity, nolink=nolink)
+    key = mentions_cache_key(text, thought, nolink)
+    rv = cache.get(key)
+
+    if rv is None:
+        identity_macros = current_app.jinja_env \
+            .get_template('macros/identity.html').module
+        mentions = [pa.percept for pa in thought.percept_assocs if pa.percept.kind == "mention"]
 
-        if eval_ctx.autoescape:
-            rendered_link = Markup(rendered_link)
-        text = text.replace("".join(["@", mention.text]), rendered_link)
+        rv = text
+        for mention in mentions:
+            if mention.identity.kind == "persona":
+                rendered_link = identity_macros.persona(mention.identity, nolink=nolink)
+            else:
+                rendered_link = identity_macros.movement(mention.identity, nolink=nolink)
+
+            if eval_ctx.autoescape:
+                rendered_link = Markup(rendered_link)
+            rv = rv.replace("".join(["@", mention.text]), rendered_link)
+
+        rv = unicode(rv)
+        cache.set(key, rv, timeout=current_app.config["MENTIONS_CACHE_TIMEOUT"])
 
     if eval_ctx.autoescape:
-        text = Markup(text)
+        rv = Markup(rv)
 
-    return text
+    return rv
 
 
 def gallery_col_width(pa_list):
@@ -129,6 +153,10 @@ def gallery_col_width(pa_list):
 
 
 def sort_hot(query):
-    """Sort thoughts by their hotness"""
+    """Sort thoughts by their stored hotness score (see `glia.hotness`)"""
+    from sqlalchemy.orm import Query
     from nucleus.nucleus.models import Thought
-    return sorted(query, key=Thought.hot, reverse=True)
+
+    if isinstance(query, Query):
+        return query.order_by(Thought._hot.desc())
+    return sorted(query, key=lambda t: t._hot or 0.0, reverse=True)
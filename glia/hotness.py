@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.hotness
+    ~~~~~
+
+    Stored hotness score for Thoughts.
+
+    `Thought.hot()` from Nucleus remains the formula, but its result is kept in
+    the indexed `thought._hot` column so that rankings can be answered by the
+    database with `ORDER BY _hot DESC LIMIT n`. The score is recomputed whenever
+    a flush changes a Thought's vote or comment count, and the scores of recent
+    Thoughts are recomputed in bulk by the periodical `decay_hotness` job.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import event, inspect, bindparam, or_
+from sqlalchemy.orm import Session
+
+from nucleus.nucleus import ExecutionTimer
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import Thought
+
+logger = logging.getLogger('web')
+
+# Added by migration 4b2a7c1e9d30
+Thought._hot = db.Column(db.Float, default=0.0, index=True)
+
+# Changes to these attributes trigger recomputing the hotness score
+HOTNESS_ATTRIBUTES = ("_upvotes", "_comment_count")
+
+
+@event.listens_for(Session, "before_flush")
+def update_hotness(session, flush_context, instances):
+    """Recompute the stored score of Thoughts whose votes or comments changed"""
+    for obj in session.new | session.dirty:
+        if not isinstance(obj, Thought) or obj.kind != "thought":
+            continue
+
+        state = inspect(obj)
+        if state.pending or any(state.attrs[attr].history.has_changes()
+                for attr in HOTNESS_ATTRIBUTES):
+            obj._hot = obj.hot()
+
+
+def decay_hotness():
+    """Recompute the stored score of all recent Thoughts
+
+    Thoughts older than `HOTNESS_DECAY_DAYS` keep their last score, which is
+    still updated when their votes or comments change, so that rankings of
+    old Thoughts stay ordered.
+    """
+    timer = ExecutionTimer()
+    thought_table = Thought.__table__
+    cutoff = datetime.utcnow() - timedelta(
+        days=current_app.config["HOTNESS_DECAY_DAYS"])
+
+    # Old Thoughts that have no score yet are scored as well
+    recent = Thought.query \
+        .filter_by(kind="thought") \
+        .filter(or_(Thought.created > cutoff, Thought._hot == 0,
+            Thought._hot == None))
+
+    scores = [{"thought_id": t.id, "hot": t.hot()} for t in recent.yield_per(500)]
+    if len(scores) > 0:
+        db.session.execute(thought_table.update()
+            .where(thought_table.c.id == bindparam("thought_id"))
+            .values(_hot=bindparam("hot")), scores)
+
+    db.session.commit()
+    timer.stop("Decayed hotness of {} thoughts".format(len(scores)))
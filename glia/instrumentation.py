@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.instrumentation
+    ~~~~~
+
+    Performance metrics for Flask endpoints and Socket.IO event handlers.
+
+    Each request or event is a measurement of wall time, number and duration
+    of SQL queries, cache hits and misses and template rendering time. When a
+    measurement finishes it is added to a Redis hash for the current time
+    window, so that all web processes contribute to the same rolling
+    histograms. `summary` combines the most recent windows and is exposed in
+    the `metrics` view and the `manage.py metrics` command.
+
+    Requests slower than `SLOW_REQUEST_THRESHOLD` seconds are logged together
+    with the SQL statements they executed and kept as samples in Redis.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import functools
+import json
+import logging
+import time
+
+from flask import current_app, request
+from flask.ext.rq import get_connection
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.local import Local, release_local
+
+logger = logging.getLogger('web')
+
+METRICS_KEY = "glia:metrics:{}:{}"
+NAMES_KEY = "glia:metrics:names"
+SLOW_KEY = "glia:metrics:slow"
+
+# Upper bounds of wall time histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Counters summed up for every measurement
+COUNTERS = ["count", "wall_time", "queries", "sql_time", "cache_hits",
+    "cache_misses", "template_time"]
+
+# Measurements in progress in the current greenlet
+_local = Local()
+
+
+def _current():
+    """Return the innermost measurement in progress or None"""
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def _add(counter, value):
+    measurement = _current()
+    if measurement is not None:
+        measurement[counter] += value
+
+
+def start(name):
+    """Begin a measurement in the current greenlet
+
+    Args:
+        name (String): Endpoint or event name the measurement is recorded for
+    """
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+
+    measurement = {k: 0 for k in COUNTERS}
+    measurement["name"] = name
+    measurement["started"] = time.time()
+    measurement["statements"] = [] \
+        if current_app.config["SLOW_REQUEST_THRESHOLD"] else None
+    _local.stack.append(measurement)
+
+
+def finish():
+    """End the innermost measurement and record it
+
+    Returns:
+        dict: The finished measurement or None if there was none in progress
+    """
+    stack = getattr(_local, "stack", None)
+    if not stack:
+        return None
+
+    measurement = stack.pop()
+    if len(stack) == 0:
+        release_local(_local)
+
+    measurement["count"] = 1
+    measurement["wall_time"] = time.time() - measurement["started"]
+
+    try:
+        record(measurement)
+        threshold = current_app.config["SLOW_REQUEST_THRESHOLD"]
+        if threshold and measurement["wall_time"] >= threshold:
+            record_slow(measurement)
+    except Exception, e:
+        logger.warning("Error recording metrics for {}: {}".format(
+            measurement["name"], e))
+
+    return measurement
+
+
+def record(measurement):
+    """Add a finished measurement to the histograms of its time window"""
+    window_length = current_app.config["INSTRUMENTATION_WINDOW"]
+    window = int(measurement["started"] // window_length) * window_length
+    key = METRICS_KEY.format(window, measurement["name"])
+
+    wall_ms = measurement["wall_time"] * 1000
+    bucket = next((b for b in HISTOGRAM_BUCKETS if wall_ms <= b), "inf")
+
+    pipe = get_connection().pipeline()
+    for counter in COUNTERS:
+        # Most requests don't render templates or use the cache
+        if not measurement[counter]:
+            continue
+        if isinstance(measurement[counter], float):
+            pipe.hincrbyfloat(key, counter, measurement[counter])
+        else:
+            pipe.hincrby(key, counter, measurement[counter])
+    pipe.hincrby(key, "le_{}".format(bucket), 1)
+    pipe.expire(key, window_length * current_app.config["INSTRUMENTATION_RETENTION"])
+    pipe.zadd(NAMES_KEY, **{measurement["name"]: measurement["started"]})
+    pipe.execute()
+
+
+def record_slow(measurement):
+    """Log a slow measurement and keep it as a sample"""
+    sample = {k: measurement[k] for k in COUNTERS if k != "count"}
+    sample["name"] = measurement["name"]
+    sample["started"] = measurement["started"]
+    sample["url"] = request.url if request else None
+    sample["statements"] = sorted(measurement["statements"],
+        key=lambda s: s["duration"], reverse=True)
+
+    logger.warning("Slow request {} ({:.0f}ms, {} queries in {:.0f}ms):\n{}".format(
+        sample["url"], sample["wall_time"] * 1000, sample["queries"],
+        sample["sql_time"] * 1000, "\n".join(["{:>8.1f}ms {}".format(
+            s["duration"] * 1000, s["statement"]) for s in sample["statements"][:5]])))
+
+    pipe = get_connection().pipeline()
+    pipe.lpush(SLOW_KEY, json.dumps(sample))
+    pipe.ltrim(SLOW_KEY, 0, current_app.config["SLOW_REQUEST_SAMPLES"] - 1)
+    pipe.execute()
+
+
+def _percentile(histogram, count, q):
+    """Return the upper bound of the histogram bucket containing quantile q"""
+    seen = 0
+    for bucket in HISTOGRAM_BUCKETS + ["inf"]:
+        seen += histogram.get(bucket, 0)
+        if seen >= q * count:
+            return bucket
+    return "inf"
+
+
+def summary(windows=5):
+    """Return aggregated metrics of the most recent time windows
+
+    Args:
+        windows (int): Number of windows to combine
+
+    Returns:
+        dict: Metrics keyed by endpoint or event name
+    """
+    conn = get_connection()
+    window_length = current_app.config["INSTRUMENTATION_WINDOW"]
+    now = int(time.time() // window_length) * window_length
+    starts = [now - i * window_length for i in range(windows)]
+
+    # Forget names that weren't measured in any retained window
+    conn.zremrangebyscore(NAMES_KEY, "-inf",
+        now - window_length * current_app.config["INSTRUMENTATION_RETENTION"])
+
+    names = conn.zrangebyscore(NAMES_KEY, starts[-1], "+inf")
+    pipe = conn.pipeline()
+    for name in names:
+        for window in starts:
+            pipe.hgetall(METRICS_KEY.format(window, name))
+    results = pipe.execute()
+
+    rv = dict()
+    for i, name in enumerate(names):
+        totals = {k: 0 for k in COUNTERS}
+        histogram = dict()
+        for data in results[i * windows:(i + 1) * windows]:
+            for field, value in data.items():
+                if field.startswith("le_"):
+                    bucket = field[3:]
+                    bucket = int(bucket) if bucket != "inf" else bucket
+                    histogram[bucket] = histogram.get(bucket, 0) + int(value)
+                elif field in totals:
+                    totals[field] += float(value)
+
+        count = int(totals["count"])
+        if count == 0:
+            continue
+
+        rv[name] = {
+            "count": count,
+            "wall_time_mean": totals["wall_time"] / count,
+            "wall_time_p50": _percentile(histogram, count, 0.5),
+            "wall_time_p95": _percentile(histogram, count, 0.95),
+            "queries_mean": totals["queries"] / count,
+            "sql_time_mean": totals["sql_time"] / count,
+            "template_time_mean": totals["template_time"] / count,
+            "cache_hits": int(totals["cache_hits"]),
+            "cache_misses": int(totals["cache_misses"]),
+            "histogram": {str(k): v for k, v in histogram.items()}
+        }
+
+    return rv
+
+
+def slow_samples():
+    """Return stored samples of slow requests, most recent first"""
+    return [json.loads(s) for s in get_connection().lrange(SLOW_KEY, 0, -1)]
+
+
+def track_event(f):
+    """Decorator for measuring a Socket.IO event handler
+
+    Must be applied below `socketio.on` so that the registered handler is the
+    measured one."""
+    name = "socketio.{}".format(f.__name__)
+
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        if not current_app.config["INSTRUMENTATION"]:
+            return f(*args, **kwargs)
+        start(name)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            finish()
+    return wrapped
+
+
+class TimedTemplate(Template):
+    """Jinja template class adding its render time to the measurement"""
+
+    def render(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            _add("template_time", time.time() - started)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("glia_query_start", []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info["glia_query_start"].pop()
+    measurement = _current()
+    if measurement is not None:
+        measurement["queries"] += 1
+        measurement["sql_time"] += duration
+        if measurement["statements"] is not None:
+            measurement["statements"].append({
+                "statement": statement,
+                "duration": duration
+            })
+
+
+def _count_cache_get(get):
+    @functools.wraps(get)
+    def wrapped(*args, **kwargs):
+        rv = get(*args, **kwargs)
+        _add("cache_hits" if rv is not None else "cache_misses", 1)
+        return rv
+    return wrapped
+
+
+def _count_cache_get_many(get_many):
+    @functools.wraps(get_many)
+    def wrapped(*args, **kwargs):
+        rv = get_many(*args, **kwargs)
+        hits = len([v for v in rv if v is not None])
+        _add("cache_hits", hits)
+        _add("cache_misses", len(rv) - hits)
+        return rv
+    return wrapped
+
+
+def init_app(app, cache):
+    """Setup instrumentation of requests, queries, templates and the cache
+
+    Args:
+        app (Flask): Application
+        cache (Cache): Flask-Cache instance whose backend is instrumented
+    """
+    if not app.config["INSTRUMENTATION"]:
+        return
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    app.jinja_env.template_class = TimedTemplate
+
+    backend = app.extensions["cache"][cache]
+    backend.get = _count_cache_get(backend.get)
+    backend.get_many = _count_cache_get_many(backend.get_many)
+
+    @app.before_request
+    def start_request_measurement():
+        if request.endpoint is not None:
+            start(request.endpoint)
+
+    @app.teardown_request
+    def finish_request_measurement(exc):
+        if request.endpoint is not None:
+            finish()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.jobs
+    ~~~~~
+
+    Background jobs executed by the rq worker. Jobs listed in `periodical` are
+    scheduled by `worker.periodic_schedule` alongside those from Nucleus.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+
+from contextlib import contextmanager
+
+logger = logging.getLogger('web')
+
+_app = None
+
+
+@contextmanager
+def job_context():
+    """Provide a request context for jobs executed outside of the web process
+
+    The app is only created once per worker process so that consecutive jobs
+    don't pay for setting it up again.
+    """
+    global _app
+    if _app is None:
+        from glia import create_app
+        _app = create_app(log_info=False)
+
+    with _app.test_request_context('/'):
+        yield _app
+
+
+def build_frontpage_snapshot():
+    """Precompute the anonymous front page and store it in the cache"""
+    from glia.web.frontpage import build_snapshot
+
+    with job_context():
+        build_snapshot()
+
+
+def decay_hotness():
+    """Recompute stored hotness scores of recent Thoughts"""
+    from glia import hotness
+
+    with job_context():
+        hotness.decay_hotness()
+
+
+def flush_readmarks():
+    """Mark notifications read for URLs their recipients visited"""
+    from glia.web import readmarks
+
+    with job_context():
+        count = readmarks.flush_readmarks()
+        logger.debug("Marked {} notifications read".format(count))
+
+
+def process_longform(thought_id, placeholder_id, longform, source=None):
+    """Extract percepts from longform text attached to a Thought"""
+    from glia import attachments
+
+    with job_context():
+        attachments.process_longform(thought_id, placeholder_id, longform,
+            source)
+
+
+def process_text(thought_id, text):
+    """Extract percepts from the short text of a Thought"""
+    from glia import attachments
+
+    with job_context():
+        attachments.process_text(thought_id, text)
+
+
+def refill_keypool():
+    """Generate keypairs for new Personas in advance"""
+    from glia import keypool
+
+    with job_context():
+        count = keypool.refill()
+        logger.info("Added {} keysets to the key pool".format(count))
+
+
+def flush_votes():
+    """Write votes recorded by the vote engine to the database"""
+    from glia import votes
+
+    with job_context():
+        count = votes.flush_votes()
+        logger.debug("Wrote {} votes".format(count))
+
+
+def flush_mail():
+    """Deliver all queued emails"""
+    from glia import mail
+
+    with job_context():
+        count = mail.flush_outbox()
+        logger.info("Delivered {} queued emails".format(count))
+
+
+def flush_presence():
+    """Store connection times of chat members in the database"""
+    from glia.web import presence
+
+    with job_context():
+        count = presence.flush_last_connected()
+        logger.debug("Updated last connection time of {} personas".format(count))
+
+
+# Periodical jobs are tuples of (function name, interval in seconds)
+periodical = [
+    ("build_frontpage_snapshot", 60),
+    ("decay_hotness", 600),
+    ("flush_presence", 60),
+    ("flush_readmarks", 30),
+    ("flush_mail", 30),
+    ("flush_votes", 10),
+    ("refill_keypool", 900),
+]
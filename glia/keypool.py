@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.keypool
+    ~~~~~
+
+    Pool of pregenerated RSA keypairs for new Personas.
+
+    Generating the signing and encryption keypairs of a Persona takes hundreds
+    of milliseconds of CPU time, during which the gevent server can't serve any
+    other connection. Keypairs are therefore generated by the `refill_keypool`
+    job on the rq worker and stored in a Redis list, from which `assign_keys`
+    takes one set per new Persona. If the pool is empty, keys are generated
+    in the request as before.
+
+    Keysets in Redis are encrypted with a key derived from the app's
+    `SECRET_KEY`. Assigned keys are stored on the Persona in the same
+    serialization `Persona.generate_keys` uses, so that Nucleus loads keys
+    from both paths alike.
+
+    The pool is enabled with the `KEYPOOL` config value.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import base64
+import json
+import logging
+
+from cryptography.fernet import Fernet, InvalidToken
+from flask import current_app
+from flask.ext.rq import get_connection, get_queue
+from hashlib import sha256
+from keyczar.keys import RsaPrivateKey
+
+logger = logging.getLogger('web')
+
+POOL_KEY = "glia:keypool"
+REFILL_PENDING_KEY = "glia:keypool:refill-pending"
+
+# Attributes of Persona set from a pooled keyset
+KEY_ATTRIBUTES = ["sign_private", "sign_public", "crypt_private", "crypt_public"]
+
+
+def _pool_cipher():
+    """Return the cipher for keysets stored in Redis"""
+    digest = sha256(current_app.config["SECRET_KEY"]).digest()
+    return Fernet(base64.urlsafe_b64encode(digest))
+
+
+def generate_keyset():
+    """Return new signing and encryption keypairs
+
+    Returns:
+        dict: Serialized keys with the names in `KEY_ATTRIBUTES`
+    """
+    sign_key = RsaPrivateKey.Generate()
+    crypt_key = RsaPrivateKey.Generate()
+    return {
+        "sign_private": str(sign_key),
+        "sign_public": str(sign_key.public_key),
+        "crypt_private": str(crypt_key),
+        "crypt_public": str(crypt_key.public_key)
+    }
+
+
+def assign_keys(persona, password):
+    """Give a Persona keypairs from the pool
+
+    Falls back to generating keys in place if the pool is disabled or empty.
+    Schedules a refill when the pool runs low.
+
+    Args:
+        persona (Persona): Persona without keys
+        password (String): Password passed on to `Persona.generate_keys` if
+            keys are generated in place
+    """
+    if not current_app.config["KEYPOOL"]:
+        persona.generate_keys(password)
+        return
+
+    conn = get_connection('low')
+    pipe = conn.pipeline()
+    pipe.lpop(POOL_KEY)
+    pipe.llen(POOL_KEY)
+    keyset, remaining = pipe.execute()
+
+    if remaining < current_app.config["KEYPOOL_MIN_SIZE"]:
+        schedule_refill(conn)
+
+    if keyset is not None:
+        try:
+            keyset = json.loads(_pool_cipher().decrypt(keyset))
+        except InvalidToken:
+            # Stored before a change of SECRET_KEY
+            logger.warning("Discarding undecryptable keyset from key pool")
+            keyset = None
+
+    if keyset is None:
+        logger.warning("Key pool is empty, generating keys for {}".format(persona))
+        persona.generate_keys(password)
+    else:
+        for attr in KEY_ATTRIBUTES:
+            setattr(persona, attr, keyset[attr])
+
+
+def schedule_refill(conn=None):
+    """Enqueue a `refill_keypool` job unless one is already waiting"""
+    conn = conn or get_connection('low')
+    if conn.set(REFILL_PENDING_KEY, 1, nx=True,
+            ex=current_app.config["KEYPOOL_REFILL_TIMEOUT"]):
+        from glia import jobs
+        get_queue('low').enqueue(jobs.refill_keypool)
+
+
+def refill():
+    """Generate keysets until the pool holds `KEYPOOL_SIZE` of them
+
+    Returns:
+        int: Number of generated keysets
+    """
+    conn = get_connection('low')
+    size = current_app.config["KEYPOOL_SIZE"]
+    cipher = _pool_cipher()
+    rv = 0
+
+    try:
+        while conn.llen(POOL_KEY) < size:
+            conn.rpush(POOL_KEY, cipher.encrypt(json.dumps(generate_keyset())))
+            rv += 1
+    finally:
+        conn.delete(REFILL_PENDING_KEY)
+
+    return rv
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.mail
+    ~~~~~
+
+    Outbound email delivery.
+
+    Request handlers call `queue_email`, which only appends the rendered
+    message to a Redis list. The first message of every `MAIL_FLUSH_INTERVAL`
+    enqueues a `flush_mail` job on the rq `low` queue, later ones are picked
+    up by the periodical `flush_mail` job. The worker delivers all queued
+    messages in batches, reusing one connection of the configured backend.
+
+    Backends are selected with the `MAIL_BACKEND` config value:
+
+    - `sendgrid`: Deliver using the Sendgrid web API (default)
+    - `smtp`: Deliver to the SMTP server at `MAIL_SMTP_HOST`:`MAIL_SMTP_PORT`
+    - `file`: Append messages as JSON lines to `MAIL_FILE_PATH` (for testing)
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import json
+import logging
+import os
+import smtplib
+import sendgrid
+
+from email.mime.text import MIMEText
+from flask import current_app
+from flask.ext.rq import get_connection, get_queue
+from sendgrid import SendGridClient
+
+logger = logging.getLogger('web')
+
+OUTBOX_KEY = "glia:mail:outbox"
+FLUSH_PENDING_KEY = "glia:mail:flush-pending"
+PROCESSING_KEY = "glia:mail:processing"
+
+
+class SendgridBackend(object):
+    """Deliver messages using the Sendgrid web API"""
+
+    def __init__(self, config):
+        sg_user = os.environ.get('SENDGRID_USERNAME') or config["SENDGRID_USERNAME"]
+        sg_pass = os.environ.get('SENDGRID_PASSWORD') or config["SENDGRID_PASSWORD"]
+        self.client = SendGridClient(sg_user, sg_pass, raise_errors=True)
+
+    def send(self, payload):
+        message = sendgrid.Mail()
+        for recipient in payload["to"]:
+            message.add_to(recipient)
+        message.set_subject(payload["subject"])
+        message.set_html(payload["html"])
+        message.set_from(payload["sender"])
+        return self.client.send(message)
+
+
+class SMTPBackend(object):
+    """Deliver messages to an SMTP server"""
+
+    def __init__(self, config):
+        self.host = config["MAIL_SMTP_HOST"]
+        self.port = config["MAIL_SMTP_PORT"]
+        self.connection = None
+
+    def send(self, payload):
+        if self.connection is None:
+            self.connection = smtplib.SMTP(self.host, self.port)
+
+        message = MIMEText(payload["html"].encode('utf-8'), 'html', 'utf-8')
+        message['Subject'] = payload["subject"]
+        message['From'] = payload["sender"]
+        message['To'] = ", ".join(payload["to"])
+
+        try:
+            return self.connection.sendmail(
+                payload["sender"], payload["to"], message.as_string())
+        except smtplib.SMTPServerDisconnected:
+            self.connection = None
+            raise
+
+
+class FileBackend(object):
+    """Append messages to a file, one JSON object per line"""
+
+    def __init__(self, config):
+        self.path = config["MAIL_FILE_PATH"]
+
+    def send(self, payload):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(payload) + "\n")
+
+
+BACKENDS = {
+    "sendgrid": SendgridBackend,
+    "smtp": SMTPBackend,
+    "file": FileBackend
+}
+
+_backend = None
+
+
+def get_backend():
+    """Return the backend instance of this process, creating it if necessary"""
+    global _backend
+    name = current_app.config["MAIL_BACKEND"]
+    if _backend is None or not isinstance(_backend, BACKENDS[name]):
+        _backend = BACKENDS[name](current_app.config)
+    return _backend
+
+
+def deliver(payloads, failed=None):
+    """Deliver a batch of messages using the configured backend
+
+    Args:
+        payloads (list): Message dicts as created by `queue_email`
+        failed (list): Optional list to which messages that couldn't be
+            delivered are appended
+
+    Returns:
+        int: Number of messages delivered successfully
+    """
+    backend = get_backend()
+    rv = 0
+    for payload in payloads:
+        try:
+            backend.send(payload)
+        except Exception, e:
+            logger.exception("Error sending email '{}' to {}: {}".format(
+                payload["subject"], payload["to"], e))
+            if failed is not None:
+                failed.append(payload)
+        else:
+            rv += 1
+    return rv
+
+
+def queue_email(to, subject, html, sender):
+    """Queue an email for delivery by the worker
+
+    Args:
+        to (list): Recipient addresses, optionally with names as in
+            'Name <address>'
+        subject (String): Subject line
+        html (String): Rendered message body
+        sender (String): Sender
+    """
+    payload = {
+        "to": to,
+        "subject": subject,
+        "html": html,
+        "sender": sender
+    }
+
+    if not current_app.config["MAIL_QUEUE"]:
+        deliver([payload])
+        return
+
+    conn = get_connection('low')
+    conn.rpush(OUTBOX_KEY, json.dumps(payload))
+    schedule_flush(conn)
+
+
+def schedule_flush(conn=None):
+    """Enqueue a `flush_mail` job unless one was enqueued in this interval"""
+    conn = conn or get_connection('low')
+    if conn.set(FLUSH_PENDING_KEY, 1, nx=True,
+            ex=current_app.config["MAIL_FLUSH_INTERVAL"]):
+        from glia import jobs
+        get_queue('low').enqueue(jobs.flush_mail)
+
+
+def flush_outbox():
+    """Deliver all queued messages in batches of `MAIL_BATCH_SIZE`
+
+    The outbox is moved to a processing list first, from which each batch is
+    only removed after it was sent. Messages of an interrupted flush are sent
+    again by the next one. Messages the backend rejected are queued again
+    until they failed `MAIL_MAX_ATTEMPTS` times.
+
+    Returns:
+        int: Number of messages delivered
+    """
+    conn = get_connection('low')
+    batch_size = current_app.config["MAIL_BATCH_SIZE"]
+    rv = 0
+
+    if not conn.exists(PROCESSING_KEY):
+        if not conn.exists(OUTBOX_KEY):
+            return 0
+        conn.rename(OUTBOX_KEY, PROCESSING_KEY)
+
+    while True:
+        batch = conn.lrange(PROCESSING_KEY, 0, batch_size - 1)
+        if len(batch) == 0:
+            conn.delete(PROCESSING_KEY)
+            break
+
+        failed = []
+        rv += deliver([json.loads(payload) for payload in batch], failed)
+
+        pipe = conn.pipeline()
+        for payload in failed:
+            payload["attempts"] = payload.get("attempts", 0) + 1
+            if payload["attempts"] < current_app.config["MAIL_MAX_ATTEMPTS"]:
+                pipe.rpush(OUTBOX_KEY, json.dumps(payload))
+            else:
+                logger.error("Giving up on email '{}' to {}".format(
+                    payload["subject"], payload["to"]))
+        pipe.ltrim(PROCESSING_KEY, len(batch), -1)
+        pipe.execute()
+
+    return rv
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.percepts
+    ~~~~~
+
+    Content digests for Percepts.
+
+    Every Percept stores a digest of its kind and identifying content (text,
+    URL, filename, tag or mentioned identity) in the indexed
+    `percept.content_digest` column. Looking up an existing Percept for some
+    content then takes one index probe instead of comparing text bodies.
+    Digests are computed whenever a Percept is inserted or updated.
+
+    Glia creates Percepts with `get_or_create` from this module. Percepts
+    created by Nucleus itself, e.g. in `process_attachments`, are still looked
+    up by Nucleus' own `get_or_create`.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+
+from hashlib import sha1
+from sqlalchemy import event
+
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import Percept
+
+logger = logging.getLogger('web')
+
+# Added by migration 5c1e7a9d2f46
+Percept.content_digest = db.Column(db.String(40), index=True)
+
+# Attributes identifying the content of each kind of Percept. Dotted names
+# follow relationships. Other kinds are identified by their title.
+DIGEST_ATTRIBUTES = {
+    "text": ("text", ),
+    "link": ("url", ),
+    "linkedpicture": ("url", ),
+    "tag": ("tag_id", ),
+    "mention": ("identity.id", "text"),
+}
+
+
+def content_digest(kind, *values):
+    """Return the digest of a Percept kind with the given content"""
+    parts = [kind] + [v if isinstance(v, unicode) else
+        str(v).decode('utf-8') if v is not None else u"" for v in values]
+    return sha1(u"\x1f".join(parts).encode('utf-8')).hexdigest()
+
+
+def _content_value(percept, attr):
+    rv = percept
+    for name in attr.split("."):
+        if rv is None:
+            return None
+        rv = getattr(rv, name)
+    return rv
+
+
+def percept_digest(percept):
+    """Return the digest of a Percept or None if its content is unknown
+
+    Percepts without a digest are never found by `find_percept`, which only
+    costs a duplicate instead of returning the wrong Percept.
+    """
+    attrs = DIGEST_ATTRIBUTES.get(percept.kind, ("title", ))
+    try:
+        values = [_content_value(percept, attr) for attr in attrs]
+    except AttributeError, e:
+        logger.warning("Can't compute content digest of {}: {}".format(
+            percept, e))
+        return None
+    return content_digest(percept.kind, *values)
+
+
+def find_percept(cls, *values):
+    """Return an existing Percept of cls with the given content
+
+    Args:
+        cls (class): Percept subclass, e.g. TextPercept
+        values: Content in the order given by `DIGEST_ATTRIBUTES`
+
+    Returns:
+        Percept: Matching Percept or None
+    """
+    kind = cls.__mapper__.polymorphic_identity
+    return cls.query \
+        .filter(Percept.content_digest == content_digest(kind, *values)) \
+        .first()
+
+
+def get_or_create(cls, *values, **kwargs):
+    """Return a Percept of cls with the given content, creating it if needed
+
+    Existing Percepts are found by their digest. Only new content is passed on
+    to `cls.get_or_create` from Nucleus.
+
+    Args:
+        cls (class): Percept subclass, e.g. TextPercept
+        values: Content in the order given by `DIGEST_ATTRIBUTES`
+        kwargs: Passed on to `cls.get_or_create`
+    """
+    rv = find_percept(cls, *values)
+    if rv is None:
+        rv = cls.get_or_create(*values, **kwargs)
+    return rv
+
+
+@event.listens_for(Percept, "before_insert", propagate=True)
+@event.listens_for(Percept, "before_update", propagate=True)
+def update_content_digest(mapper, connection, target):
+    """Store the digest of a Percept's content when it is written"""
+    target.content_digest = percept_digest(target)
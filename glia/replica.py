@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.replica
+    ~~~~~
+
+    Routing of read-only queries to a database replica.
+
+    With `SQLALCHEMY_REPLICA_URI` set, SELECT statements issued inside views
+    and functions decorated with `read_only` are sent to the replica. Flushes
+    and all other statements always use the primary database.
+
+    After a session wrote to the database, the rest of the request reads from
+    the primary. Users whose writes were committed keep reading from the
+    primary for `REPLICA_STICKY_SECONDS`, so that they see their own changes
+    even if the replica lags behind.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import functools
+import logging
+
+from flask import current_app, g, has_app_context, has_request_context, \
+    session
+from flask.ext.rq import get_connection
+from functools import partial
+from sqlalchemy import event, orm
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import Select, CompoundSelect
+
+try:
+    from flask.ext.sqlalchemy import SignallingSession
+except ImportError:  # Flask-SQLAlchemy < 2.0
+    from flask.ext.sqlalchemy import _SignallingSession as SignallingSession
+
+from nucleus.nucleus.connections import db
+
+logger = logging.getLogger('web')
+
+REPLICA_BIND = "replica"
+STICKY_KEY = "glia:replica:sticky:{}"
+
+# Session.info key marking sessions that wrote to the database
+WROTE_INFO_KEY = "glia_replica_wrote"
+
+
+class RoutingSession(SignallingSession):
+    """Session sending SELECT statements to the replica when allowed"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and isinstance(clause, (Select, CompoundSelect)) \
+                and use_replica():
+            return db.get_engine(self.app, bind=REPLICA_BIND)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def init_app(app):
+    """Register the replica bind and install the routing session"""
+    uri = app.config["SQLALCHEMY_REPLICA_URI"]
+    if uri is None:
+        return
+
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    binds[REPLICA_BIND] = uri
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+    factory = db.session.session_factory
+    if getattr(factory, "func", factory) is not RoutingSession:
+        db.session.remove()
+        db.session = orm.scoped_session(partial(RoutingSession, db),
+            scopefunc=getattr(db.session.registry, "scopefunc", None))
+
+
+def read_only(f):
+    """Read from the replica while f runs, unless the viewer just wrote"""
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        if not has_app_context():
+            return f(*args, **kwargs)
+
+        g.replica_depth = g.get("replica_depth", 0) + 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.replica_depth -= 1
+    return wrapped
+
+
+def use_primary():
+    """Send all further queries of this request to the primary"""
+    g.db_primary = True
+
+
+def _user_id():
+    """Return the ID of the logged in user without loading the user
+
+    `current_user` can't be used here because loading it queries the
+    database, which calls `get_bind` again.
+    """
+    if not has_request_context():
+        return None
+    return session.get("user_id")
+
+
+def _sticky():
+    user_id = _user_id()
+    if user_id is None:
+        return False
+    return get_connection().exists(STICKY_KEY.format(user_id))
+
+
+def use_replica():
+    """Return True if SELECT statements may currently use the replica"""
+    if not has_app_context() or g.get("replica_depth", 0) == 0 \
+            or g.get("db_primary", False):
+        return False
+
+    if g.get("db_sticky", None) is None:
+        g.db_sticky = _sticky()
+    return not g.db_sticky
+
+
+@event.listens_for(Session, "after_flush")
+def mark_written(db_session, flush_context):
+    """Read the session's own writes from the primary"""
+    db_session.info[WROTE_INFO_KEY] = True
+    if has_app_context():
+        use_primary()
+
+
+@event.listens_for(Session, "after_commit")
+def make_sticky(db_session):
+    """Keep users on the primary for a while after their writes"""
+    if not db_session.info.pop(WROTE_INFO_KEY, False) \
+            or not has_request_context() \
+            or current_app.config["SQLALCHEMY_REPLICA_URI"] is None:
+        return
+
+    user_id = _user_id()
+    if user_id is not None:
+        get_connection().set(STICKY_KEY.format(user_id), 1,
+            ex=current_app.config["REPLICA_STICKY_SECONDS"])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_written(db_session, previous_transaction):
+    db_session.info.pop(WROTE_INFO_KEY, None)
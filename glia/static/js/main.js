@@ -48,7 +48,13 @@ $(document).ready(function(){
     });
 
     socket.on('status', function (msg) {
-        append_timeline("System", msg['msg']);
+        if (msg.thought_id !== undefined) {
+            // Attachments of a chatline were processed
+            $('.rk-chat-percept-' + msg.thought_id).remove();
+            $('.rk-chatline-' + msg.thought_id).after(msg.html);
+        } else {
+            append_timeline("System", msg['msg']);
+        }
     });
 
     socket.on('nicknames', function (data) {
@@ -57,14 +63,28 @@ $(document).ready(function(){
 
         $('#rk-chat-nicknames').empty();
         for (var i in nicknames) {
-          if (ids[i] == window.admin_id) {
-            $('#rk-chat-nicknames').append($('<strong>').text(nicknames[i] + " (Administrator)"));
-          } else {
-            $('#rk-chat-nicknames').append($('<strong>').text(nicknames[i]));
+          append_nickname(ids[i], nicknames[i]);
+        }
+    });
+
+    socket.on('presence', function (data) {
+        for (var i in data.left) {
+          $('#rk-chat-nicknames > [data-id="' + data.left[i].id + '"]').remove();
+        }
+        for (var i in data.joined) {
+          if ($('#rk-chat-nicknames > [data-id="' + data.joined[i].id + '"]').length == 0) {
+            append_nickname(data.joined[i].id, data.joined[i].username);
           }
         }
     });
 
+    // Keep presence in the current room alive
+    setInterval(function() {
+        if (socket.socket.connected) {
+            socket.emit('heartbeat', {'room_id': window.room_id});
+        }
+    }, 60 * 1000);
+
     socket.on('msg_to_room', append_timeline);
 
     socket.on('reconnect', function () {
@@ -98,17 +118,15 @@ $(document).ready(function(){
     socket.on('vote', function(data) {
         window.votedata = data;
 
-        thought_id = data.votes[0].thought_id;
-        author_id = data.votes[0].author_id;
-        vote_count = data.votes[0].vote_count;
-        voting_done = data.votes[0].voting_done;
-        console.log("Thought "+thought_id+" now has "+vote_count+" votes.");
+        $.each(data.votes, function(i, vote) {
+            console.log("Thought "+vote.thought_id+" now has "+vote.vote_count+" votes.");
 
-        if (voting_done != undefined) {
-            $("#rk-promote-"+thought_id+" > span").animate({width: voting_done*100+"%"});
-        }
+            if (vote.voting_done != undefined) {
+                $("#rk-promote-"+vote.thought_id+" > span").animate({width: vote.voting_done*100+"%"});
+            }
 
-        $(".upvote-count-"+thought_id).text(vote_count);
+            $(".upvote-count-"+vote.thought_id).text(vote.vote_count);
+        });
     });
 
     // DOM manipulation
@@ -132,6 +150,13 @@ $(document).ready(function(){
         hide_truncate_toggles();
     }
 
+    function append_nickname(id, nickname) {
+        if (id == window.admin_id) {
+            nickname = nickname + " (Administrator)";
+        }
+        $('#rk-chat-nicknames').append($('<strong>').attr('data-id', id).text(nickname));
+    }
+
     function hide_truncate_toggles() {
         // Hide truncate toggle when not needed
         $(".truncate").each(function() {
@@ -207,6 +232,15 @@ $(document).ready(function(){
         amplitude.logEvent("vote");
     }
 
+    function mark_upvoted(thought_ids) {
+        // Shared fragments are rendered without the viewer's upvotes
+        $.each(thought_ids, function(i, thought_id) {
+            $(".upvote-"+thought_id)
+                .removeClass("btn-default")
+                .addClass("btn-primary");
+        });
+    }
+
     function notification(title, message) {
         new PNotify({
             title: 'RKTIK ' + title,
@@ -222,6 +256,7 @@ $(document).ready(function(){
         $.ajax($('#rk-chat-more-button').attr('href'))
             .done(function(data) {
                 $('#rk-chat-more').after(data['html']);
+                mark_upvoted(data['upvoted'] || []);
 
                 if (data['end_reached'] == true) {
                     $('#rk-chat-more-button').remove();
@@ -253,6 +288,8 @@ $(document).ready(function(){
         // MISC UI
         //
 
+        mark_upvoted(window.upvoted_ids || []);
+
         $(".upvote").click(function () {
             if (logged_in()) {
                 request_upvote(this.dataset.id);
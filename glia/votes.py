@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.votes
+    ~~~~~
+
+    Write-behind vote engine.
+
+    Upvotes are toggled in Redis instead of writing the upvote row and the
+    `thought._upvotes` counter in the request. Every Thought that received a
+    vote has a set of the Persona IDs currently upvoting it, loaded from the
+    database on first use. Toggles update this set and record the Persona's
+    latest choice in a pending hash, which the periodical `flush_votes` job
+    writes to the database in one transaction.
+
+    Vote counts and the viewer's upvote state are read from the sets by
+    `glia.web.preload` wherever they are present.
+
+    Besides the upvote rows and `thought._upvotes`, the flush promotes
+    Thoughts in a movement's mindspace to its blog once they have the
+    movement's required number of votes, as `Thought.toggle_upvote` does.
+    Other effects of `toggle_upvote` in Nucleus are not reproduced.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import datetime
+import logging
+
+from flask import current_app
+from flask.ext.rq import get_connection
+from uuid import uuid4
+
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import Thought, Upvote, Movement
+
+logger = logging.getLogger('web')
+
+VOTERS_KEY = "glia:votes:{}"
+PENDING_KEY = "glia:votes:pending"
+PROCESSING_KEY = "glia:votes:processing"
+
+# Member of every voter set, so that Thoughts without votes have a set too
+SENTINEL = "-"
+
+# States of Upvote rows, see `Thought.toggle_upvote` in Nucleus
+UPVOTE_ACTIVE = 0
+UPVOTE_DISABLED = -1
+
+# KEYS: voter set; ARGV: timeout, sentinel and voter IDs
+LOAD_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    redis.call('sadd', KEYS[1], unpack(ARGV, 2))
+end
+redis.call('expire', KEYS[1], ARGV[1])
+"""
+
+# KEYS: voter set, pending hash; ARGV: timeout, Persona ID, pending field
+TOGGLE_SCRIPT = """
+local upvoted = 1
+if redis.call('sismember', KEYS[1], ARGV[2]) == 1 then
+    redis.call('srem', KEYS[1], ARGV[2])
+    upvoted = 0
+else
+    redis.call('sadd', KEYS[1], ARGV[2])
+end
+redis.call('hset', KEYS[2], ARGV[3], upvoted)
+redis.call('expire', KEYS[1], ARGV[1])
+return {upvoted, redis.call('scard', KEYS[1]) - 1}
+"""
+
+
+def promotion_movement(thought):
+    """Return the Movement whose mindspace contains a Thought or None"""
+    mindset = thought.mindset
+    if mindset is None or not isinstance(mindset.author, Movement) \
+            or mindset.author.mindspace != mindset:
+        return None
+    return mindset.author
+
+
+def voting_done(thought, vote_count):
+    """Return the share of required votes a mindspace Thought has received
+
+    Same as `Movement.voting_done` from Nucleus, which can't be used here
+    because it counts the Thought's upvotes in the database and misses the
+    votes still pending in Redis.
+
+    Args:
+        thought (Thought): Thought in any mindset
+        vote_count (int): Current vote count of the Thought
+
+    Returns:
+        float: Between 0 and 1 or None if the Thought can't be promoted
+    """
+    movement = promotion_movement(thought)
+    if movement is None:
+        return None
+    return min(1.0, float(vote_count) / max(1, movement.required_votes()))
+
+
+def promote(thought, vote_count):
+    """Add a Thought to its movement's blog if it has enough votes
+
+    Thoughts are only promoted once, which is recorded in `Thought._blogged`.
+
+    Returns:
+        Thought: The copy on the blog or None if nothing was promoted
+    """
+    if thought._blogged:
+        return None
+
+    movement = promotion_movement(thought)
+    if movement is None or vote_count < movement.required_votes():
+        return None
+
+    blog_thought = Thought.clone(thought, movement, movement.blog)
+    thought._blogged = True
+    db.session.add(blog_thought)
+    db.session.add(thought)
+    logger.info("Promoted {} to {} with {} votes".format(
+        thought, movement.blog, vote_count))
+    return blog_thought
+
+
+def _pending_field(thought_id, persona_id):
+    return "{}:{}".format(thought_id, persona_id)
+
+
+def load_voters(thought_id, conn=None):
+    """Copy the voters of a Thought from the database unless already loaded"""
+    conn = conn or get_connection()
+    voters = [author_id for (author_id, ) in db.session.query(Upvote.author_id)
+        .filter(Upvote.parent_id == thought_id)
+        .filter(Upvote.state >= 0)]
+    conn.eval(LOAD_SCRIPT, 1, VOTERS_KEY.format(thought_id),
+        current_app.config["VOTE_CACHE_TIMEOUT"], SENTINEL, *voters)
+
+
+def toggle(thought, persona):
+    """Toggle the upvote of a Persona on a Thought
+
+    Args:
+        thought (Thought): Thought to vote on
+        persona (Persona): Voter
+
+    Returns:
+        tuple: Boolean that is True if the Persona now upvotes the Thought
+            and the new vote count
+    """
+    conn = get_connection()
+    key = VOTERS_KEY.format(thought.id)
+    if not conn.exists(key):
+        load_voters(thought.id, conn)
+
+    upvoted, count = conn.eval(TOGGLE_SCRIPT, 2, key, PENDING_KEY,
+        current_app.config["VOTE_CACHE_TIMEOUT"], persona.id,
+        _pending_field(thought.id, persona.id))
+    return upvoted == 1, count
+
+
+def live_state(thought_ids, persona_id=None):
+    """Return vote counts and upvote state of Thoughts with loaded voter sets
+
+    Args:
+        thought_ids (list): IDs of Thoughts
+        persona_id (String): Viewer whose upvotes are returned
+
+    Returns:
+        dict: Maps IDs of Thoughts that have a voter set to tuples of the vote
+            count and whether persona_id upvoted them
+    """
+    if len(thought_ids) == 0:
+        return dict()
+
+    pipe = get_connection().pipeline()
+    for tid in thought_ids:
+        pipe.scard(VOTERS_KEY.format(tid))
+        pipe.sismember(VOTERS_KEY.format(tid), persona_id or SENTINEL)
+    results = pipe.execute()
+
+    rv = dict()
+    for tid, count, member in zip(thought_ids, results[::2], results[1::2]):
+        if count > 0:
+            rv[tid] = (count - 1, bool(member) and persona_id is not None)
+    return rv
+
+
+def flush_votes():
+    """Write pending votes and vote counts to the database
+
+    Returns:
+        int: Number of votes written
+    """
+    conn = get_connection()
+
+    # Votes from a failed flush are retried before taking new ones
+    if not conn.exists(PROCESSING_KEY):
+        if not conn.exists(PENDING_KEY):
+            return 0
+        conn.rename(PENDING_KEY, PROCESSING_KEY)
+
+    votes = dict()
+    for field, upvoted in conn.hgetall(PROCESSING_KEY).items():
+        thought_id, persona_id = field.split(":", 1)
+        votes[(thought_id, persona_id)] = upvoted == "1"
+
+    if len(votes) == 0:
+        conn.delete(PROCESSING_KEY)
+        return 0
+
+    thought_ids = set([tid for tid, pid in votes.keys()])
+    persona_ids = set([pid for tid, pid in votes.keys()])
+
+    existing = dict()
+    for upvote in Upvote.query \
+            .filter(Upvote.parent_id.in_(thought_ids)) \
+            .filter(Upvote.author_id.in_(persona_ids)):
+        existing[(upvote.parent_id, upvote.author_id)] = upvote
+
+    now = datetime.datetime.utcnow()
+    for (thought_id, persona_id), upvoted in votes.items():
+        upvote = existing.get((thought_id, persona_id))
+        if upvoted and upvote is None:
+            db.session.add(Upvote(
+                id=uuid4().hex,
+                author_id=persona_id,
+                parent_id=thought_id,
+                state=UPVOTE_ACTIVE,
+                created=now,
+                modified=now))
+        elif upvote is not None and upvoted != (upvote.state >= 0):
+            upvote.state = UPVOTE_ACTIVE if upvoted else UPVOTE_DISABLED
+            upvote.modified = now
+            db.session.add(upvote)
+
+    # Counters are taken from the voter sets, which include votes that
+    # arrived after the pending hash was renamed
+    counts = live_state(list(thought_ids))
+    for thought in Thought.query.filter(Thought.id.in_(thought_ids)):
+        if thought.id in counts:
+            thought._upvotes = counts[thought.id][0]
+            db.session.add(thought)
+            promote(thought, thought._upvotes)
+
+    db.session.commit()
+    conn.delete(PROCESSING_KEY)
+    return len(votes)
@@ -5,7 +5,7 @@ from flask.ext.login import current_user
 
 from forms import LoginForm
 
-from nucleus.nucleus.models import Movement, Mindset
+from viewer import get_viewer
 
 app = Blueprint('web', __name__)
 app.logger = logging.getLogger('web')
@@ -14,14 +14,14 @@ VIEW_CACHE_TIMEOUT = 5
 
 
 @app.context_processor
-def inject_repost_mindsets():
-    rv = []
-    if not current_user.is_anonymous():
-        rv = Mindset.query.filter(Mindset.id.in_(
-            current_user.active_persona.repost_mindsets()))
+def inject_viewer():
+    return dict(viewer=get_viewer())
+
 
+@app.context_processor
+def inject_repost_mindsets():
     return dict(
-        repost_mindsets=rv
+        repost_mindsets=get_viewer().repost_mindsets
     )
 
 
@@ -32,12 +32,7 @@ def inject_login_form():
 
 @app.context_processor
 def inject_navbar_movements():
-    if current_user.is_anonymous():
-        movements = Movement.top_movements()
-    else:
-        movements = current_user.active_persona.movements()
-
-    return dict(nav_movements=movements)
+    return dict(nav_movements=get_viewer().movements)
 
 import views
 import events
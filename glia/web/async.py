@@ -7,18 +7,25 @@
 
     :copyright: (c) 2015 by Vincent Ahrend.
 """
-from flask import render_template, url_for, jsonify, request
+import calendar
+
+from datetime import datetime
+from flask import current_app, url_for, jsonify, request
 from flask.ext.login import login_required, current_user
 
+from sqlalchemy import and_, or_
 from sqlalchemy.exc import SQLAlchemyError
 
-from . import app, VIEW_CACHE_TIMEOUT
-from .. import socketio
+from . import app
+from glia import bus
+from glia import instrumentation
+from glia.replica import read_only
 from glia.web.dev_helpers import http_auth
-from glia.web.helpers import make_view_cache_key
+from glia.web.fragments import render_chatline, upvoted_ids
 from glia.web.forms import CreatePersonaForm
+from glia.web.preload import preload_thoughts
 from nucleus.nucleus import UnauthorizedError
-from nucleus.nucleus.connections import db, cache
+from nucleus.nucleus.connections import db
 from nucleus.nucleus.models import Thought, Mindset, Movement, Persona, \
     Identity, FollowerNotification
 
@@ -50,20 +57,46 @@ def handle_invalid_usage(error):
     return response
 
 
+def encode_cursor(thought):
+    """Return a pagination cursor pointing at thought
+
+    The cursor has the form '<created in microseconds>-<id>'"""
+    created = calendar.timegm(thought.created.utctimetuple()) * 1000000 \
+        + thought.created.microsecond
+    return "{}-{}".format(created, thought.id)
+
+
+def decode_cursor(cursor):
+    """Return a tuple (created, id) from a cursor made by `encode_cursor`
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    created, thought_id = cursor.split("-", 1)
+    created = int(created)
+    try:
+        created_dt = datetime.utcfromtimestamp(created // 1000000)
+    except OverflowError:
+        raise ValueError("Cursor timestamp out of range")
+    return (created_dt.replace(microsecond=created % 1000000), thought_id)
+
+
 #
 # ROUTES
 #
 
 
 @app.route('/async/chat/<mindset_id>', methods=["GET"])
-@app.route('/async/chat/<mindset_id>/before-<index_id>/', methods=["GET"])
+@app.route('/async/chat/<mindset_id>/before-<cursor>/', methods=["GET"])
 @login_required
 # @http_auth.login_required
-@cache.cached(
-    timeout=VIEW_CACHE_TIMEOUT,
-    key_prefix=make_view_cache_key
-)
-def async_chat(mindset_id, index_id=None):
+@read_only
+def async_chat(mindset_id, cursor=None):
+    """Return rendered chatlines of a mindset, newest last
+
+    Pages are selected by a keyset cursor on (created, id) of the oldest
+    chatline already shown. Rendered chatlines are shared between viewers, so
+    the viewer's upvotes are returned separately in 'upvoted'."""
     from flask import jsonify
     errors = ""
     html = ""
@@ -73,25 +106,30 @@ def async_chat(mindset_id, index_id=None):
     if sm is None:
         errors += "Error loading more items. Please refresh page. "
 
-    if index_id:
-        index_thought = Thought.query.get(index_id)
-        if index_thought is None:
+    if cursor:
+        try:
+            cursor_created, cursor_id = decode_cursor(cursor)
+        except ValueError:
             errors += "Error loading more items. Please refresh page. "
 
     if len(errors) == 0:
-        thoughts = sm.index.filter_by(state=0).order_by(Thought.created.desc())
+        thoughts = sm.index.filter_by(state=0) \
+            .order_by(Thought.created.desc(), Thought.id.desc())
 
-        if index_id:
-            thoughts = thoughts.filter(Thought.created < index_thought.created)
+        if cursor:
+            thoughts = thoughts.filter(or_(
+                Thought.created < cursor_created,
+                and_(Thought.created == cursor_created, Thought.id < cursor_id)))
 
-        thoughts = thoughts.limit(51)[::-1]
+        thoughts = thoughts.limit(51).all()
+        end_reached = True if len(thoughts) < 51 else False
 
-        last_id = None
-        for thought in thoughts[:50]:
-            html = "\n".join([html, render_template('chatline.html', thought=thought)])
-            last_id = thought.id
+        thoughts = thoughts[:50][::-1]
+        preload_thoughts(thoughts)
 
-        end_reached = True if len(thoughts) < 51 else False
+        html = "\n".join([render_chatline(thought) for thought in thoughts])
+        last_id = thoughts[-1].id if len(thoughts) > 0 else None
+        upvoted = upvoted_ids()
 
     if errors:
         return(jsonify({
@@ -100,12 +138,14 @@ def async_chat(mindset_id, index_id=None):
         }))
     else:
         if not end_reached:
-            next_url = url_for('.async_chat', mindset_id=mindset_id, index_id=thoughts[0].id)
+            next_url = url_for('.async_chat', mindset_id=mindset_id,
+                cursor=encode_cursor(thoughts[0]))
         return(jsonify({
             'end_reached': end_reached,
             'html': html,
             'last_id': last_id,
             'next_url': next_url,
+            'upvoted': upvoted
         }))
 
 
@@ -145,7 +185,7 @@ def async_movement(movement_id):
     else:
         app.logger.info("{} changed mission of {} to '{}'".format(
             current_user.active_persona, movement, new_mission))
-        socketio.emit('status',
+        bus.emit('status',
             {'msg': "{} set a new mission: {}".format(
                 current_user.active_persona.username, new_mission)},
             room=movement.mindspace.id, namespace="/movements")
@@ -342,3 +382,20 @@ def async_toggle_movement_membership(movement_id):
         "persona_id": current_user.active_persona.id,
         "association": rv
     }, )
+
+
+@app.route("/async/metrics/", methods=["GET"])
+@http_auth.login_required
+def async_metrics():
+    """Return request and event metrics of the last `windows` time windows"""
+    if http_auth.username() != "admin_user":
+        raise InvalidUsage(message="Only admin may view metrics",
+            status_code=403)
+
+    windows = request.args.get("windows", default=5, type=int)
+    return jsonify({
+        "window_length": current_app.config["INSTRUMENTATION_WINDOW"],
+        "windows": windows,
+        "metrics": instrumentation.summary(windows),
+        "slow_requests": instrumentation.slow_samples()
+    })
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.broadcast
+    ~~~~~
+
+    Payloads broadcast to chat rooms when a Thought is created or voted on.
+
+    The `message` and `comment` payloads are rendered once per Thought from
+    the shared fragment cache (see `glia.web.fragments`), which uses the macro
+    modules Jinja builds once per process. The same rendered chatline is later
+    served by `async_chat` when the chat history is loaded.
+
+    Vote counts are broadcast at most once per `VOTE_BROADCAST_INTERVAL`
+    seconds and Thought, no matter how many votes arrive in between.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import gevent
+
+from flask import current_app
+
+from glia.web.fragments import render_chatline, render_thought
+from glia.web.preload import preload_thoughts, upvote_count_filter
+
+# Maps IDs of Thoughts with a scheduled `vote` broadcast to their room
+_pending_votes = dict()
+
+
+def chat_payloads(thought):
+    """Render the payloads of the `message` and `comment` events for a Thought
+
+    Args:
+        thought (Thought): Newly created Thought
+
+    Returns:
+        tuple: Dicts (message, comment)
+    """
+    preload_thoughts([thought])
+
+    message = {
+        'username': thought.author.username,
+        'msg': render_chatline(thought),
+        'thought_id': thought.id,
+        'parent_id': thought.parent_id,
+        'parent_short': render_thought("short", thought.parent)
+            if thought.parent else None,
+        'vote_count': upvote_count_filter(thought)
+    }
+
+    comment = {
+        'msg': render_thought("comment", thought),
+        'parent_id': thought.parent_id
+    }
+
+    return message, comment
+
+
+def vote_payload(thought, vote_count):
+    """Payload of the `vote` event for a Thought
+
+    `voting_done` is included for Thoughts that can be promoted to a
+    movement blog.
+    """
+    from glia.votes import voting_done
+
+    vote = {
+        'thought_id': thought.id,
+        'vote_count': vote_count
+    }
+    done = voting_done(thought, vote_count)
+    if done is not None:
+        vote['voting_done'] = done
+    return {'votes': [vote]}
+
+
+def schedule_vote_broadcast(thought_id, room_id):
+    """Broadcast the vote count of a Thought to a room after a short delay
+
+    Further votes on the Thought before the broadcast is sent are included in
+    the same event.
+    """
+    if thought_id in _pending_votes:
+        return
+
+    _pending_votes[thought_id] = room_id
+    gevent.spawn_later(current_app.config["VOTE_BROADCAST_INTERVAL"],
+        _broadcast_votes, current_app._get_current_object(), thought_id)
+
+
+def _broadcast_votes(app, thought_id):
+    from glia import bus
+    from glia.votes import live_state
+    from nucleus.nucleus.models import Thought
+
+    room_id = _pending_votes.pop(thought_id, None)
+    with app.app_context():
+        state = live_state([thought_id])
+        thought = Thought.query.get(thought_id)
+        if room_id is not None and thought_id in state and thought is not None:
+            bus.emit('vote', vote_payload(thought, state[thought_id][0]),
+                room=room_id)
@@ -8,22 +8,27 @@
     :copyright: (c) 2015 by Vincent Ahrend.
 """
 
-import datetime
 import functools
 import traceback
 import sys
 
-from flask import request, current_app, url_for
+from flask import current_app, request, url_for
 from flask.ext.login import current_user
 from flask.ext.socketio import emit, join_room, leave_room
 from sqlalchemy.exc import SQLAlchemyError
 
 from . import app
 from .. import socketio, db
-from glia.web.helpers import send_external_notifications
+from glia.instrumentation import track_event
+from glia.web import presence
+from glia import bus, votes
+from glia.attachments import create_from_input
+from glia.web.broadcast import chat_payloads, schedule_vote_broadcast, \
+    vote_payload
+from glia.web.helpers import dispatch_notifications
 from nucleus.nucleus.helpers import find_mentions
-from nucleus.nucleus.models import Mindset, Thought, Movement, \
-    Persona, Mention, MentionNotification, ReplyNotification, Mindspace
+from nucleus.nucleus.models import Mindset, Thought, Mention, \
+    MentionNotification, ReplyNotification
 from nucleus.nucleus import notification_signals, PersonaNotFoundError, \
     UnauthorizedError
 
@@ -54,6 +59,7 @@ def chat_error_handlerp(e):
 
 @socketio_authenticated_only
 @socketio.on('connect', namespace="/personas")
+@track_event
 def connectp():
     if not current_user.is_anonymous():
         request.namespace.join_room(current_user.active_persona.id)
@@ -72,8 +78,7 @@ def movement_chat_relay(sender, **data):
         raise ValueError("Missing message")
 
     print sender, data
-    socketio.emit('status', {"msg": data.get('message')},
-        room=data.get("room_id"), namespace="/movements")
+    bus.emit('status', {"msg": data.get('message')}, room=data.get("room_id"))
 
 
 @socketio.on_error(namespace='/movements')
@@ -84,6 +89,7 @@ def chat_error_handler(e):
 
 @socketio_authenticated_only
 @socketio.on('joined', namespace='/movements')
+@track_event
 def joined(message):
     """Sent by clients when they enter a room.
     A status message is broadcast to all people in the room."""
@@ -93,41 +99,57 @@ def joined(message):
         if "room_id" not in message:
             message["room_id"] = "base"
 
-        current_user.active_persona.last_connected = datetime.datetime.utcnow()
-        db.session.add(current_user.active_persona)
-        db.session.commit()
-
+        persona = current_user.active_persona
         join_room(message["room_id"])
-        app.logger.debug("{} joined movement chat {}".format(current_user.active_persona, message['room_id']))
-        emit('status', {'msg': current_user.active_persona.username + ' has entered the room.'}, room=message["room_id"])
+        app.logger.debug("{} joined movement chat {}".format(persona, message['room_id']))
 
-        rv = {"nicknames": [], "ids": []}
-        movement = Movement.query.filter_by(blog_id=message["room_id"]).first()
-        room = Mindset.query.get(message["room_id"])
-        if room and isinstance(room.author, Movement):
-            movement = room.author
-            online_cutoff = datetime.datetime.utcnow() - \
-                datetime.timedelta(seconds=15 * 60)
-            for gma in movement.members.join(Persona).filter(
-                    Persona.last_connected > online_cutoff).order_by(
-                    Persona.last_connected.desc()):
-                rv["nicknames"].append(gma.persona.username)
-                rv["ids"].append(gma.persona.id)
+        if presence.join(message["room_id"], persona):
+            bus.emit('status', {'msg': persona.username + ' has entered the room.'}, room=message["room_id"])
+            bus.emit('presence', presence.delta(joined=[presence.member(persona)]),
+                room=message["room_id"])
 
-        emit('nicknames', rv, room=message["room_id"])
+        # Only the joining client receives the full member list
+        emit('nicknames', presence.online(message["room_id"]))
+
+
+@socketio_authenticated_only
+@socketio.on('heartbeat', namespace='/movements')
+@track_event
+def heartbeat(message):
+    """Sent by clients periodically while they are in a room.
+    Members whose heartbeat timed out are announced as having left, members
+    returning after timing out as having joined."""
+    if "room_id" not in message:
+        message["room_id"] = "base"
+
+    persona = current_user.active_persona
+    joined = [presence.member(persona)] \
+        if presence.join(message["room_id"], persona) else []
+
+    expired = presence.expire(message["room_id"])
+    if len(joined) > 0 or len(expired) > 0:
+        bus.emit('presence', presence.delta(joined=joined, left=expired),
+            room=message["room_id"])
 
 
 @socketio_authenticated_only
 @socketio.on('left', namespace='/movements')
+@track_event
 def left(message):
     """Sent by clients when they leave a room.
     A status message is broadcast to all people in the room."""
+    persona = current_user.active_persona
     leave_room(message['room_id'])
-    emit('status', {'msg': current_user.active_persona.username + ' has left the room.'}, room=message["room_id"])
+
+    if presence.leave(message['room_id'], persona):
+        bus.emit('status', {'msg': persona.username + ' has left the room.'}, room=message["room_id"])
+        bus.emit('presence', presence.delta(left=[presence.member(persona)]),
+            room=message["room_id"])
 
 
 @socketio_authenticated_only
 @socketio.on('repost', namespace='/movements')
+@track_event
 def repost(message):
     """Sent by client when the user reposts a Thought."""
     errors = ""
@@ -149,6 +171,7 @@ def repost(message):
         thought = Thought.clone(parent_thought, author, map)
         thought.text = message['text']
         db.session.add(thought)
+        notifications = []
 
         # Check if there were new mentions added to the Thought
         mentions = find_mentions(thought.text)
@@ -158,7 +181,7 @@ def repost(message):
                 mention = Mention(identity=ident, text=mention_text)
                 notification = MentionNotification(
                     mention, author, url_for('web.thought', id=thought.id))
-                send_external_notifications(notification)
+                notifications.append(notification)
                 db.session.add(mention)
                 db.session.add(notification)
 
@@ -167,7 +190,7 @@ def repost(message):
         if parent_thought:
             notif = ReplyNotification(parent_thought=parent_thought, author=author,
                 url=url_for('web.thought', id=thought.id))
-            send_external_notifications(notif)
+            notifications.append(notif)
             db.session.add(notif)
 
         try:
@@ -180,30 +203,14 @@ def repost(message):
             app.logger.info(u"Repost {} {}: {}".format(
                 map if map else "[no mindset]", author.username, thought.text))
 
-            # Render using templates
-            chatline_template = current_app.jinja_env.get_template(
-                'chatline.html')
-            thought_macros_template = current_app.jinja_env.get_template(
-                'macros/thought.html')
-            thought_macros = thought_macros_template.make_module(
-                {'request': request})
+            dispatch_notifications(notifications)
 
+            data, reply_data = chat_payloads(thought)
             if map is not None:
-                data = {
-                    'username': author.username,
-                    'msg': chatline_template.render(thought=thought),
-                    'thought_id': thought.id,
-                    'parent_id': thought.parent_id,
-                    'parent_short': thought_macros.short(thought.parent),
-                    'vote_count': thought.upvote_count()
-                }
-                emit('message', data, room=map.id)
-
-            reply_data = {
-                'msg': thought_macros.comment(thought),
-                'parent_id': parent_thought.id
-            }
-            emit('comment', reply_data, room=message["room_id"])
+                bus.emit('message', data, room=map.id)
+
+            reply_data['parent_id'] = parent_thought.id
+            bus.emit('comment', reply_data, room=message["room_id"])
 
     if errors != "":
         app.logger.warning("Errors creating Thought: {}".format(errors))
@@ -221,6 +228,7 @@ def repost(message):
 
 @socketio_authenticated_only
 @socketio.on('text', namespace='/movements')
+@track_event
 def text(message):
     """Sent by a client when the user entered a new message.
     The message is sent to all people in the room."""
@@ -245,7 +253,7 @@ def text(message):
         map = Mindset.query.get(message["map_id"])
 
     if errors == "":
-        thought_data = Thought.create_from_input(
+        thought_data = create_from_input(
             text=message["msg"],
             mindset=map,
             parent=parent)
@@ -264,32 +272,11 @@ def text(message):
             app.logger.info(u"{} {}: {}".format(
                 map, thought.author.username, thought.text))
 
-            for notification in thought_data["notifications"]:
-                send_external_notifications(notification)
-
-            # Render using templates
-            chatline_template = current_app.jinja_env.get_template(
-                'chatline.html')
-            thought_macros_template = current_app.jinja_env.get_template(
-                'macros/thought.html')
-            thought_macros = thought_macros_template.make_module(
-                {'request': request})
-
-            data = {
-                'username': thought.author.username,
-                'msg': chatline_template.render(thought=thought),
-                'thought_id': thought.id,
-                'parent_id': thought.parent_id,
-                'parent_short': thought_macros.short(thought.parent) if thought.parent else None,
-                'vote_count': thought.upvote_count()
-            }
-            emit('message', data, room=message["room_id"])
-
-            reply_data = {
-                'msg': thought_macros.comment(thought),
-                'parent_id': thought.parent.id if thought.parent else None
-            }
-            emit('comment', reply_data, room=message["room_id"])
+            dispatch_notifications(thought_data["notifications"])
+
+            data, reply_data = chat_payloads(thought)
+            bus.emit('message', data, room=message["room_id"])
+            bus.emit('comment', reply_data, room=message["room_id"])
 
     if errors != "":
         app.logger.warning("Errors creating Thought: {}".format(errors))
@@ -298,38 +285,53 @@ def text(message):
 
 @socketio_authenticated_only
 @socketio.on('vote_request', namespace='/movements')
+@track_event
 def vote_request(message):
     """
     Issue a vote to a Thought using the currently activated Persona
 
+    With `VOTE_ENGINE` enabled the vote is recorded in Redis and written to
+    the database by the `flush_votes` job. The sender receives the new count
+    right away, the room receives a coalesced `vote` event.
+
     Args:
         thought_id (string): ID of the Thought
+        room_id (string): Room that is notified of the new vote count.
+            Defaults to the Thought's mindset.
     """
     error_message = ""
     thought_id = message.get('thought_id')
     thought = None
+    persona = current_user.active_persona
 
     if thought_id is None:
         error_message += "Vote event missing parameter. "
 
     if len(error_message) == 0:
         thought = Thought.query.get_or_404(thought_id)
-        try:
-            upvote = thought.toggle_upvote()
-        except PersonaNotFoundError:
+        if persona is None:
             error_message += "Please activate a Persona for voting. "
-            upvote = None
-        except UnauthorizedError:
+        elif not thought.authorize("read", persona.id):
             error_message += "You are not authorized to do this. Please login again."
-            upvote = None
 
-    data = dict()
+    if len(error_message) == 0:
+        if current_app.config["VOTE_ENGINE"]:
+            upvoted, vote_count = votes.toggle(thought, persona)
+        else:
+            try:
+                thought.toggle_upvote()
+            except PersonaNotFoundError:
+                error_message += "Please activate a Persona for voting. "
+            except UnauthorizedError:
+                error_message += "You are not authorized to do this. Please login again."
+            else:
+                vote_count = thought.upvote_count()
+
     if len(error_message) > 0:
-        app.logger.error("Error processing vote event from {} on {}: {}".format(current_user.active_persona, (thought or "<Thought {}>".format(thought_id or "with unknown id")), error_message))
-        data = {
-            "meta": {
-                "error_message": error_message
-            }
-        }
+        app.logger.error("Error processing vote event from {} on {}: {}".format(persona, (thought or "<Thought {}>".format(thought_id or "with unknown id")), error_message))
+        emit('error', error_message)
     else:
-        app.logger.debug("Processed vote by {} on {}".format(upvote.author, thought))
+        app.logger.debug("Processed vote by {} on {}".format(persona, thought))
+        emit('vote', vote_payload(thought, vote_count))
+        schedule_vote_broadcast(thought.id,
+            message.get("room_id") or thought.mindset_id)
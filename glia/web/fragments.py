@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.fragments
+    ~~~~~
+
+    Cache for rendered Thought HTML that is shared between viewers.
+
+    Fragments are keyed by the Thought's version, the viewer's read
+    permission, the macro arguments and a hash of the template sources, so
+    that edits, votes, comments and deploys all lead to new keys instead of
+    requiring explicit invalidation.
+
+    Shared fragments are rendered without the viewer's upvote state. Thoughts
+    upvoted by the viewer are collected while rendering and marked on the
+    client using the list returned by `upvoted_ids`.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+
+from flask import current_app, g, render_template
+from hashlib import sha1
+from jinja2 import Markup
+
+from nucleus.nucleus.connections import cache
+from glia.web.helpers import authorize_filter
+from glia.web.preload import preloaded, upvote_count_filter, \
+    comment_count_filter
+
+logger = logging.getLogger('web')
+
+FRAGMENT_CACHE_KEY = "fragment-{}"
+
+# Templates whose source determines the output of cached fragments
+THOUGHT_TEMPLATES = ["macros/thought.html", "macros/percept.html",
+    "macros/identity.html"]
+CHATLINE_TEMPLATES = ["chatline.html", "macros/chat.html"] + THOUGHT_TEMPLATES
+
+_template_hashes = dict()
+
+
+def template_hash(names):
+    """Return a hash of the sources of templates, computed once per process"""
+    key = tuple(names)
+    if key not in _template_hashes:
+        env = current_app.jinja_env
+        h = sha1()
+        for name in names:
+            h.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+        _template_hashes[key] = h.hexdigest()
+    return _template_hashes[key]
+
+
+def thought_version(thought):
+    """Return a stamp that changes on edits, votes and comments of a Thought"""
+    return "{}.{}.{}".format(
+        thought.modified.isoformat() if thought.modified else None,
+        upvote_count_filter(thought),
+        comment_count_filter(thought))
+
+
+def _cache_key(*parts):
+    rv = "-".join([unicode(p) for p in parts])
+    return FRAGMENT_CACHE_KEY.format(sha1(rv.encode('utf-8')).hexdigest())
+
+
+def _arg_key(value):
+    """Return a representation of a macro argument for use in cache keys"""
+    return getattr(value, "id", value)
+
+
+def _render_shared(key, render):
+    rv = cache.get(key)
+    if rv is None:
+        g.shared_fragment = True
+        try:
+            rv = render()
+        finally:
+            g.shared_fragment = False
+        cache.set(key, rv, timeout=current_app.config["FRAGMENT_CACHE_TIMEOUT"])
+    return rv
+
+
+def _collect_upvoted(thought):
+    if preloaded(thought, "upvoted"):
+        if g.get("upvoted_ids", None) is None:
+            g.upvoted_ids = set()
+        g.upvoted_ids.add(thought.id)
+
+
+def render_thought(macro, thought, **kwargs):
+    """Render a macro from macros/thought.html, reusing a shared copy
+
+    Args:
+        macro (String): Name of the macro, e.g. 'thought_lead'
+        thought (Thought): Thought to render
+        kwargs: Arguments passed on to the macro. Instances are
+            represented by their ID in the cache key.
+
+    Returns:
+        Markup: Rendered macro
+    """
+    key = _cache_key(macro, thought.id, thought_version(thought),
+        authorize_filter(thought, "read"),
+        sorted([(k, _arg_key(v)) for k, v in kwargs.items()]),
+        template_hash(THOUGHT_TEMPLATES))
+
+    module = current_app.jinja_env.get_template('macros/thought.html').module
+    rv = _render_shared(key,
+        lambda: unicode(getattr(module, macro)(thought, **kwargs)))
+
+    _collect_upvoted(thought)
+    return Markup(rv)
+
+
+def render_chatline(thought):
+    """Render a chatline, reusing a copy rendered for any other viewer
+
+    The thought (and its parent) must have been passed to `preload_thoughts`.
+
+    Returns:
+        String: Rendered chatline.html
+    """
+    parent = thought.parent if thought.parent_id is not None else None
+    key = _cache_key("chatline", thought.id, thought_version(thought),
+        preloaded(thought, "read"),
+        preloaded(parent, "read") if parent is not None else None,
+        template_hash(CHATLINE_TEMPLATES))
+
+    rv = _render_shared(key,
+        lambda: render_template('chatline.html', thought=thought))
+
+    _collect_upvoted(thought)
+    return rv
+
+
+def upvoted_ids():
+    """Return IDs of Thoughts in shared fragments the viewer has upvoted"""
+    return sorted(g.get("upvoted_ids", set()))
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.frontpage
+    ~~~~~
+
+    Precomputed front page for anonymous visitors. The snapshot is built by a
+    periodical job (see `glia.jobs`) and stored as a single versioned blob in
+    the cache, so that the `index` view only needs one cache hit and one
+    batched query to render the page.
+
+    If the snapshot expired, one request rebuilds it while holding a lock in
+    the cache. Concurrent requests are served the previous snapshot, which is
+    kept for longer, instead of building their own.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import datetime
+import json
+import logging
+
+from flask import current_app
+
+from glia.replica import read_only
+from glia.web.helpers import generate_graph
+from nucleus.nucleus import ExecutionTimer
+from nucleus.nucleus.connections import cache, db
+from nucleus.nucleus.helpers import recent_thoughts
+from nucleus.nucleus.models import Movement, Thought
+
+logger = logging.getLogger('web')
+
+# Increment when the layout of the snapshot dict changes so that stale
+# snapshots written by older code are ignored
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_CACHE_KEY = "frontpage-snapshot-v{}".format(SNAPSHOT_VERSION)
+
+# Copy of the last snapshot, served while it is rebuilt. Kept this many times
+# longer than the current snapshot.
+STALE_CACHE_KEY = "frontpage-snapshot-stale-v{}".format(SNAPSHOT_VERSION)
+STALE_TIMEOUT_FACTOR = 12
+
+# Held while a request rebuilds the snapshot
+LOCK_CACHE_KEY = "frontpage-snapshot-lock"
+LOCK_TIMEOUT = 60
+
+
+def build_snapshot():
+    """Compute the anonymous front page and store it in the cache
+
+    Returns:
+        dict: The snapshot with keys 'version', 'created', 'top_thought_ids'
+            (in hot order), 'movement_ids', 'recent_ids' and 'graph_json'
+    """
+    timer = ExecutionTimer()
+
+    top_ids = db.session.query(Thought.id) \
+        .filter(Thought.id.in_(read_only(Thought.top_thought)())) \
+        .order_by(Thought._hot.desc())
+
+    rv = {
+        "version": SNAPSHOT_VERSION,
+        "created": datetime.datetime.utcnow(),
+        "top_thought_ids": [row.id for row in top_ids],
+        "movement_ids": [m['id'] for m in
+            read_only(Movement.top_movements)()],
+        "recent_ids": list(recent_thoughts()),
+        "graph_json": generate_graph()
+    }
+
+    timeout = current_app.config["FRONTPAGE_SNAPSHOT_TIMEOUT"]
+    cache.set(SNAPSHOT_CACHE_KEY, rv, timeout=timeout)
+    cache.set(STALE_CACHE_KEY, rv, timeout=timeout * STALE_TIMEOUT_FACTOR)
+
+    timer.stop("Built front page snapshot")
+    return rv
+
+
+def empty_snapshot():
+    """Return a snapshot without content, see `build_snapshot`"""
+    return {
+        "version": SNAPSHOT_VERSION,
+        "created": datetime.datetime.utcnow(),
+        "top_thought_ids": [],
+        "movement_ids": [],
+        "recent_ids": [],
+        "graph_json": json.dumps({"nodes": [], "links": []})
+    }
+
+
+def _cached(key):
+    rv = cache.get(key)
+    if rv is None or rv.get("version") != SNAPSHOT_VERSION:
+        return None
+    return rv
+
+
+def get_snapshot():
+    """Return the current snapshot
+
+    If there is none, it is built in place unless another request is already
+    building it. In that case the last snapshot or, if there never was one,
+    an empty snapshot is returned.
+
+    Returns:
+        dict: See `build_snapshot`
+    """
+    rv = _cached(SNAPSHOT_CACHE_KEY)
+    if rv is not None:
+        return rv
+
+    if cache.add(LOCK_CACHE_KEY, True, timeout=LOCK_TIMEOUT):
+        logger.warning("Front page snapshot missing. Building it in request.")
+        try:
+            return build_snapshot()
+        finally:
+            cache.delete(LOCK_CACHE_KEY)
+
+    rv = _cached(STALE_CACHE_KEY)
+    return rv if rv is not None else empty_snapshot()
+
+
+def hydrate_snapshot(snapshot):
+    """Load all instances referenced in a snapshot
+
+    All thoughts are fetched in one batch and returned in snapshot order.
+
+    Args:
+        snapshot (dict): Snapshot as returned by `get_snapshot`
+
+    Returns:
+        tuple: (top thoughts, movements, recent thoughts, graph json)
+    """
+    thought_ids = set(snapshot["top_thought_ids"]) | set(snapshot["recent_ids"])
+    thoughts = {t.id: t for t in Thought.query.filter(Thought.id.in_(thought_ids))} \
+        if thought_ids else {}
+
+    movements = Movement.query.filter(Movement.id.in_(snapshot["movement_ids"])).all() \
+        if snapshot["movement_ids"] else []
+
+    top = [thoughts[tid] for tid in snapshot["top_thought_ids"] if tid in thoughts]
+    recent = [thoughts[tid] for tid in snapshot["recent_ids"] if tid in thoughts]
+    recent.sort(key=lambda t: t.created, reverse=True)
+
+    return (top, movements, recent, snapshot["graph_json"])
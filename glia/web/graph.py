@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.graph
+    ~~~~~
+
+    Building blocks for the mind graph rendered by the D3 force layout.
+
+    The graph of every viewer is made of the same kind of parts: identities
+    with the thoughts on their blogs. These clusters are loaded for all
+    involved identities with a single query and cached individually, so that
+    the anonymous graph and the graphs of all Personas share them. Only the
+    viewer's top thoughts are loaded per graph.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+
+from datetime import datetime, timedelta
+from sqlalchemy.orm import joinedload
+
+from nucleus.nucleus.connections import cache
+from nucleus.nucleus.models import Thought, TOP_THOUGHT_CACHE_DURATION
+
+logger = logging.getLogger('web')
+
+CLUSTER_CACHE_KEY = "graph-cluster-{}-{}"
+
+# Blog thoughts shown next to the author of a top thought
+RECENT_BLOG_DAYS = 7
+
+
+def anim_duration(hot):
+    return max([(5.0 / (hot * 1000 + 1)), 0.33])
+
+
+def thought_item(t):
+    """Return the node of a Thought"""
+    return {
+        "name": "{}<br /><small>by {}</small>".format(
+            t.text.encode('utf-8'), t.author.username.encode('utf-8')),
+        "group": 1,
+        "radius": 2,
+        "url": t.get_absolute_url(),
+        "anim": anim_duration(t._hot or 0.0)
+    }
+
+
+def ident_item(ident):
+    """Return the node of an Identity"""
+    return {
+        "name": ident.username,
+        "group": 2,
+        "radius": 4,
+        "url": ident.get_absolute_url(),
+        "color": ident.color
+    }
+
+
+class GraphBuilder(object):
+    """Collects nodes and links, adding every node only once"""
+
+    def __init__(self, root):
+        self.nodes = [root]
+        self.links = []
+        self.indexes = dict()
+
+    def __contains__(self, key):
+        return key in self.indexes
+
+    def node(self, key, item):
+        """Return the index of a node, adding it if necessary"""
+        if key not in self.indexes:
+            self.indexes[key] = len(self.nodes)
+            self.nodes.append(item)
+        return self.indexes[key]
+
+    def link(self, source, target, **kwargs):
+        kwargs.update({"source": source, "target": target})
+        self.links.append(kwargs)
+
+    def export(self):
+        return dict(nodes=self.nodes, links=self.links)
+
+
+def load_top_thoughts(ids):
+    """Load Thoughts together with their mindsets and authors"""
+    if len(ids) == 0:
+        return []
+
+    rv = {t.id: t for t in Thought.query
+        .filter(Thought.id.in_(ids))
+        .options(joinedload(Thought.mindset).joinedload('author'))
+        .options(joinedload(Thought.author))}
+    return [rv[tid] for tid in ids if tid in rv]
+
+
+def blog_clusters(idents, recent=True):
+    """Return the blog clusters of a list of Identities
+
+    Clusters missing from the cache are loaded with one query.
+
+    Args:
+        idents (list): Identity instances
+        recent (Boolean): Only include blog thoughts from the last
+            `RECENT_BLOG_DAYS` days
+
+    Returns:
+        dict: Maps Identity IDs to dicts with keys 'ident' (node) and
+            'thoughts' (list of (Thought ID, node) tuples, newest first)
+    """
+    kind = "recent" if recent else "all"
+    keys = [CLUSTER_CACHE_KEY.format(ident.id, kind) for ident in idents]
+    cached = cache.get_many(*keys) if len(keys) > 0 else []
+
+    rv = dict()
+    missing = []
+    for ident, cluster in zip(idents, cached):
+        if cluster is None:
+            missing.append(ident)
+        else:
+            rv[ident.id] = cluster
+
+    if len(missing) > 0:
+        blogs = {ident.blog_id: ident for ident in missing}
+        thoughts = Thought.query \
+            .filter(Thought.mindset_id.in_(blogs.keys())) \
+            .options(joinedload(Thought.author)) \
+            .order_by(Thought.created.desc())
+        if recent:
+            thoughts = thoughts.filter(Thought.created >
+                (datetime.utcnow() - timedelta(days=RECENT_BLOG_DAYS)))
+
+        loaded = {ident.id: {"ident": ident_item(ident), "thoughts": []}
+            for ident in missing}
+        for t in thoughts:
+            loaded[blogs[t.mindset_id].id]["thoughts"].append(
+                (t.id, thought_item(t)))
+
+        for ident_id, cluster in loaded.items():
+            cache.set(CLUSTER_CACHE_KEY.format(ident_id, kind), cluster,
+                timeout=TOP_THOUGHT_CACHE_DURATION)
+        rv.update(loaded)
+
+    return rv
@@ -9,34 +9,34 @@
 """
 import json
 import logging
-import os
 import pytz
-import sendgrid
 
-from datetime import datetime, timedelta
-from flask import render_template, request
+from collections import OrderedDict
+from flask import current_app, render_template, request
 from flask.ext.login import current_user
 from hashlib import sha256
 from uuid import uuid4
-from sendgrid import SendGridClient, SendGridClientError, SendGridServerError
+from sqlalchemy import inspect
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import joinedload, lazyload
+from sqlalchemy.orm import joinedload
 
 from nucleus.nucleus import ExecutionTimer
 from nucleus.nucleus.connections import cache
 from nucleus.nucleus.models import Persona, Movement, \
-    MovementMemberAssociation, Thought, TOP_THOUGHT_CACHE_DURATION
+    MovementMemberAssociation, Notification, Thought, \
+    TOP_THOUGHT_CACHE_DURATION
 
-from .. import socketio
+from glia import bus
+from glia.mail import queue_email
+from glia.replica import read_only
+from glia.web.graph import GraphBuilder, load_top_thoughts, blog_clusters, \
+    thought_item
+from glia.web.preload import preloaded
+from glia.web.viewer import get_viewer
 
 
 logger = logging.getLogger('web')
 
-# Cached results are fetched from the database by ID, which returns the result
-# list out of order. This lambda function reorders them.
-reorder = lambda l: sorted(l, key=Thought.hot, reverse=True)
-
-
 class UnauthorizedError(Exception):
     """Current user is not authorized for this action"""
     pass
@@ -55,12 +55,18 @@ def authorize_filter(obj, action, actor=None):
         Boolean: True if action is currently authorized
     """
     if actor is None:
-        actor = current_user.active_persona
+        actor = get_viewer().persona
+
+    if action == "read":
+        rv = preloaded(obj, "read", actor_id=actor.id)
+        if rv is not None:
+            return rv
 
     return obj.authorize(action, actor.id)
 
 
 @cache.memoize(timeout=TOP_THOUGHT_CACHE_DURATION)
+@read_only
 def generate_graph(persona=None):
     """Generates a graph for consumption by the D3 force layout
 
@@ -87,41 +93,28 @@ def generate_graph(persona=None):
             list.
     """
     timer = ExecutionTimer()
-    rv = dict(nodes=[], links=[])
-    node_indexes = dict()
 
     if persona:
-        idents = {m.id: m for m in persona.blogs_followed}
-        thoughts = Thought.query.filter(Thought.id.in_(
-            Thought.top_thought(persona=persona, filter_blogged=True)))
+        idents = persona.blogs_followed
+        thought_ids = Thought.top_thought(persona=persona, filter_blogged=True)
     else:
-        idents = {m.id: m for m in Movement.query
+        idents = Movement.query \
             .filter(Movement.id.in_(
-                [m['id'] for m in Movement.top_movements()]))
-            .options(joinedload(Movement.blog))}
-        thoughts = Thought.query.filter(Thought.id.in_(
-            Thought.top_thought()))
-
-    anim_duration = lambda hot: max([(5.0 / (hot * 1000 + 1)), 0.33])
-
-    thought_item = lambda t: {
-        "name": "{}<br /><small>by {}</small>".format(
-            t.text.encode('utf-8'), t.author.username.encode('utf-8')),
-        "group": 1,
-        "radius": 2,
-        "url": t.get_absolute_url(),
-        "anim": anim_duration(t.hot())
-    }
-
-    ident_item = lambda ident: {
-        "name": ident.username,
-        "group": 2,
-        "radius": 4,
-        "url": ident.get_absolute_url(),
-        "color": ident.color
-    }
-
-    rv['nodes'].append({
+                [m['id'] for m in Movement.top_movements()])) \
+            .all()
+        thought_ids = Thought.top_thought()
+
+    thoughts = load_top_thoughts(list(thought_ids))
+
+    authors = OrderedDict()
+    for t in thoughts:
+        authors[t.mindset.author.id] = t.mindset.author
+    followed = [m for m in idents if m.id not in authors]
+
+    author_clusters = blog_clusters(authors.values(), recent=True)
+    followed_clusters = blog_clusters(followed, recent=False)
+
+    graph = GraphBuilder({
         "name": "Rktik Mind<br /><small>This page</small>",
         "group": 0,
         "radius": 6,
@@ -129,61 +122,34 @@ def generate_graph(persona=None):
         "x": 100,
         "y": 100
     })
-    i = 1
 
     for t in thoughts:
-        if t.id in node_indexes:
-            rv["links"].append({"source": 0, "target": node_indexes[t.id]})
-        else:
-            rv["nodes"].append(thought_item(t))
-            rv["links"].append({"source": 0, "target": i})
-
-            node_indexes[t.id] = i
-            i += 1
-
-        if t.mindset.author.id not in node_indexes:
-            rv["nodes"].append(ident_item(t.mindset.author))
-            node_indexes[t.mindset.author.id] = i
-            try:
-                del idents[t.mindset.author.id]
-            except KeyError:
-                pass
-            i += 1
-
-        rv["links"].append({"source": node_indexes[t.id],
-            "target": node_indexes[t.mindset.author.id]})
-
-        additional_not_on_frontpage = t.mindset.author.blog.index \
-            .filter(Thought.created > (datetime.utcnow() - timedelta(days=7)))
-
-        for t_blog in additional_not_on_frontpage:
-            if t_blog != t:
-                if t_blog.id not in node_indexes:
-                    rv["nodes"].append(thought_item(t_blog))
-                    node_indexes[t_blog.id] = i
-                    i += 1
-
-                rv["links"].append({"target": node_indexes[t.mindset.author.id],
-                    "source": node_indexes[t_blog.id]})
-
-    for m in idents.values():
-        rv["nodes"].append(ident_item(m))
-        rv["links"].append({"source": 0, "target": i, "kind": 1})
-        node_indexes[m.id] = i
-        i += 1
-
-        for t_blog in m.blog.index:
-            if t_blog.id not in node_indexes:
-                rv["nodes"].append(thought_item(t_blog))
-                node_indexes[t_blog.id] = i
-                i += 1
-
-                rv["links"].append({"target": node_indexes[m.id],
-                    "source": node_indexes[t_blog.id]})
+        t_index = graph.node(t.id, thought_item(t))
+        graph.link(0, t_index)
+
+        author = t.mindset.author
+        if author.id not in graph:
+            cluster = author_clusters[author.id]
+            author_index = graph.node(author.id, cluster["ident"])
+
+            for t_blog_id, t_blog_item in cluster["thoughts"]:
+                if t_blog_id != t.id:
+                    graph.link(graph.node(t_blog_id, t_blog_item), author_index)
+
+        graph.link(t_index, graph.indexes[author.id])
+
+    for m in followed:
+        cluster = followed_clusters[m.id]
+        m_index = graph.node(m.id, cluster["ident"])
+        graph.link(0, m_index, kind=1)
+
+        for t_blog_id, t_blog_item in cluster["thoughts"]:
+            if t_blog_id not in graph:
+                graph.link(graph.node(t_blog_id, t_blog_item), m_index)
 
     timer.stop("Generated mind graph for {}".format(
         persona if persona else "anonymous users"))
-    return json.dumps(rv)
+    return json.dumps(graph.export())
 
 
 def localtime(value, tzval="UTC"):
@@ -211,70 +177,68 @@ def make_view_cache_key(*args, **kwargs):
     return sha256(rv).hexdigest()
 
 
-def send_email(message):
-    """Send Email using Sendgrid service
-
-    Args:
-        message (Sendgrid Message): Readily configured message object
-
-    Returns:
-        tuple: (status, message)
-
-    Raises:
-        SendGridClientError
-        SendGridServerError
-    """
-    from flask import current_app
-
-    sg_user = os.environ.get('SENDGRID_USERNAME') or current_app.config["SENDGRID_USERNAME"]
-    sg_pass = os.environ.get('SENDGRID_PASSWORD') or current_app.config["SENDGRID_PASSWORD"]
-    sg = SendGridClient(sg_user, sg_pass, raise_errors=True)
-    try:
-        rv = sg.send(message)
-    except Exception, e:
-        logger.exception("Eror sending email: {}".format(e))
-        rv = (None, None)
-
-    return rv
-
-
-def send_external_notifications(notification):
+def dispatch_notifications(notifications):
     """Send Email and trigger Desktop notifications depending on user prefs
 
+    Call after the notifications have been committed. Recipients and their
+    user accounts are loaded with a single query and every recipient gets one
+    desktop notification summarizing all of their notifications.
+
     Args:
-        notification (Notification): Notification object specifying message
+        notifications (list): Notification objects specifying message
             recipient etc.
     """
-
-    # Desktop notifications
-    if isinstance(notification.recipient, Persona):
-        data = {
-            'title': notification.source,
-            'msg': notification.text
-        }
-        socketio.emit('message', data,
-            room=notification.recipient.id, namespace="/personas")
-
-    # Email notification
-    if isinstance(notification.recipient, Persona):
-        if notification.recipient.user.email_allowed(notification):
-            message = sendgrid.Mail()
-            message.add_to("{} <{}>".format(
-                notification.recipient.username, notification.recipient.user.email))
-            message.set_subject(notification.text)
-            message.set_html(render_template("email/notification.html",
-                notification=notification))
-            message.set_from('RKTIK Notifications')
-
-            logger.info("Sending email notification to {}: {}".format(
-                notification.recipient, notification.recipient.user.email))
-
-            try:
-                status, msg = send_email(message)
-            except SendGridClientError, e:
-                logger.error("Client error sending notification email: {}".format(e))
-            except SendGridServerError, e:
-                logger.error("Server error sending notification email: {}".format(e))
+    # Committing expired the notifications, refresh them with one query
+    ids = [inspect(n).identity[0] for n in notifications
+        if inspect(n).identity is not None]
+    if len(ids) > 0:
+        Notification.query.filter(Notification.id.in_(ids)).all()
+
+    by_recipient = OrderedDict()
+    for notification in notifications:
+        by_recipient.setdefault(notification.recipient_id, []) \
+            .append(notification)
+
+    if len(by_recipient) == 0:
+        return
+
+    # Recipients that aren't Personas are not notified
+    recipients = dict([(p.id, p) for p in Persona.query
+        .filter(Persona.id.in_(by_recipient.keys()))
+        .options(joinedload(Persona.user))])
+
+    for recipient_id, recipient_notifications in by_recipient.items():
+        recipient = recipients.get(recipient_id)
+        if recipient is None:
+            continue
+
+        # Desktop notifications
+        if len(recipient_notifications) == 1:
+            data = {
+                'title': recipient_notifications[0].source,
+                'msg': recipient_notifications[0].text
+            }
+        else:
+            data = {
+                'title': "{} new notifications".format(
+                    len(recipient_notifications)),
+                'msg': "\n".join([n.text for n in recipient_notifications])
+            }
+        bus.emit('message', data, room=recipient_id, namespace="/personas")
+
+        # Email notification
+        for notification in recipient_notifications:
+            if recipient.user.email_allowed(notification):
+                logger.info("Queueing email notification to {}: {}".format(
+                    recipient, recipient.user.email))
+
+                queue_email(
+                    to=["{} <{}>".format(recipient.username,
+                        recipient.user.email)],
+                    subject=notification.text,
+                    html=render_template("email/notification.html",
+                        notification=notification),
+                    sender='RKTIK Notifications')
 
 
 def send_movement_invitation(recipient, movement, personal_message=None):
@@ -299,34 +263,32 @@ def send_movement_invitation(recipient, movement, personal_message=None):
         raise ValueError("{} is not a valid movement instance".format(
             movement))
 
-    message = sendgrid.Mail()
-    message.add_to(recipient)
-    message.set_subject("You were invited to join the {} movement".format(
-        movement.username))
-    message.set_html(render_template("email/movement_invitation.html",
+    html = render_template("email/movement_invitation.html",
         movement=movement,
         sender=current_user.active_persona,
         personal_message=personal_message,
-        invitation_code=mma.invitation_code))
-    message.set_from('RKTIK {} movement'.format(movement.username))
+        invitation_code=mma.invitation_code)
 
     try:
         db.session.commit()
-        status, msg = send_email(message)
-    except (SendGridClientError, SendGridServerError), e:
-        logger.error("Error sending email invitation to '{}' code '{}': {}".format(
-            recipient, mma.invitation_code, e))
     except SQLAlchemyError, e:
         logger.error("Error sending email invitation to '{}' code '{}': {}".format(
             recipient, mma.invitation_code, e))
     else:
-        logger.info("Sent invitation email for {} to '{}'".format(
+        queue_email(
+            to=[recipient],
+            subject="You were invited to join the {} movement".format(
+                movement.username),
+            html=html,
+            sender='RKTIK {} movement'.format(movement.username))
+
+        logger.info("Queued invitation email for {} to '{}'".format(
             movement, recipient))
         return mma
 
 
 def send_validation_email(user, db):
-    """Send validation email using sendgrid, resetting the signup code.
+    """Queue validation email, resetting the signup code.
 
     Args:
         user (User): Nucleus user object
@@ -336,7 +298,6 @@ def send_validation_email(user, db):
         ValueError: If active user has no name or email address
     """
     from nucleus.nucleus.database import db
-    from flask import current_app
 
     user.signup_code = uuid4().hex
     db.session.add(user)
@@ -348,23 +309,11 @@ def send_validation_email(user, db):
     if name is None or email is None:
         raise ValueError("Username and email can't be empty")
 
-    message = sendgrid.Mail()
-    message.add_to("{} <{}>".format(name, email))
-    message.set_subject('Please confirm your email address')
-    message.set_html(render_template("email/signup_confirmation.html", user=user))
-    message.set_from('RKTIK Email Confirmation')
-
-    try:
-        status, msg = send_email(message)
-    except SendGridClientError, e:
-        logger.error("Client error sending confirmation email: {}".format(e))
-        if current_app.config.get('DEBUG') is True:
-            logger.warning("User is being auto validated in debug environment")
-            user.validate()
-    except SendGridServerError, e:
-        logger.error("Server error sending confirmation email: {}".format(e))
-        logger.warning("User is being auto validated in debug environment")
-        user.validate()
+    queue_email(
+        to=["{} <{}>".format(name, email)],
+        subject='Please confirm your email address',
+        html=render_template("email/signup_confirmation.html", user=user),
+        sender='RKTIK Email Confirmation')
 
 
 def valid_redirect(path):
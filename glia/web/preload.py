@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.preload
+    ~~~~~
+
+    Batch loading of the per-thought state needed by `macros/thought.html`.
+
+    List views call `preload_thoughts` once with all Thoughts they are about to
+    render. Vote and comment counts, the set of Thoughts upvoted by the active
+    Persona and the result of the "read" authorization are then attached to
+    the instances so that the template filters defined here don't need to
+    query the database for every Thought. Votes recorded by the vote engine
+    (see `glia.votes`) take precedence over the counts stored in the database.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+from flask import current_app, g
+from flask.ext.login import current_user
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import Thought, Upvote
+from glia import votes
+
+# Name of the instance attribute holding preloaded state
+PRELOAD_ATTR = "_preloaded"
+
+
+def preload_thoughts(thoughts, persona=None, parents=True):
+    """Attach vote, comment and authorization state to a list of Thoughts
+
+    Runs a constant number of queries regardless of the length of the list.
+
+    Args:
+        thoughts (list): Thought instances that are going to be rendered
+        persona (Persona): Viewer. Defaults to the active Persona.
+        parents (Boolean): Also preload the parents of all Thoughts, which are
+            rendered by chatlines
+
+    Returns:
+        list: The thoughts that were passed in
+    """
+    thoughts = [t for t in thoughts if t is not None]
+    if persona is None and not current_user.is_anonymous():
+        persona = current_user.active_persona
+
+    targets = {t.id: t for t in thoughts}
+    parent_ids = set([t.parent_id for t in thoughts
+        if t.parent_id is not None]) if parents else set()
+
+    if len(targets) == 0:
+        return thoughts
+
+    # Load parents, and the mindsets and authors used by Thought.authorize,
+    # in one query. Parents in the identity map don't need lazy loading.
+    loaded = Thought.query \
+        .filter(Thought.id.in_(set(targets.keys()) | parent_ids)) \
+        .options(joinedload(Thought.mindset).joinedload('author')) \
+        .options(joinedload(Thought.author)) \
+        .all()
+    targets.update({t.id: t for t in loaded if t.id in parent_ids})
+
+    ids = targets.keys()
+
+    # Counts are stored on the thought table. Only those that haven't been
+    # calculated yet need to be counted.
+    missing_upvotes = [tid for tid, t in targets.items() if t._upvotes is None]
+    upvote_counts = dict()
+    if len(missing_upvotes) > 0:
+        upvote_counts = dict(db.session.query(Upvote.parent_id, func.count(Upvote.id))
+            .filter(Upvote.parent_id.in_(missing_upvotes))
+            .filter(Upvote.state >= 0)
+            .group_by(Upvote.parent_id))
+
+    missing_comments = [tid for tid, t in targets.items() if t._comment_count is None]
+    comment_counts = dict()
+    if len(missing_comments) > 0:
+        comment_counts = dict(db.session.query(Thought.parent_id, func.count(Thought.id))
+            .filter(Thought.parent_id.in_(missing_comments))
+            .filter(Thought.kind == "thought")
+            .filter(Thought.state >= 0)
+            .group_by(Thought.parent_id))
+
+    upvoted = set()
+    if persona is not None:
+        upvoted = set(row.parent_id for row in db.session.query(Upvote.parent_id)
+            .filter(Upvote.parent_id.in_(ids))
+            .filter(Upvote.author_id == persona.id)
+            .filter(Upvote.state >= 0))
+
+    actor_id = persona.id if persona is not None else None
+
+    # Votes that haven't been flushed by the vote engine yet
+    live = votes.live_state(ids, actor_id) \
+        if current_app.config["VOTE_ENGINE"] else dict()
+    for tid, (count, live_upvoted) in live.items():
+        upvote_counts[tid] = count
+        if live_upvoted:
+            upvoted.add(tid)
+        else:
+            upvoted.discard(tid)
+
+    # Read access depends on the mindset and author of a Thought, which many
+    # Thoughts of a list share
+    readable = dict()
+    for t in targets.values():
+        key = (t.mindset_id, t.author_id)
+        if key not in readable:
+            readable[key] = t.authorize("read", actor_id)
+
+    for tid, t in targets.items():
+        setattr(t, PRELOAD_ATTR, {
+            "actor_id": actor_id,
+            "upvoted": tid in upvoted,
+            "upvote_count": upvote_counts[tid] if tid in live
+                else t._upvotes if t._upvotes is not None
+                else upvote_counts.get(tid, 0),
+            "comment_count": t._comment_count if t._comment_count is not None
+                else comment_counts.get(tid, 0),
+            "read": readable[(t.mindset_id, t.author_id)]
+        })
+
+    return thoughts
+
+
+def preloaded(thought, key, actor_id=False):
+    """Return a preloaded value or None if it was not preloaded
+
+    Args:
+        thought (Thought): Instance passed to `preload_thoughts`
+        key (String): One of the keys set by `preload_thoughts`
+        actor_id (String): If given, the value is only returned if it was
+            preloaded for this actor
+    """
+    data = getattr(thought, PRELOAD_ATTR, None)
+    if data is None or (actor_id is not False and data["actor_id"] != actor_id):
+        return None
+    return data[key]
+
+
+def upvoted_filter(thought):
+    """Return True if the active Persona upvoted thought
+
+    Always False while rendering fragments that are shared between viewers."""
+    if g.get("shared_fragment", False):
+        return False
+    rv = preloaded(thought, "upvoted")
+    return thought.upvoted() if rv is None else rv
+
+
+def upvote_count_filter(thought):
+    """Return the number of upvotes on thought"""
+    rv = preloaded(thought, "upvote_count")
+    return thought.upvote_count() if rv is None else rv
+
+
+def comment_count_filter(thought):
+    """Return the number of comments on thought"""
+    rv = preloaded(thought, "comment_count")
+    return thought.comment_count() if rv is None else rv
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.presence
+    ~~~~~
+
+    Tracks which Personas are currently connected to a chat room.
+
+    Presence is kept in Redis, using the connection configured for rq. Every
+    room has a sorted set of Persona IDs scored by the time of their last
+    heartbeat, so that members who disappear without leaving expire after
+    `PRESENCE_TIMEOUT` seconds. Connection times are collected in a hash and
+    written to `Persona.last_connected` in bulk by the periodical
+    `flush_presence` job instead of on every room join.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+import time
+
+from datetime import datetime
+from flask import current_app
+from flask.ext.rq import get_connection
+from sqlalchemy import bindparam
+
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import Persona
+
+logger = logging.getLogger('web')
+
+ROOM_KEY = "glia:presence:room:{}"
+NAMES_KEY = "glia:presence:names"
+LAST_CONNECTED_KEY = "glia:presence:last-connected"
+
+
+def _member(persona_id, names):
+    return {"id": persona_id, "username": names.get(persona_id)}
+
+
+def join(room_id, persona):
+    """Mark a Persona as present in a room
+
+    Also used for heartbeats of Personas that are already present.
+
+    Args:
+        room_id (String): ID of the room
+        persona (Persona): Persona that joined
+
+    Returns:
+        Boolean: True if the Persona was not present before
+    """
+    now = time.time()
+    pipe = get_connection().pipeline()
+    pipe.zadd(ROOM_KEY.format(room_id), **{persona.id: now})
+    pipe.hset(NAMES_KEY, persona.id, persona.username)
+    pipe.hset(LAST_CONNECTED_KEY, persona.id, now)
+    added, _, _ = pipe.execute()
+    return added == 1
+
+
+def leave(room_id, persona):
+    """Remove a Persona from a room
+
+    Returns:
+        Boolean: True if the Persona was present
+    """
+    return get_connection().zrem(ROOM_KEY.format(room_id), persona.id) == 1
+
+
+def expire(room_id):
+    """Remove all members of a room whose last heartbeat is too old
+
+    Returns:
+        list: Dicts with keys 'id' and 'username' of removed members
+    """
+    conn = get_connection()
+    key = ROOM_KEY.format(room_id)
+    cutoff = time.time() - current_app.config["PRESENCE_TIMEOUT"]
+
+    expired = conn.zrangebyscore(key, "-inf", cutoff)
+    if len(expired) == 0:
+        return []
+
+    pipe = conn.pipeline()
+    pipe.zrem(key, *expired)
+    pipe.hmget(NAMES_KEY, expired)
+    _, usernames = pipe.execute()
+    names = dict(zip(expired, usernames))
+    return [_member(persona_id, names) for persona_id in expired]
+
+
+def online(room_id):
+    """Return all members of a room, most recently active first
+
+    Returns:
+        dict: Lists 'nicknames' and 'ids' of present Personas
+    """
+    conn = get_connection()
+    cutoff = time.time() - current_app.config["PRESENCE_TIMEOUT"]
+    ids = conn.zrevrangebyscore(ROOM_KEY.format(room_id), "+inf", cutoff)
+    usernames = conn.hmget(NAMES_KEY, ids) if len(ids) > 0 else []
+    return {"nicknames": usernames, "ids": ids}
+
+
+def delta(joined=None, left=None):
+    """Return a presence update for broadcasting to a room
+
+    Args:
+        joined (list): Dicts with keys 'id' and 'username'
+        left (list): Dicts with keys 'id' and 'username'
+    """
+    return {"joined": joined or [], "left": left or []}
+
+
+def member(persona):
+    """Return a Persona in the format used by `delta`"""
+    return {"id": persona.id, "username": persona.username}
+
+
+def flush_last_connected():
+    """Write collected connection times to `Persona.last_connected`
+
+    Returns:
+        int: Number of updated Personas
+    """
+    pipe = get_connection().pipeline()
+    pipe.hgetall(LAST_CONNECTED_KEY)
+    pipe.delete(LAST_CONNECTED_KEY)
+    last_connected, _ = pipe.execute()
+
+    if len(last_connected) == 0:
+        return 0
+
+    # last_connected may be defined on a parent table of Persona
+    persona_table = Persona.last_connected.property.columns[0].table
+    db.session.execute(persona_table.update()
+        .where(persona_table.c.id == bindparam("persona_id"))
+        .values(last_connected=bindparam("last_connected")), [{
+            "persona_id": persona_id,
+            "last_connected": datetime.utcfromtimestamp(float(ts))
+        } for persona_id, ts in last_connected.items()])
+    db.session.commit()
+
+    return len(last_connected)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.readmarks
+    ~~~~~
+
+    Read state of notifications.
+
+    A notification is read once its recipient visits its URL. Instead of
+    updating the notification table during that request, the visit is
+    recorded in a Redis hash per Persona and written to the database with one
+    bulk update by the periodical `flush_readmarks` job.
+
+    The unread notifications of each Persona are cached, so that the badge and
+    dropdown in base.html as well as the check for visits to unread URLs don't
+    query the database. Cached entries are deleted when a notification for
+    the Persona is committed and updated in place when a visit is recorded.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+import time
+
+from datetime import datetime
+from flask import current_app
+from flask.ext.rq import get_connection
+from sqlalchemy import and_, bindparam, event, func
+from sqlalchemy.orm import Session
+
+from nucleus.nucleus.connections import db, cache
+from nucleus.nucleus.models import Notification
+
+logger = logging.getLogger('web')
+
+UNREAD_CACHE_KEY = "unread-notifications-{}"
+READMARKS_KEY = "glia:readmarks:{}"
+PERSONAS_KEY = "glia:readmarks:personas"
+
+# Session.info key for Persona IDs whose cached notifications are deleted on
+# commit
+INVALIDATE_INFO_KEY = "glia_unread_invalidate"
+
+# Change time of notifications without modified and created timestamps
+EPOCH = datetime(1970, 1, 1)
+
+
+def changed(notification):
+    """Return when a notification was last changed
+
+    `Notification.modified` is nullable, in which case the creation time is
+    used.
+    """
+    return notification.modified or notification.created or EPOCH
+
+
+def pending_readmarks(persona_id, conn=None):
+    """Return visits of a Persona that have not been flushed yet
+
+    Returns:
+        dict: Maps URLs to the datetime of the visit
+    """
+    conn = conn or get_connection()
+    return {url: datetime.utcfromtimestamp(float(ts)) for url, ts
+        in conn.hgetall(READMARKS_KEY.format(persona_id)).items()}
+
+
+def unread_notifications(persona):
+    """Return the unread notifications of a Persona, most recent first
+
+    Returns:
+        list: Dicts with keys 'id', 'url', 'text' and 'domain'
+    """
+    key = UNREAD_CACHE_KEY.format(persona.id)
+    rv = cache.get(key)
+    if rv is None:
+        pending = pending_readmarks(persona.id)
+        rv = [{
+            "id": n.id,
+            "url": n.url,
+            "text": n.text,
+            "domain": n.domain
+        } for n in persona.notification_list()
+            if n.url not in pending or changed(n) > pending[n.url]]
+        cache.set(key, rv, timeout=current_app.config["UNREAD_CACHE_TIMEOUT"])
+    return rv
+
+
+def mark_read(persona, url):
+    """Record that a Persona visited url if there are unread notifications for it
+
+    Returns:
+        int: Number of notifications marked read
+    """
+    notifications = unread_notifications(persona)
+    remaining = [n for n in notifications if n["url"] != url]
+    if len(remaining) == len(notifications):
+        return 0
+
+    pipe = get_connection().pipeline()
+    pipe.hset(READMARKS_KEY.format(persona.id), url, time.time())
+    pipe.sadd(PERSONAS_KEY, persona.id)
+    pipe.execute()
+
+    cache.set(UNREAD_CACHE_KEY.format(persona.id), remaining,
+        timeout=current_app.config["UNREAD_CACHE_TIMEOUT"])
+    return len(notifications) - len(remaining)
+
+
+def flush_readmarks():
+    """Write recorded visits to the notification table
+
+    Returns:
+        int: Number of updated notifications
+    """
+    conn = get_connection()
+    persona_ids = list(conn.smembers(PERSONAS_KEY))
+    if len(persona_ids) == 0:
+        return 0
+
+    pipe = conn.pipeline()
+    for persona_id in persona_ids:
+        pipe.hgetall(READMARKS_KEY.format(persona_id))
+        pipe.delete(READMARKS_KEY.format(persona_id))
+    pipe.srem(PERSONAS_KEY, *persona_ids)
+    results = pipe.execute()
+
+    params = []
+    for persona_id, readmarks in zip(persona_ids, results[0:-1:2]):
+        params.extend([{
+            "persona_id": persona_id,
+            "visited_url": url,
+            "visited": datetime.utcfromtimestamp(float(ts))
+        } for url, ts in readmarks.items()])
+
+    if len(params) == 0:
+        return 0
+
+    notification_table = Notification.__table__
+    rv = db.session.execute(notification_table.update()
+        .where(and_(
+            notification_table.c.recipient_id == bindparam("persona_id"),
+            notification_table.c.url == bindparam("visited_url"),
+            notification_table.c.unread == True,
+            func.coalesce(notification_table.c.modified,
+                notification_table.c.created, EPOCH) <= bindparam("visited")))
+        .values(unread=False), params)
+    db.session.commit()
+
+    return rv.rowcount
+
+
+@event.listens_for(Session, "after_flush")
+def collect_notified_personas(session, flush_context):
+    """Remember recipients of new or changed notifications"""
+    persona_ids = session.info.setdefault(INVALIDATE_INFO_KEY, set())
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Notification):
+            persona_ids.add(obj.recipient_id)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_unread_notifications(session):
+    """Delete cached notifications of recipients once changes are committed"""
+    persona_ids = session.info.pop(INVALIDATE_INFO_KEY, None)
+    if persona_ids:
+        cache.delete_many(*[UNREAD_CACHE_KEY.format(pid)
+            for pid in persona_ids if pid is not None])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_notified_personas(session, previous_transaction):
+    session.info.pop(INVALIDATE_INFO_KEY, None)
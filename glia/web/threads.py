@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.threads
+    ~~~~~
+
+    Loads the conversation around a Thought for the `thought` view.
+
+    The chain of ancestors shown as context and the tree of replies are each
+    fetched with a single recursive query on PostgreSQL. Other databases (the
+    SQLite database used for unit testing) fall back to one query per level.
+    The loaded replies are attached to their parents so that rendering the
+    tree with the `replies` filter does not lazy-load anything.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+from collections import defaultdict
+from sqlalchemy import literal
+
+from nucleus.nucleus.connections import db
+from nucleus.nucleus.models import Thought
+
+# Levels of replies rendered by the `comment_tree` macro in macros/thought.html
+THREAD_DEPTH = 4
+
+# Maximum length of conversation context (see `async_thought`)
+MAX_CONTEXT_LENGTH = 10
+
+# Name of the instance attribute holding preloaded replies
+REPLIES_ATTR = "_thread_replies"
+
+
+def _recursive_queries():
+    """Return True if the database supports recursive common table expressions"""
+    return db.engine.dialect.name == "postgresql"
+
+
+def load_context(thought):
+    """Return the ancestors of a Thought shown as its conversation context
+
+    Args:
+        thought (Thought): Thought whose context is loaded
+
+    Returns:
+        list: Up to `thought.context_length` ancestors, oldest first
+    """
+    limit = min(thought.context_length or 0, MAX_CONTEXT_LENGTH)
+    if limit <= 0 or thought.parent_id is None:
+        return []
+
+    if _recursive_queries():
+        thought_table = Thought.__table__
+        parent_table = thought_table.alias()
+
+        ancestors = db.session.query(
+            thought_table.c.id,
+            thought_table.c.parent_id,
+            literal(1).label("depth")) \
+            .filter(thought_table.c.id == thought.parent_id) \
+            .cte("ancestors", recursive=True)
+        ancestors_alias = ancestors.alias()
+
+        ancestors = ancestors.union_all(db.session.query(
+            parent_table.c.id,
+            parent_table.c.parent_id,
+            (ancestors_alias.c.depth + 1).label("depth"))
+            .filter(parent_table.c.id == ancestors_alias.c.parent_id)
+            .filter(ancestors_alias.c.depth < limit))
+
+        rv = [t for t, depth in db.session.query(Thought, ancestors.c.depth)
+            .join(ancestors, Thought.id == ancestors.c.id)
+            .order_by(ancestors.c.depth.desc())]
+    else:
+        rv = []
+        current = thought
+        while len(rv) < limit and current.parent_id is not None:
+            current = current.parent
+            rv.insert(0, current)
+
+    return rv
+
+
+def load_replies(thought, depth=THREAD_DEPTH):
+    """Load the tree of replies to a Thought and attach it to the instances
+
+    Args:
+        thought (Thought): Root of the tree
+        depth (int): Number of levels to load
+
+    Returns:
+        list: All loaded replies
+    """
+    if _recursive_queries():
+        thought_table = Thought.__table__
+        child_table = thought_table.alias()
+
+        replies = db.session.query(
+            thought_table.c.id,
+            literal(1).label("depth")) \
+            .filter(thought_table.c.parent_id == thought.id) \
+            .filter(thought_table.c.kind == "thought") \
+            .cte("replies", recursive=True)
+        replies_alias = replies.alias()
+
+        replies = replies.union_all(db.session.query(
+            child_table.c.id,
+            (replies_alias.c.depth + 1).label("depth"))
+            .filter(child_table.c.parent_id == replies_alias.c.id)
+            .filter(child_table.c.kind == "thought")
+            .filter(replies_alias.c.depth < depth))
+
+        rv = db.session.query(Thought) \
+            .join(replies, Thought.id == replies.c.id) \
+            .order_by(Thought._hot.desc()) \
+            .all()
+    else:
+        rv = []
+        frontier = [thought.id]
+        for _ in range(depth):
+            children = Thought.query \
+                .filter(Thought.parent_id.in_(frontier)) \
+                .filter_by(kind="thought") \
+                .order_by(Thought._hot.desc()) \
+                .all()
+            if len(children) == 0:
+                break
+            rv.extend(children)
+            frontier = [t.id for t in children]
+
+    tree = defaultdict(list)
+    for t in rv:
+        tree[t.parent_id].append(t)
+
+    # Replies on the deepest level get an empty list even if they have
+    # children of their own, as the template never expands them
+    for t in [thought] + rv:
+        setattr(t, REPLIES_ATTR, tree[t.id])
+
+    return rv
+
+
+def replies_filter(thought):
+    """Return replies to a Thought, ordered by hotness
+
+    Uses the tree attached by `load_replies` if available."""
+    rv = getattr(thought, REPLIES_ATTR, None)
+    if rv is None:
+        rv = Thought.query \
+            .filter_by(parent_id=thought.id) \
+            .filter_by(kind="thought") \
+            .order_by(Thought._hot.desc()) \
+            .all()
+    return rv
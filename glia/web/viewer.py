@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    glia.web.viewer
+    ~~~~~
+
+    Identity of the user making the current request.
+
+    `get_viewer` returns a `Viewer` that is created once per request and used
+    by the context processors and the `authorize` filter. Data that every page
+    needs about the active Persona (movement memberships, repost mindsets and
+    followed blogs) is cached for `VIEWER_CACHE_TIMEOUT` seconds, keyed by
+    Persona ID. Cached entries are deleted after a commit changes the Persona
+    or one of its movement memberships.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import logging
+
+from flask import current_app, g
+from flask.ext.login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from nucleus.nucleus.connections import cache
+from nucleus.nucleus.models import Persona, Movement, Mindset, \
+    MovementMemberAssociation
+
+from glia.replica import read_only
+
+logger = logging.getLogger('web')
+
+VIEWER_CACHE_KEY = "viewer-{}"
+
+# Session.info key for Persona IDs whose cached data is deleted on commit
+INVALIDATE_INFO_KEY = "glia_viewer_invalidate"
+
+
+class Viewer(object):
+    """Identity and navigation data of the current user
+
+    Movements and mindsets are returned as dicts with the attributes used by
+    base.html, so that no models need to be loaded on cache hits."""
+
+    def __init__(self, user):
+        self.user = user
+        self.anonymous = user.is_anonymous()
+        self._data = None
+
+    @property
+    def persona(self):
+        return self.user.active_persona
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = load_viewer_data(self.persona)
+        return self._data
+
+    @property
+    def movements(self):
+        """Movements shown in the navigation bar"""
+        if self.anonymous:
+            return read_only(Movement.top_movements)()
+        return self.data["movements"]
+
+    @property
+    def repost_mindsets(self):
+        """Mindsets the active Persona can repost to"""
+        return [] if self.anonymous else self.data["repost_mindsets"]
+
+    def is_following(self, ident):
+        """Return True if the active Persona follows the blog of ident"""
+        return not self.anonymous and ident.id in self.data["followed_ids"]
+
+
+def get_viewer():
+    """Return the Viewer of the current request, creating it if necessary"""
+    rv = g.get("viewer", None)
+    if rv is None or rv.user is not current_user._get_current_object():
+        rv = Viewer(current_user._get_current_object())
+        g.viewer = rv
+    return rv
+
+
+def load_viewer_data(persona):
+    """Return cached navigation data of a Persona
+
+    Returns:
+        dict: Lists 'movements' (dicts with 'id' and 'username'),
+            'repost_mindsets' (dicts with 'id' and 'name') and 'followed_ids'
+    """
+    key = VIEWER_CACHE_KEY.format(persona.id)
+    rv = cache.get(key)
+    if rv is None:
+        repost_ids = persona.repost_mindsets()
+        mindsets = Mindset.query.filter(Mindset.id.in_(repost_ids)).all() \
+            if len(repost_ids) > 0 else []
+
+        rv = {
+            "movements": [{"id": m.id, "username": m.username}
+                for m in persona.movements()],
+            "repost_mindsets": [{"id": m.id, "name": m.name} for m in mindsets],
+            "followed_ids": [ident.id for ident in persona.blogs_followed]
+        }
+        cache.set(key, rv, timeout=current_app.config["VIEWER_CACHE_TIMEOUT"])
+    return rv
+
+
+@event.listens_for(Session, "after_flush")
+def collect_changed_viewers(session, flush_context):
+    """Remember Personas whose memberships or attributes were changed"""
+    persona_ids = session.info.setdefault(INVALIDATE_INFO_KEY, set())
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Persona):
+            persona_ids.add(obj.id)
+        elif isinstance(obj, MovementMemberAssociation):
+            persona_ids.add(obj.persona_id)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_viewers(session):
+    """Delete cached data of changed Personas once changes are committed"""
+    persona_ids = session.info.pop(INVALIDATE_INFO_KEY, None)
+    if persona_ids:
+        cache.delete_many(*[VIEWER_CACHE_KEY.format(pid)
+            for pid in persona_ids if pid is not None])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_changed_viewers(session, previous_transaction):
+    session.info.pop(INVALIDATE_INFO_KEY, None)
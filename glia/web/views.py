@@ -10,8 +10,9 @@
 import datetime
 import traceback
 
+from collections import OrderedDict
 from flask import request, redirect, render_template, flash, url_for, session, \
-    current_app, abort
+    abort
 from flask.ext.login import login_user, logout_user, current_user, login_required
 from flask.ext.sqlalchemy import get_debug_queries
 from jinja2.exceptions import TemplateNotFound
@@ -21,17 +22,27 @@ from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import joinedload
 
 from . import app, VIEW_CACHE_TIMEOUT
-from .. import socketio
+from glia import bus
 from forms import LoginForm, SignupForm, CreateMovementForm, CreateReplyForm, \
     DeleteThoughtForm, CreateThoughtForm, CreatePersonaForm, \
     EditThoughtForm, InviteMembersForm, EmailPrefsForm
 # from glia.web.dev_helpers import http_auth
 from glia.web.helpers import send_validation_email, \
-    send_external_notifications, send_movement_invitation, \
-    valid_redirect, make_view_cache_key, reorder, generate_graph
+    dispatch_notifications, send_movement_invitation, \
+    valid_redirect, make_view_cache_key, generate_graph
+from glia.attachments import attach_longform, attached_percepts, \
+    sync_attachments, create_from_input
+from glia.keypool import assign_keys
+from glia.percepts import content_digest, get_or_create
+from glia.replica import read_only
+from glia.web.broadcast import chat_payloads
+from glia.web.frontpage import get_snapshot, hydrate_snapshot
+from glia.web.preload import preload_thoughts, upvote_count_filter
+from glia.web.readmarks import mark_read
+from glia.web.threads import load_context, load_replies
 from nucleus.nucleus import ALLOWED_COLORS
 from nucleus.nucleus.connections import db, cache
-from nucleus.nucleus.helpers import process_attachments, recent_thoughts
+from nucleus.nucleus.helpers import recent_thoughts
 from nucleus.nucleus.models import Persona, User, Movement, \
     Thought, Mindset, MovementMemberAssociation, Tag, TagPercept, \
     PerceptAssociation, Notification, \
@@ -53,17 +64,10 @@ def mark_notifications_read():
     """Mark notifications for the current request path as read"""
 
     if not current_user.is_anonymous():
-        notifications = Notification.query \
-            .filter_by(url=request.path) \
-            .filter_by(recipient=current_user.active_persona) \
-            .filter_by(unread=True)
-
-        for n in notifications:
-            n.unread = False
-            db.session.add(n)
-            app.logger.debug("Marked {} read".format(n))
-
-        db.session.commit()
+        count = mark_read(current_user.active_persona, request.path)
+        if count > 0:
+            app.logger.debug("Marked {} notifications for {} read".format(
+                count, request.path))
 
 #
 # ROUTES
@@ -113,8 +117,8 @@ def create_persona(for_movement=None):
             user=current_user)
 
         # Create keypairs
-        app.logger.info("Generating private keys for {}".format(persona))
-        persona.generate_keys(form.password.data)
+        app.logger.info("Assigning private keys to {}".format(persona))
+        assign_keys(persona, form.password.data)
 
         # Create mindspace and blog
         persona.mindspace = Mindspace(
@@ -192,10 +196,8 @@ def create_thought():
 
     if form.validate_on_submit():
         try:
-            thought_data = Thought.create_from_input(
+            thought_data = create_from_input(
                 text=form.text.data,
-                longform=form.longform.data,
-                longform_source=form.lfsource.data,
                 parent=parent,
                 mindset=ms)
         except ValueError, e:
@@ -206,6 +208,10 @@ def create_thought():
             thought = thought_data["instance"]
             thought.posted_from = "web-form"
 
+            if form.longform.data and len(form.longform.data) > 0:
+                attach_longform(thought, form.longform.data,
+                    source=form.lfsource.data)
+
             thought.toggle_upvote()
 
             db.session.add(thought)
@@ -218,26 +224,13 @@ def create_thought():
                 app.logger.error("Error creating longform thought: {}".format(e))
                 flash("An error occured saving your message. Please try again.")
             else:
-                map(send_external_notifications, thought_data["notifications"])
-
-                # Render using templates
-                thought_macros_template = current_app.jinja_env.get_template(
-                    'macros/thought.html')
-                thought_macros = thought_macros_template.make_module(
-                    {'request': request})
-
-                data = {
-                    'username': thought.author.username,
-                    'msg': render_template("chatline.html", thought=thought),
-                    'thought_id': thought.id,
-                    'parent_id': thought.parent_id,
-                    'parent_short': thought_macros.short(thought.parent) if thought.parent else None,
-                    'vote_count': thought.upvote_count()
-                }
-                socketio.emit('message', data, room=form.mindset.data)
-
-                socketio.emit('comment', {'msg': thought_macros.comment(thought),
-                    'parent_id': form.parent.data}, room=form.parent.data)
+                dispatch_notifications(thought_data["notifications"])
+
+                data, reply_data = chat_payloads(thought)
+                bus.emit('message', data, room=form.mindset.data)
+
+                reply_data['parent_id'] = form.parent.data
+                bus.emit('comment', reply_data, room=form.parent.data)
                 flash("Great success! Your new post is ready.")
                 return redirect(url_for("web.thought", id=thought.id))
 
@@ -300,40 +293,34 @@ def edit_thought(id=None):
         thought.text = form.text.data
         db.session.add(thought)
 
-        # Append new attachments from longform field
-        if form.longform.data and len(form.longform.data) > 0:
-            lftext, percepts = process_attachments(form.longform.data)
-            app.logger.debug("Extracted {} percepts from longform".format(len(percepts)))
-
-            lftext_percept = TextPercept.get_or_create(lftext,
-                source=form.lfsource.data)
-            percepts.add(lftext_percept)
-
-            for p in percepts:
-                if PerceptAssociation.query.filter_by(thought=thought) \
-                        .filter_by(percept=p).count() == 0:
-                    pa = PerceptAssociation(thought=thought, percept=p,
-                        author=current_user.active_persona)
-                    db.session.add(pa)
+        existing = attached_percepts(thought)
+        desired = OrderedDict(existing)
 
         # Update longform fields
         edited_lf = [(k[9:], v) for k, v in request.form.items() if k.startswith('longform-')]
         for key, lftext in edited_lf:
-            oldp = TextPercept.query.get(key)
-            newp = TextPercept.get_or_create(lftext, source=request.form.get('lfsource-' + key))
-            if oldp != newp:
-                app.logger.info("Changed attachment from {} to {}".format(oldp, newp))
-                pa = PerceptAssociation.query.filter_by(
-                    thought=thought).filter_by(percept=oldp).first()
-                pa.percept = newp
-                pa.source = request.form.get('lfsource-' + key)
-                db.session.add(pa)
+            oldp = existing.get(key)
+            if oldp is None or \
+                    oldp.content_digest == content_digest("text", lftext):
+                continue
+
+            newp = get_or_create(TextPercept, lftext, source=request.form.get('lfsource-' + key))
+            app.logger.info("Changed attachment from {} to {}".format(oldp, newp))
+            del desired[key]
+            desired[newp.id] = newp
 
         # Delete attachments
         for delete_id in request.form.getlist('delete'):
             app.logger.info("Removing percept {}".format(delete_id))
-            PerceptAssociation.query.filter_by(thought=thought) \
-                .filter_by(percept_id=delete_id).delete()
+            desired.pop(delete_id, None)
+
+        sync_attachments(thought, desired.values(),
+            author=current_user.active_persona, existing=existing.keys())
+
+        # Append new attachments from longform field
+        if form.longform.data and len(form.longform.data) > 0:
+            attach_longform(thought, form.longform.data,
+                source=form.lfsource.data, author=current_user.active_persona)
 
         # Write to database
         try:
@@ -369,38 +356,37 @@ def help(page):
 #     timeout=VIEW_CACHE_TIMEOUT,
 #     key_prefix=make_view_cache_key
 # )
+@read_only
 def index():
     """Front page"""
     movementform = CreateMovementForm()
 
     # Determine content source
     if current_user.is_anonymous():
-        more_movements = Movement.query \
-            .filter(Movement.id.in_([m['id'] for m in Movement.top_movements()]))
-
-        top_main = reorder(Thought.query.filter(Thought.id.in_(
-            Thought.top_thought())))
-
+        top_main, more_movements, recent, graph_json = hydrate_snapshot(
+            get_snapshot())
         top_global = None
-        graph_json = generate_graph()
     else:
         more_movements = Movement.query \
             .filter(Movement.id.in_(
                 current_user.active_persona.suggested_movements()))
 
-        top_main = reorder(Thought.query.filter(
+        top_main = Thought.query.filter(
             Thought.id.in_(
                 Thought.top_thought(persona=current_user.active_persona,
                     filter_blogged=True))
-        ).options(joinedload('author').joinedload('percept_assocs')))
+        ).options(joinedload('author').joinedload('percept_assocs')) \
+            .order_by(Thought._hot.desc()).all()
 
-        top_global = reorder(Thought.query.filter(Thought.id.in_(
-            Thought.top_thought())))
+        top_global = Thought.query.filter(Thought.id.in_(
+            Thought.top_thought())).order_by(Thought._hot.desc()).all()
 
         graph_json = generate_graph(persona=current_user.active_persona)
 
-    recent = Thought.query.filter(Thought.id.in_(recent_thoughts())) \
-        .order_by(Thought.created.desc()).all()
+        recent = Thought.query.filter(Thought.id.in_(recent_thoughts())) \
+            .order_by(Thought.created.desc()).all()
+
+    preload_thoughts(top_main + (top_global or []) + recent, parents=False)
 
     return render_template('index.html', movementform=movementform,
         top_main=top_main, top_global=top_global, recent_thoughts=recent,
@@ -501,6 +487,7 @@ def movement(id):
 #     timeout=VIEW_CACHE_TIMEOUT,
 #     key_prefix=make_view_cache_key
 # )
+@read_only
 def movement_blog(id, page=1):
     """Display a movement's profile"""
     movement = Movement.query.get_or_404(id)
@@ -510,6 +497,7 @@ def movement_blog(id, page=1):
         .filter(Thought.state >= 0) \
         .order_by(Thought.created.desc()) \
         .paginate(page, 5)
+    preload_thoughts(thought_selection.items, parents=False)
 
     code = request.args.get("invitation_code", default=None)
     return render_template('movement_blog.html', movement=movement,
@@ -517,6 +505,7 @@ def movement_blog(id, page=1):
 
 
 @app.route("/movements/")
+@read_only
 def movement_list():
     """Display a list of all available movements"""
     movements = Movement.query.order_by(Movement.username).all()
@@ -539,15 +528,18 @@ def movement_mindspace(id):
         flash("Only members can access the mindspace of '{}'".format(movement.username))
         return redirect(url_for("web.movement_blog", id=movement.id))
 
-    thought_selection = reorder(Thought.query
-        .filter(Thought.id.in_(movement.mindspace_top_thought())))
+    thought_selection = Thought.query \
+        .filter(Thought.id.in_(movement.mindspace_top_thought())) \
+        .order_by(Thought._hot.desc()) \
+        .all()
     top_posts = list()
+    preload_thoughts(thought_selection, parents=False)
 
     blog_index = [t.id for t in movement.blog.index]
     for candidate in thought_selection:
         candidate.promote_target = None if candidate.id in blog_index \
             else movement
-        if candidate.upvote_count() > 0:
+        if upvote_count_filter(candidate) > 0:
             top_posts.append(candidate)
 
     member_selection = MovementMemberAssociation.query \
@@ -690,6 +682,7 @@ def persona(id):
 #     timeout=VIEW_CACHE_TIMEOUT,
 #     key_prefix=make_view_cache_key
 # )
+@read_only
 def persona_blog(id, page=1):
     """Display a persona's blog"""
     if id is None:
@@ -702,6 +695,7 @@ def persona_blog(id, page=1):
         .filter(Thought.state >= 0) \
         .order_by(Thought.created.desc()) \
         .paginate(page, 5)
+    preload_thoughts(thought_selection.items, parents=False)
 
     return render_template('persona_blog.html', persona=p, thoughts=thought_selection)
 
@@ -730,8 +724,8 @@ def signup():
             color=form.color.data)
 
         # Create keypairs
-        app.logger.info("Generating private keys for {}".format(persona))
-        persona.generate_keys(form.password.data)
+        app.logger.info("Assigning private keys to {}".format(persona))
+        assign_keys(persona, form.password.data)
 
         # Create mindspace and blog
         persona.mindspace = Mindspace(
@@ -752,7 +746,7 @@ def signup():
             db.session.add(mma)
 
         # Auto-follow top movements
-        top_movements = Movement.top_movements()
+        top_movements = read_only(Movement.top_movements)()
         app.logger.debug("Auto joining {}".format(
             ", ".join([m["username"] for m in top_movements])))
         for m_data in top_movements:
@@ -853,16 +847,19 @@ def signup_validation(id, signup_code):
 
 @app.route('/tag/<name>/')
 # @http_auth.login_required
+@read_only
 def tag(name):
     tag = Tag.query.filter_by(name=name).first()
 
-    thoughts = Thought.query.join(PerceptAssociation).join(TagPercept).filter(TagPercept.tag_id == tag.id)
+    thoughts = Thought.query.join(PerceptAssociation).join(TagPercept).filter(TagPercept.tag_id == tag.id).all()
+    preload_thoughts(thoughts, parents=False)
 
     return render_template("tag.html", tag=tag, thoughts=thoughts)
 
 
 @app.route('/thought/<id>/')
 # @http_auth.login_required
+@read_only
 def thought(id=None):
     thought = Thought.query.get_or_404(id)
 
@@ -870,14 +867,6 @@ def thought(id=None):
         flash("This Thought is private")
         return(redirect(url_for("web.index")))
 
-    # Load conversation context
-    context = []
-    while(len(context) < thought.context_length) and thought.parent is not None:
-        context.append(thought.parent if len(context) == 0 else context[-1].parent)
-        if context[-1].parent is None:
-            break
-    context = context[::-1]  # reverse list
-
     if thought.state < 0 and not thought.authorize("delete", current_user.active_persona.id):
         flash("This Thought is currently unavailable.")
         if request.referrer and request.referrer != request.url:
@@ -886,6 +875,11 @@ def thought(id=None):
             redirect_target = url_for('web.index')
         return redirect(redirect_target)
 
+    # Load conversation context and replies
+    context = load_context(thought)
+    replies = load_replies(thought)
+    preload_thoughts([thought] + context + replies, parents=False)
+
     reply_form = CreateReplyForm(parent=thought.id)
 
     return render_template("thought.html", thought=thought, context=context,
@@ -3,7 +3,7 @@
     glia.manage
     ~~~~~
 
-    Manage database migrations
+    Manage database migrations, caches and static assets
 
     :copyright: (c) 2015 by Vincent Ahrend.
 """
@@ -23,6 +23,18 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('--no-minify', dest='minified', action='store_false',
+    default=True, help="Only concatenate bundle sources")
+def assets(minified):
+    """Build fingerprinted and gzipped static bundles"""
+    from glia.assets import build
+
+    logging.warning("Building static bundles...")
+    manifest = build(app, minified=minified)
+    for name, filename in manifest.items():
+        print "{:<20} {}".format(name, filename)
+
+
 @manager.command
 def clearmc():
     """Flush memcache"""
@@ -39,5 +51,26 @@ def flushredis():
     subprocess.call(["redis-cli", "flushall"])
 
 
+@manager.option('-w', '--windows', dest='windows', type=int, default=5,
+    help="Number of time windows to combine")
+def metrics(windows):
+    """Show request and event metrics"""
+    from glia import instrumentation
+
+    summary = instrumentation.summary(windows)
+    print "{:<40} {:>7} {:>9} {:>7} {:>7} {:>8} {:>9} {:>11}".format(
+        "name", "count", "mean ms", "p95 ms", "queries", "sql ms", "render ms",
+        "cache hit %")
+    for name, m in sorted(summary.items(),
+            key=lambda item: item[1]["wall_time_mean"] * item[1]["count"],
+            reverse=True):
+        lookups = m["cache_hits"] + m["cache_misses"]
+        print "{:<40} {:>7} {:>9.1f} {:>7} {:>7.1f} {:>8.1f} {:>9.1f} {:>11}".format(
+            name[:40], m["count"], m["wall_time_mean"] * 1000, m["wall_time_p95"],
+            m["queries_mean"], m["sql_time_mean"] * 1000,
+            m["template_time_mean"] * 1000,
+            "{:.0f}".format(100.0 * m["cache_hits"] / lookups) if lookups else "-")
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,23 @@
+"""Add index for paginating mindset chat
+
+Revision ID: 2d8e5f0a7b13
+Revises: 4b2a7c1e9d30
+Create Date: 2016-01-15 11:08:52.631904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d8e5f0a7b13'
+down_revision = '4b2a7c1e9d30'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_thought_mindset_created', 'thought',
+        ['mindset_id', 'created', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_thought_mindset_created', table_name='thought')
@@ -0,0 +1,24 @@
+"""Add Percept content digest
+
+Revision ID: 5c1e7a9d2f46
+Revises: 2d8e5f0a7b13
+Create Date: 2016-01-21 10:42:13.518204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c1e7a9d2f46'
+down_revision = '2d8e5f0a7b13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('percept', sa.Column('content_digest', sa.String(length=40), nullable=True))
+    op.create_index(op.f('ix_percept_content_digest'), 'percept', ['content_digest'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_percept_content_digest'), table_name='percept')
+    op.drop_column('percept', 'content_digest')
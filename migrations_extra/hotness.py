@@ -0,0 +1,32 @@
+"""
+Alembic supplementary upgrade using ORM
+
+"""
+import sys, os
+sys.path.append(os.getcwd())
+
+from glia import create_app
+from nucleus.nucleus.database import db
+from nucleus.nucleus.models import Thought
+
+
+def upgrade(logger):
+    from glia.hotness import decay_hotness
+
+    thought_table = Thought.__table__
+    db.session.execute(thought_table.update()
+        .where(thought_table.c._hot == None)
+        .values(_hot=0))
+    db.session.commit()
+    logger.info("Initialized hotness of all thoughts")
+
+    decay_hotness()
+    logger.info("Updated hotness of recent thoughts")
+
+
+if __name__ == "__main__":
+    app = create_app()
+    app.logger.info("Starting upgrade")
+    with app.test_request_context('/'):
+        upgrade(app.logger)
+    app.logger.info("Upgrade finished")
@@ -0,0 +1,55 @@
+"""
+Alembic supplementary upgrade using ORM
+
+"""
+import sys, os
+sys.path.append(os.getcwd())
+
+from sqlalchemy import bindparam
+
+from glia import create_app
+from glia.percepts import percept_digest
+from nucleus.nucleus.database import db
+from nucleus.nucleus.models import Percept
+
+
+BATCH_SIZE = 500
+
+
+def upgrade(logger):
+    percept_table = Percept.__table__
+    update = percept_table.update() \
+        .where(percept_table.c.id == bindparam("percept_id")) \
+        .values(content_digest=bindparam("digest"))
+
+    count = 0
+    last_id = None
+    while True:
+        batch = Percept.query \
+            .with_polymorphic('*') \
+            .filter(Percept.content_digest == None)
+        if last_id is not None:
+            batch = batch.filter(Percept.id > last_id)
+        batch = batch.order_by(Percept.id).limit(BATCH_SIZE).all()
+        if len(batch) == 0:
+            break
+
+        last_id = batch[-1].id
+        digests = [{"percept_id": p.id, "digest": percept_digest(p)}
+            for p in batch]
+        digests = [d for d in digests if d["digest"] is not None]
+        if len(digests) > 0:
+            db.session.execute(update, digests)
+        db.session.commit()
+        db.session.expunge_all()
+
+        count += len(digests)
+        logger.info("Stored content digests of {} percepts".format(count))
+
+
+if __name__ == "__main__":
+    app = create_app()
+    app.logger.info("Starting upgrade")
+    with app.test_request_context('/'):
+        upgrade(app.logger)
+    app.logger.info("Upgrade finished")
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    run_benchmarks.py
+    ~~~~~
+
+    Benchmark suite for Glia
+
+    Optionally fills the configured database with a synthetic dataset, runs
+    the request scenarios from `benchmarks.scenarios` and, given a running
+    server, the chat load generator. Results are written as JSON to
+    `benchmarks/results/` so that runs of different commits can be compared:
+
+        >> python run_benchmarks.py --generate
+        >> python run_benchmarks.py --compare benchmarks/results/<old>.json
+
+    Use a dedicated database, the dataset generator adds users and content.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import subprocess
+
+from glia import create_app
+from glia.helpers import setup_loggers
+from benchmarks import dataset, scenarios
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "benchmarks", "results")
+DATASET_FILE = os.path.join(RESULTS_DIR, "dataset.json")
+
+logger = logging.getLogger('benchmarks')
+setup_loggers([logger, ])
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def flatten(results, prefix=""):
+    """Return a flat dict of the numbers in nested results"""
+    rv = dict()
+    for k, v in results.items():
+        key = "{}.{}".format(prefix, k) if prefix else k
+        if isinstance(v, dict):
+            rv.update(flatten(v, key))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            rv[key] = v
+    return rv
+
+
+def compare(old, new):
+    """Print the change of every metric between two results"""
+    old_values = flatten(old["scenarios"])
+    new_values = flatten(new["scenarios"])
+
+    print "{:<45} {:>12} {:>12} {:>9}".format(
+        "metric", old.get("commit", "old"), new.get("commit", "new"), "change")
+    for key in sorted(set(old_values) | set(new_values)):
+        a = old_values.get(key)
+        b = new_values.get(key)
+        change = "{:+.1f}%".format(100.0 * (b - a) / a) \
+            if a and b is not None else "-"
+        print "{:<45} {:>12} {:>12} {:>9}".format(key,
+            "{:.2f}".format(a) if a is not None else "-",
+            "{:.2f}".format(b) if b is not None else "-",
+            change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Glia benchmarks")
+    parser.add_argument("--generate", action="store_true",
+        help="Create a synthetic dataset before running scenarios")
+    parser.add_argument("--personas", type=int, default=50)
+    parser.add_argument("--movements", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=20,
+        help="Top-level thoughts per movement mindspace and blog")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scenario", action="append", dest="scenarios",
+        help="Run only this scenario (may be repeated)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--chat-server", metavar="HOST:PORT",
+        help="Also run the chat load generator against this server")
+    parser.add_argument("--chat-clients", type=int, default=5)
+    parser.add_argument("--output", help="Path of the JSON result file")
+    parser.add_argument("--compare", metavar="RESULT",
+        help="Compare the results with a previous result file")
+    args = parser.parse_args()
+
+    app = create_app(log_info=False)
+
+    if not os.path.isdir(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+
+    if args.generate:
+        logger.info("Generating dataset")
+        data = dataset.generate(app, personas=args.personas,
+            movements=args.movements, threads=args.threads, seed=args.seed)
+        with open(DATASET_FILE, "w") as f:
+            json.dump(data, f, indent=2)
+    elif os.path.exists(DATASET_FILE):
+        with open(DATASET_FILE) as f:
+            data = json.load(f)
+    else:
+        parser.error("No dataset found, run with --generate first")
+
+    results = {
+        "commit": current_commit(),
+        "created": datetime.datetime.utcnow().isoformat(),
+        "dataset": data,
+        "iterations": args.iterations,
+        "scenarios": scenarios.run(app, data, names=args.scenarios,
+            iterations=args.iterations)
+    }
+
+    if args.chat_server:
+        from benchmarks import chat_load
+
+        host, port = args.chat_server.split(":")
+        results["scenarios"]["chat"] = chat_load.run(host, int(port),
+            data["email"], dataset.BENCHMARK_PASSWORD, data["mindset_id"],
+            clients=args.chat_clients)
+
+    output = args.output or os.path.join(RESULTS_DIR, "{}-{}.json".format(
+        datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S"), results["commit"]))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logger.info("Results written to {}".format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    else:
+        print json.dumps(results["scenarios"], indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
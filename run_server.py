@@ -12,7 +12,9 @@
 from gevent import monkey
 monkey.patch_all()
 
-from glia import create_app, socketio
+import gevent
+
+from glia import bus, create_app, socketio
 from worker import periodic_schedule
 from socketio.server import SocketIOServer
 
@@ -21,6 +23,8 @@ app = create_app()
 
 if __name__ == '__main__':
     periodic_schedule()
+    if app.config['SOCKETIO_BACKEND'] == "redis":
+        gevent.spawn(bus.listen, app)
 
     if app.config['USE_DEBUG_SERVER']:
         # flask development server
@@ -9,6 +9,7 @@
 """
 
 import os
+import random
 import unittest
 import logging
 
@@ -32,18 +33,46 @@ logger = logging.getLogger('unittest')
 setup_loggers([logger, ])
 
 
+class NamespaceRecorder(object):
+    """Socket.IO namespace of a connection that records emitted events"""
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event, *args, **kwargs):
+        self.events.append((event, args))
+
+    def disconnect(self):
+        self.events.append(("disconnect", ()))
+
+
 class GliaTestCase(unittest.TestCase):
     def setUp(self):
+        from nucleus.nucleus.connections import db
+
         os.environ["GLIA_CONFIG"] = "../unittest_config.py"
         app = create_app(log_info=False)
 
+        self.flask_app = app
+        self.db_session = db.session
+        self.binds = app.config.get("SQLALCHEMY_BINDS")
         self.app = app.test_client()
 
         logger.info("Generating new Souma keypairs")
         self.register_souma()
 
     def tearDown(self):
+        from nucleus.nucleus.connections import db
+
+        # Tests may install the replica routing session
+        db.session.remove()
+        db.session = self.db_session
+        self.flask_app.config["SQLALCHEMY_BINDS"] = self.binds
+        self.flask_app.config["SQLALCHEMY_REPLICA_URI"] = None
+
         os.remove("./unittest_server.db")
+        if os.path.exists("./unittest_mail.jsonl"):
+            os.remove("./unittest_mail.jsonl")
         os.environ["GLIA_CONFIG"] = GLIA_CONFIG_OLD_VALUE
 
     def auth_headers(self, path, payload=""):
@@ -62,6 +91,44 @@ class GliaTestCase(unittest.TestCase):
         path = "/v0/soumas/"
         return self.app.post(path, data=payload, content_type='application/json', base_url=base_url)
 
+    def create_conversation(self, members=2):
+        """Create a movement with members and a Thought in its mindspace
+
+        Must be called in a request context.
+
+        Returns:
+            tuple: Movement, list of member Personas, Thought posted by the
+                first member
+        """
+        from benchmarks.dataset import create_persona, create_movement, post
+        from nucleus.nucleus.connections import db
+
+        rng = random.Random(0)
+        personas = [create_persona(n, rng) for n in range(members)]
+        db.session.commit()
+
+        movement = create_movement(0, personas[0], rng)
+        for persona in personas[1:]:
+            persona.toggle_movement_membership(movement=movement)
+        db.session.commit()
+
+        thought = post(personas[0], movement.mindspace, rng)
+        db.session.commit()
+        return movement, personas, thought
+
+    def socketio_event(self, event, message, namespace="/movements"):
+        """Call the Socket.IO handler of an event as the current user
+
+        Returns:
+            list: Tuples (event, args) emitted to the sender
+        """
+        from flask import request
+        from glia import socketio
+
+        request.namespace = NamespaceRecorder()
+        socketio.messages[namespace][event](message)
+        return request.namespace.events
+
     def test_register_souma(self):
         rv = self.register_souma()
         resp = json.loads(rv.data)
@@ -89,6 +156,474 @@ class GliaTestCase(unittest.TestCase):
         assert resp["meta"]["errors"][0][0] == ERROR["OBJECT_NOT_FOUND"](h)[0]
         assert resp["meta"]["errors"][0][1] == ERROR["OBJECT_NOT_FOUND"](h)[1]
 
+    def test_queue_email(self):
+        from glia.mail import queue_email
+
+        with self.flask_app.app_context():
+            queue_email(
+                to=["Test <test@app.souma>"],
+                subject="Test subject",
+                html="<p>Test</p>",
+                sender="RKTIK Test")
+
+        with open("./unittest_mail.jsonl") as f:
+            payload = json.loads(f.readlines()[-1])
+        assert payload["to"] == ["Test <test@app.souma>"]
+        assert payload["subject"] == "Test subject"
+
+    def test_mail_queue(self):
+        from flask.ext.rq import get_connection, get_queue
+        from redis.exceptions import ConnectionError
+        from glia import mail
+
+        self.flask_app.config["MAIL_QUEUE"] = True
+        with self.flask_app.app_context():
+            conn = get_connection('low')
+            try:
+                conn.delete(mail.OUTBOX_KEY, mail.FLUSH_PENDING_KEY,
+                    mail.PROCESSING_KEY)
+            except ConnectionError:
+                self.skipTest("Redis is not available")
+
+            flush_jobs = lambda: [j for j in get_queue('low').jobs
+                if j.func_name == "glia.jobs.flush_mail"]
+            existing = set([j.id for j in flush_jobs()])
+            try:
+                for n in range(3):
+                    mail.queue_email(
+                        to=["Test <test@app.souma>"],
+                        subject="Queued {}".format(n),
+                        html="<p>Test</p>",
+                        sender="RKTIK Test")
+
+                # Only the first message of the interval enqueues a flush
+                assert conn.llen(mail.OUTBOX_KEY) == 3
+                assert len([j for j in flush_jobs()
+                    if j.id not in existing]) == 1
+
+                assert mail.flush_outbox() == 3
+                assert conn.llen(mail.OUTBOX_KEY) == 0
+
+                # Messages the backend rejects are queued again
+                mail_file_path = self.flask_app.config["MAIL_FILE_PATH"]
+                self.flask_app.config["MAIL_FILE_PATH"] = "."
+                mail._backend = None
+                mail.queue_email(
+                    to=["Test <test@app.souma>"],
+                    subject="Rejected",
+                    html="<p>Test</p>",
+                    sender="RKTIK Test")
+                try:
+                    assert mail.flush_outbox() == 0
+                finally:
+                    self.flask_app.config["MAIL_FILE_PATH"] = mail_file_path
+                    mail._backend = None
+                retried = json.loads(conn.lindex(mail.OUTBOX_KEY, 0))
+                assert retried["subject"] == "Rejected"
+                assert retried["attempts"] == 1
+                assert not conn.exists(mail.PROCESSING_KEY)
+            finally:
+                for job in flush_jobs():
+                    if job.id not in existing:
+                        job.cancel()
+                        job.delete()
+                conn.delete(mail.OUTBOX_KEY, mail.FLUSH_PENDING_KEY,
+                    mail.PROCESSING_KEY)
+
+        with open("./unittest_mail.jsonl") as f:
+            subjects = [json.loads(line)["subject"] for line in f]
+        assert subjects == ["Queued 0", "Queued 1", "Queued 2"]
+
+    def test_broadcast_bus(self):
+        from flask.ext.rq import get_connection
+        from redis.exceptions import ConnectionError
+        from glia import bus
+
+        self.flask_app.config["SOCKETIO_BACKEND"] = "redis"
+        with self.flask_app.app_context():
+            pubsub = get_connection().pubsub()
+            try:
+                pubsub.subscribe(bus.CHANNEL)
+            except ConnectionError:
+                self.skipTest("Redis is not available")
+            messages = pubsub.listen()
+            next(messages)  # subscribe confirmation
+
+            bus.emit("status", {"msg": "Test"}, room="test-room")
+            item = next(messages)
+
+        message = json.loads(item["data"])
+        assert message["event"] == "status"
+        assert message["data"] == {"msg": "Test"}
+        assert message["room"] == "test-room"
+        assert message["namespace"] == "/movements"
+
+    def test_replica_routing(self):
+        from glia import replica
+        from nucleus.nucleus.connections import db
+        from nucleus.nucleus.models import Persona
+
+        self.flask_app.config["SQLALCHEMY_REPLICA_URI"] = \
+            "sqlite:///../unittest_replica.db"
+        replica.init_app(self.flask_app)
+
+        with self.flask_app.test_request_context('/'):
+            statement = Persona.query.statement
+            replica_engine = db.get_engine(self.flask_app,
+                bind=replica.REPLICA_BIND)
+            read_bind = replica.read_only(
+                lambda: db.session.get_bind(clause=statement))
+
+            assert db.session.get_bind(clause=statement) is db.engine
+            assert read_bind() is replica_engine
+
+            replica.use_primary()
+            assert read_bind() is db.engine
+
+    def test_replica_sticky_user(self):
+        from flask import session
+        from flask.ext.login import login_user
+        from flask.ext.rq import get_connection
+        from redis.exceptions import ConnectionError
+        from glia import replica
+        from nucleus.nucleus.connections import db
+        from nucleus.nucleus.models import Persona, User
+
+        self.flask_app.config["SQLALCHEMY_REPLICA_URI"] = \
+            "sqlite:///../unittest_replica.db"
+        replica.init_app(self.flask_app)
+
+        with self.flask_app.test_request_context('/'):
+            try:
+                get_connection().ping()
+            except ConnectionError:
+                self.skipTest("Redis is not available")
+
+            movement, (author, voter), thought = self.create_conversation()
+            user_id = author.user.id
+            get_connection().delete(replica.STICKY_KEY.format(user_id))
+
+        read_bind = replica.read_only(
+            lambda: db.session.get_bind(clause=Persona.query.statement))
+        try:
+            # Logged in, but the user is only loaded during the first query
+            with self.flask_app.test_request_context('/'):
+                session["user_id"] = user_id
+                assert read_bind() is db.get_engine(self.flask_app,
+                    bind=replica.REPLICA_BIND)
+
+                user = User.query.get(user_id)
+                login_user(user)
+                user.active_persona.username = "changed"
+                db.session.add(user.active_persona)
+                db.session.commit()
+                assert read_bind() is db.engine
+
+            with self.flask_app.test_request_context('/'):
+                session["user_id"] = user_id
+                assert read_bind() is db.engine
+        finally:
+            get_connection().delete(replica.STICKY_KEY.format(user_id))
+
+    def test_vote_request(self):
+        from flask.ext.login import login_user
+
+        with self.flask_app.test_request_context('/'):
+            movement, (author, voter), thought = self.create_conversation()
+
+            login_user(voter.user)
+            events = self.socketio_event("vote_request",
+                {"thought_id": thought.id})
+
+            assert events[0][0] == "vote"
+            vote = events[0][1][0]["votes"][0]
+            assert vote["thought_id"] == thought.id
+            assert vote["vote_count"] == 1
+            assert 0 < vote["voting_done"] <= 1
+            assert thought.upvote_count() == 1
+
+    def test_vote_engine(self):
+        from flask.ext.login import login_user
+        from flask.ext.rq import get_connection
+        from redis.exceptions import ConnectionError
+        from glia import votes
+        from nucleus.nucleus.models import Thought
+
+        self.flask_app.config["VOTE_ENGINE"] = True
+        with self.flask_app.test_request_context('/'):
+            try:
+                get_connection().ping()
+            except ConnectionError:
+                self.skipTest("Redis is not available")
+
+            movement, (author, voter), thought = self.create_conversation()
+            try:
+                login_user(voter.user)
+                events = self.socketio_event("vote_request",
+                    {"thought_id": thought.id})
+                assert events[0][1][0]["votes"][0]["vote_count"] == 1
+                assert votes.live_state([thought.id], voter.id) == \
+                    {thought.id: (1, True)}
+
+                assert votes.flush_votes() == 1
+                assert Thought.query.get(thought.id)._upvotes == 1
+                assert thought.upvote_count() == 1
+            finally:
+                get_connection().delete(votes.VOTERS_KEY.format(thought.id))
+
+    def test_deferred_links(self):
+        from flask.ext.login import login_user
+        from glia import attachments
+        from nucleus.nucleus import models as nucleus_models
+        from nucleus.nucleus.connections import db
+
+        # Installed by create_app
+        assert self.flask_app.extensions["glia_attachments"]["deferrable"]
+        assert nucleus_models.process_attachments is \
+            attachments._deferrable_process_attachments
+
+        self.flask_app.config["ASYNC_ATTACHMENTS"] = True
+        with self.flask_app.test_request_context('/'):
+            movement, (author, voter), thought = self.create_conversation()
+
+            login_user(voter.user)
+            text = "Look at http://example.com"
+            thought_data = attachments.create_from_input(text=text,
+                mindset=movement.mindspace, parent=None)
+            reply = thought_data["instance"]
+
+            jobs = db.session.info.pop(attachments.JOBS_INFO_KEY)
+            assert jobs == [("process_text", (reply.id, text))]
+            assert len(list(reply.percept_assocs)) == 0
+            db.session.rollback()
+
+    def test_preload_query_count(self):
+        from benchmarks.dataset import post
+        from benchmarks.scenarios import QueryCounter
+        from flask.ext.login import login_user
+        from glia.web.preload import preload_thoughts, preloaded
+        from nucleus.nucleus.connections import db
+        from nucleus.nucleus.models import Thought, User
+
+        with self.flask_app.test_request_context('/'):
+            movement, (author, voter), thought = self.create_conversation()
+            rng = random.Random(1)
+            for _ in range(6):
+                post(voter, movement.mindspace, rng, parent=thought)
+            db.session.commit()
+            parent_id = thought.id
+            user_id = voter.user.id
+
+        counts = []
+        for limit in (2, 6):
+            db.session.remove()
+            with self.flask_app.test_request_context('/'):
+                login_user(User.query.get(user_id))
+                replies = Thought.query.filter_by(parent_id=parent_id) \
+                    .limit(limit).all()
+                with QueryCounter(db.engine) as counter:
+                    preload_thoughts(replies)
+                    assert all(t.parent.id == parent_id for t in replies)
+                    assert all(preloaded(t, "read") for t in replies)
+                counts.append(counter.count)
+
+        assert counts[0] == counts[1]
+
+    def test_flush_readmarks(self):
+        from flask.ext.rq import get_connection
+        from redis.exceptions import ConnectionError
+        from glia.web import readmarks
+        from nucleus.nucleus.connections import db
+        from nucleus.nucleus.models import Notification, ReplyNotification
+
+        with self.flask_app.test_request_context('/'):
+            try:
+                get_connection().ping()
+            except ConnectionError:
+                self.skipTest("Redis is not available")
+
+            movement, (author, voter), thought = self.create_conversation()
+            notification = ReplyNotification(parent_thought=thought,
+                author=voter, url="/thought/readmarks-test/")
+            db.session.add(notification)
+            db.session.commit()
+
+            # Modified is nullable, the creation time counts instead
+            notification.modified = None
+            db.session.add(notification)
+            db.session.commit()
+            notification_id = notification.id
+
+            assert notification.url in [n["url"] for n in
+                readmarks.unread_notifications(author)]
+            assert readmarks.mark_read(author, notification.url) == 1
+            assert notification.url not in [n["url"] for n in
+                readmarks.unread_notifications(author)]
+
+            assert readmarks.flush_readmarks() >= 1
+            assert Notification.query.get(notification_id).unread is False
+
+    def test_keypool_assign(self):
+        from flask.ext.rq import get_connection
+        from redis.exceptions import ConnectionError
+        from glia import keypool
+
+        self.flask_app.config["KEYPOOL"] = True
+        self.flask_app.config["KEYPOOL_MIN_SIZE"] = 0
+        with self.flask_app.test_request_context('/'):
+            conn = get_connection('low')
+            try:
+                conn.delete(keypool.POOL_KEY)
+            except ConnectionError:
+                self.skipTest("Redis is not available")
+
+            # The first member's keys are generated by Nucleus
+            movement, (generated, pooled), thought = self.create_conversation()
+            try:
+                keyset = keypool.generate_keyset()
+                conn.rpush(keypool.POOL_KEY,
+                    keypool._pool_cipher().encrypt(json.dumps(keyset)))
+                keypool.assign_keys(pooled, u"password")
+            finally:
+                conn.delete(keypool.POOL_KEY)
+
+            assert pooled.sign_public == keyset["sign_public"]
+            for persona in (generated, pooled):
+                signature = persona.sign("Keypool test")
+                assert persona.verify("Keypool test", signature)
+
+    def test_percept_digest(self):
+        from glia.percepts import content_digest, find_percept, \
+            get_or_create
+        from nucleus.nucleus.connections import db
+        from nucleus.nucleus.models import TextPercept
+
+        text = u"Digest test {}".format(uuid4().hex)
+        with self.flask_app.test_request_context('/'):
+            percept = get_or_create(TextPercept, text)
+            db.session.add(percept)
+            db.session.commit()
+
+            assert percept.content_digest == content_digest("text", text)
+            assert find_percept(TextPercept, text) == percept
+            assert get_or_create(TextPercept, text) == percept
+
+    def test_presence_heartbeat(self):
+        from flask.ext.login import login_user
+        from flask.ext.rq import get_connection
+        from redis.exceptions import ConnectionError
+        from glia import bus
+        from glia.web import presence
+
+        room_id = uuid4().hex
+        emitted = []
+        emit = bus.emit
+        bus.emit = lambda event, data, **kwargs: emitted.append((event, data))
+        with self.flask_app.test_request_context('/'):
+            try:
+                get_connection().ping()
+            except ConnectionError:
+                self.skipTest("Redis is not available")
+
+            movement, (author, voter), thought = self.create_conversation()
+            try:
+                # Announced when the first heartbeat arrives
+                login_user(voter.user)
+                self.socketio_event("heartbeat", {"room_id": room_id})
+                assert emitted == [("presence", presence.delta(
+                    joined=[presence.member(voter)]))]
+
+                # Members without recent heartbeat are announced as leaving
+                presence.join(room_id, author)
+                get_connection().zadd(presence.ROOM_KEY.format(room_id),
+                    **{author.id: 0})
+                self.socketio_event("heartbeat", {"room_id": room_id})
+                assert emitted[-1][1]["left"] == [presence.member(author)]
+                assert presence.online(room_id)["ids"] == [voter.id]
+            finally:
+                bus.emit = emit
+                get_connection().delete(presence.ROOM_KEY.format(room_id))
+
+    def test_frontpage_snapshot_lock(self):
+        from glia.web import frontpage
+        from nucleus.nucleus.connections import cache
+
+        with self.flask_app.test_request_context('/'):
+            built = frontpage.build_snapshot()
+            cache.delete(frontpage.SNAPSHOT_CACHE_KEY)
+
+            # Requests while another one rebuilds get the last snapshot
+            cache.add(frontpage.LOCK_CACHE_KEY, True)
+            assert frontpage.get_snapshot()["created"] == built["created"]
+
+            cache.delete(frontpage.STALE_CACHE_KEY)
+            assert frontpage.get_snapshot()["top_thought_ids"] == []
+
+            cache.delete(frontpage.LOCK_CACHE_KEY)
+            rebuilt = frontpage.get_snapshot()
+            assert rebuilt["created"] > built["created"]
+            assert cache.get(frontpage.LOCK_CACHE_KEY) is None
+
+    def test_chat_cursor(self):
+        from glia.web.async import encode_cursor, decode_cursor
+
+        with self.flask_app.test_request_context('/'):
+            movement, personas, thought = self.create_conversation()
+
+            created, thought_id = decode_cursor(encode_cursor(thought))
+            assert created == thought.created
+            assert thought_id == thought.id
+
+            for cursor in ["not-a-cursor", "9" * 410 + "-id"]:
+                with self.assertRaises(ValueError):
+                    decode_cursor(cursor)
+
+    def test_stored_hotness(self):
+        import datetime
+        from glia import hotness
+        from nucleus.nucleus.connections import db
+        from nucleus.nucleus.models import Thought
+
+        with self.flask_app.test_request_context('/'):
+            movement, personas, thought = self.create_conversation()
+            assert thought._hot == thought.hot()
+
+            # Changed vote counts are scored when flushed
+            thought._upvotes = (thought._upvotes or 0) + 3
+            db.session.add(thought)
+            db.session.commit()
+            assert thought._hot == thought.hot()
+            score = thought._hot
+
+            # Old Thoughts keep their last score
+            db.session.execute(Thought.__table__.update()
+                .where(Thought.__table__.c.id == thought.id)
+                .values(created=datetime.datetime.utcnow() -
+                    datetime.timedelta(days=self.flask_app.config[
+                        "HOTNESS_DECAY_DAYS"] + 1)))
+            db.session.commit()
+            hotness.decay_hotness()
+            assert Thought.query.get(thought.id)._hot == score
+
+    def test_promote_once(self):
+        from glia import votes
+        from nucleus.nucleus.connections import db
+
+        with self.flask_app.test_request_context('/'):
+            movement, personas, thought = self.create_conversation()
+            required = movement.required_votes()
+            blog_size = movement.blog.index.count()
+
+            assert votes.promote(thought, required - 1) is None
+
+            # Later flushes above the threshold don't promote it again
+            assert votes.promote(thought, required) is not None
+            db.session.commit()
+            assert thought._blogged
+            assert votes.promote(thought, required + 1) is None
+            db.session.commit()
+            assert movement.blog.index.count() == blog_size + 1
+
 
 if __name__ == "__main__":
     unittest.main()
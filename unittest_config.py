@@ -43,3 +43,23 @@ except IOError:
     SECRET_KEY = os.urandom(24)
     with open('secret_key', 'w') as f:
         f.write(SECRET_KEY)
+
+# Deliver emails synchronously to a local file
+MAIL_BACKEND = "file"
+MAIL_QUEUE = False
+MAIL_FILE_PATH = "./unittest_mail.jsonl"
+
+# Generate keys in place instead of using the Redis key pool
+KEYPOOL = False
+
+# Emit Socket.IO events in the current process only
+SOCKETIO_BACKEND = "local"
+
+# Write votes to the database during the request
+VOTE_ENGINE = False
+
+# Process longform attachments during the request
+ASYNC_ATTACHMENTS = False
+
+# Don't record request metrics in Redis
+INSTRUMENTATION = False
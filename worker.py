@@ -22,18 +22,20 @@ scheduler = Scheduler(connection=conn, interval=INTERVAL)
 def periodic_schedule():
     """Enqueue in rq all periodically executed jobs"""
     from nucleus.nucleus import jobs
+    from glia import jobs as glia_jobs
 
-    logging.warning("Setting up periodical jobs:\n- {}".format("\n- ".join(j[0] for j in jobs.periodical)))
+    for module in (jobs, glia_jobs):
+        logging.warning("Setting up periodical jobs:\n- {}".format("\n- ".join(j[0] for j in module.periodical)))
 
-    for job in jobs.periodical:
-        jid = jobs.job_id("periodical", job[0])
+        for job in module.periodical:
+            jid = jobs.job_id("periodical", job[0])
 
-        scheduler.schedule(
-            scheduled_time=datetime.utcnow(),
-            func=getattr(jobs, job[0]),
-            interval=job[1],
-            id=jid,
-        )
+            scheduler.schedule(
+                scheduled_time=datetime.utcnow(),
+                func=getattr(module, job[0]),
+                interval=job[1],
+                id=jid,
+            )
 
 
 if __name__ == '__main__':